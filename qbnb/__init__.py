@@ -13,13 +13,134 @@ templates = os.path.join(
     package_dir, "templates"
 )
 
-app = Flask(__name__)
-db_string = os.getenv('db_string')
-if db_string:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_string
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../db.sqlite'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = '69cae04b04756f65eabcd2c5a11c8c24'
-app.app_context().push()
 
+def default_config():
+    '''
+    The settings read from the environment, used unless overridden
+    '''
+    return {
+        'SQLALCHEMY_DATABASE_URI':
+            os.getenv('db_string') or 'sqlite:///../db.sqlite',
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SECRET_KEY': '69cae04b04756f65eabcd2c5a11c8c24',
+        # password hashing work factor and the optional verification
+        # cache, see qbnb/passwords.py
+        'PASSWORD_HASH_ITERATIONS': int(
+            os.getenv('password_hash_iterations', 260000)),
+        'PASSWORD_VERIFY_CACHE_SIZE': int(
+            os.getenv('password_verify_cache_size', 0)),
+        'PASSWORD_VERIFY_CACHE_TTL': 60,
+        # per-process cache of logged in users, see get_session_user()
+        'USER_CACHE_SIZE': int(os.getenv('user_cache_size', 1024)),
+        'USER_CACHE_TTL': 30,
+        # per-process LRU of rendered page fragments, see
+        # qbnb/fragments.py
+        'FRAGMENT_CACHE_SIZE': int(os.getenv('fragment_cache_size', 256)),
+        # responses of at least this many bytes are compressed, with
+        # these gzip and brotli levels, see qbnb/compression.py
+        'COMPRESS_MIN_SIZE': int(os.getenv('compress_min_size', 500)),
+        'COMPRESS_LEVEL': 6,
+        'COMPRESS_BROTLI_QUALITY': 4,
+        # database of the async views of the ASGI mode, by default
+        # SQLALCHEMY_DATABASE_URI with an async driver, see
+        # qbnb/async_views.py
+        'ASYNC_DATABASE_URI': os.getenv('async_db_string'),
+        # connection pool of server databases such as MySQL, unused
+        # with SQLite, see qbnb/pool.py
+        'DB_POOL_SIZE': int(os.getenv('db_pool_size', 10)),
+        'DB_MAX_OVERFLOW': int(os.getenv('db_max_overflow', 20)),
+        'DB_POOL_TIMEOUT': float(os.getenv('db_pool_timeout', 10)),
+        'DB_POOL_RECYCLE': int(os.getenv('db_pool_recycle', 1800)),
+        'DB_POOL_PRE_PING': os.getenv('db_pool_pre_ping', '1') != '0',
+        # pragmas of the SQLite backend, 'wal' or 'default', see
+        # qbnb/sqlite_profile.py
+        'SQLITE_PROFILE': os.getenv('sqlite_profile', 'wal'),
+        # read replicas and how long a user reads from the primary
+        # after their own writes, see qbnb/replicas.py
+        'SQLALCHEMY_REPLICA_URIS': [
+            uri for uri in os.getenv('db_replica_strings', '').split(',')
+            if uri],
+        'REPLICA_READ_YOUR_WRITES': float(
+            os.getenv('replica_read_your_writes', 5)),
+        # listing search ranking and, without FTS5, how often the
+        # in-process index is rebuilt, see qbnb/search.py
+        'SEARCH_TITLE_WEIGHT': 10.0,
+        'SEARCH_RANK_CANDIDATES': 2000,
+        'SEARCH_INDEX_TTL': 600,
+        # queued bookings decided by a single writer, in batches, and
+        # how long it sleeps when the queue is empty, see
+        # qbnb/booking_queue.py
+        'BOOKING_QUEUE': os.getenv('booking_queue', '0') != '0',
+        'BOOKING_QUEUE_BATCH': int(os.getenv('booking_queue_batch', 100)),
+        'BOOKING_QUEUE_IDLE': 0.02,
+        # seconds between two balance snapshots taken by the serve
+        # command, 0 to leave them to a cron job, see qbnb/ledger.py
+        'BALANCE_SNAPSHOT_INTERVAL': int(
+            os.getenv('balance_snapshot_interval', 300)),
+        # where the processes of a multi-worker server share their
+        # metrics, see qbnb/metrics.py; the serve command sets one up
+        'METRICS_DIR': os.getenv('metrics_dir'),
+    }
+
+
+def create_app(config=None):
+    '''
+    Build the application
+      Parameters:
+        config (dict): settings overriding default_config()
+      Returns:
+        The Flask app with the routes registered. The database is
+        bound lazily: nothing connects until the first query, and the
+        tables are created by init_db() (python -m qbnb init-db), not
+        here.
+    '''
+    app = Flask(__name__)
+    app.config.update(default_config())
+    if config:
+        app.config.update(config)
+
+    # imported here so that importing qbnb stays cheap
+    from qbnb.models import db
+    from qbnb.controllers import bp
+    from qbnb.api import api
+    from qbnb.pool import pool_options, watch_pool
+    from qbnb.sqlite_profile import sqlite_pragmas, apply_pragmas
+    from qbnb.replicas import replica_key
+    from qbnb.metrics import init_metrics, watch_queries
+    from qbnb.compression import init_compression
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # explicit SQLALCHEMY_ENGINE_OPTIONS win over the DB_POOL_*
+        # settings
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+            pool_options(app.config),
+            **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for index, uri in enumerate(app.config['SQLALCHEMY_REPLICA_URIS']):
+        binds[replica_key(index)] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+    db.init_app(app)
+    app.register_blueprint(bp)
+    app.register_blueprint(api)
+    init_metrics(app)
+    # registered last so it runs first, and is timed by the metrics
+    init_compression(app)
+    with app.app_context():
+        # no connection is made, these only hook into new connections
+        pragmas = sqlite_pragmas(app.config)
+        for engine in db.engines.values():
+            watch_pool(engine)
+            watch_queries(engine)
+            if engine.dialect.name == 'sqlite':
+                apply_pragmas(engine, pragmas)
+    return app
+
+
+def __getattr__(name):
+    # `from qbnb import app` builds a default app on first use, for the
+    # scripts and tests that want a single shared one
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
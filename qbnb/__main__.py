@@ -1,12 +1,169 @@
-from qbnb import app
-from qbnb.models import *
-from qbnb.controllers import *
+import argparse
+import glob
+import os
+import sys
+import tempfile
+from qbnb import create_app
 
 """
-This file runs the server at a given port
+This file runs the server at a given port, or one of the maintenance
+commands:
+
+    python -m qbnb                            run the development server
+    python -m qbnb init-db                    create the tables
+    python -m qbnb serve [--workers N]        run the production server
+    python -m qbnb migrate [--batch-size N]   convert an old database
+    python -m qbnb import-listings FILE       bulk import listings
+    python -m qbnb reindex-search             rebuild the search index
+    python -m qbnb booking-writer             decide queued bookings
+    python -m qbnb snapshot-balances          snapshot the balances
+    python -m qbnb reconcile-ledger           check the balance ledger
 """
 
 FLASK_PORT = 8081
 
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m qbnb')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser(
+        'init-db', help='create the database tables that do not exist')
+    server = commands.add_parser(
+        'serve', help='run the production server with pre-forked workers')
+    server.add_argument('--host', default='0.0.0.0')
+    server.add_argument('--port', type=int, default=FLASK_PORT)
+    server.add_argument('--workers', type=int, default=os.cpu_count())
+    server.add_argument('--max-requests', type=int, default=1000,
+                        help='requests a worker serves before it is '
+                             'replaced, 0 to never recycle')
+    migrate = commands.add_parser(
+        'migrate', help='convert a database created with the old '
+                        'listing/booking schema to integer ids')
+    migrate.add_argument('--batch-size', type=int, default=1000,
+                         help='rows copied per transaction')
+    importer = commands.add_parser(
+        'import-listings', help='create listings from a CSV or JSON '
+                                'Lines file')
+    importer.add_argument('file')
+    importer.add_argument('--format', choices=['csv', 'jsonl'],
+                          help='guessed from the file extension if unset')
+    importer.add_argument('--chunk-size', type=int, default=500,
+                          help='rows written per transaction')
+    commands.add_parser(
+        'reindex-search', help='rebuild the listing search index')
+    commands.add_parser(
+        'booking-writer', help='decide queued bookings, for servers not '
+                               'started with serve')
+    commands.add_parser(
+        'snapshot-balances', help='snapshot the balances changed since '
+                                  'the last snapshot')
+    commands.add_parser(
+        'reconcile-ledger', help='check the balance ledger and repair '
+                                 'the snapshots')
+    args = parser.parse_args(argv)
+
+    app = create_app()
+    with app.app_context():
+        run_command(app, args)
+
+
+def prepare_metrics_dir(app):
+    # the workers add up their metrics through files, see
+    # qbnb/metrics.py; numbers of an earlier run are dropped
+    directory = app.config.get('METRICS_DIR')
+    if not directory:
+        app.config['METRICS_DIR'] = tempfile.mkdtemp(prefix='qbnb-metrics-')
+        return
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+def run_command(app, args):
+    # imported here rather than at the top, so --help stays fast
+    from qbnb.models import db, init_db
+    from qbnb.search import create_search_index, rebuild_search_index
+    if args.command == 'init-db':
+        from qbnb.migrate import OldSchemaError
+        try:
+            init_db()
+        except OldSchemaError as error:
+            sys.exit(str(error))
+        print('Database tables created.')
+    elif args.command == 'serve':
+        from qbnb.server import serve
+        prepare_metrics_dir(app)
+        services = []
+        if app.config['BOOKING_QUEUE']:
+            from qbnb.booking_queue import run_booking_writer
+            services.append(run_booking_writer)
+        if app.config['BALANCE_SNAPSHOT_INTERVAL'] > 0:
+            from qbnb.ledger import run_snapshots
+            services.append(run_snapshots)
+        from qbnb.metrics import set_worker_slot, flush_metrics
+
+        def post_fork(slot):
+            # connections opened while loading the app must not be
+            # shared between processes, each worker opens its own, of
+            # the primary and of every replica
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+            if slot is not None:
+                set_worker_slot(app, slot)
+
+        serve(app, args.host, args.port, args.workers, args.max_requests,
+              post_fork=post_fork, services=services,
+              # the last second's numbers of a recycled worker
+              worker_exit=lambda slot: flush_metrics(app))
+    elif args.command == 'migrate':
+        from qbnb.migrate import migrate_schema
+        report = migrate_schema(db.engine, args.batch_size)
+        if not report:
+            print('The database already uses the current schema.')
+        for name, count in report.items():
+            print('{}: {}'.format(name, count))
+        if report:
+            # the listings have new ids
+            create_search_index(db.session)
+            rebuild_search_index(db.session)
+            db.session.commit()
+    elif args.command == 'import-listings':
+        from qbnb.listing_import import read_listings, import_listings
+        rows = read_listings(args.file, args.format)
+        rejected = import_listings(rows, args.chunk_size)
+        for index, reason in rejected:
+            print('row {}: {}'.format(index + 1, reason))
+        print('{} rows rejected'.format(len(rejected)))
+    elif args.command == 'reindex-search':
+        create_search_index(db.session)
+        rebuild_search_index(db.session)
+        db.session.commit()
+        print('Search index rebuilt.')
+    elif args.command == 'booking-writer':
+        import signal
+        from qbnb.booking_queue import run_booking_writer
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+        try:
+            run_booking_writer(lambda: bool(stopping))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'snapshot-balances':
+        from qbnb.ledger import take_snapshots
+        print('{} balances snapshotted.'.format(take_snapshots()))
+    elif args.command == 'reconcile-ledger':
+        from qbnb.ledger import reconcile_ledger
+        for name, count in reconcile_ledger().items():
+            print('{}: {}'.format(name, count))
+    else:
+        # the reloader runs the app in a child process, the writer
+        # belongs there
+        if (app.config['BOOKING_QUEUE'] and
+                os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+            from qbnb.booking_queue import start_booking_writer
+            start_booking_writer(app)
+        app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
+
+
 if __name__ == "__main__":
-    app.run(debug=True, port=FLASK_PORT, host='0.0.0.0')
\ No newline at end of file
+    main()
@@ -0,0 +1,334 @@
+import functools
+from flask import Blueprint, current_app, jsonify, request, session
+from flask import url_for
+from qbnb.models import db, login, Listing, create_listing, update_listing
+from qbnb.models import create_booking, update_user, validate_user_update
+from qbnb.models import create_bookings
+from qbnb.models import get_listings_page, get_user_bookings
+from qbnb.models import get_session_user, get_balance, get_page_versions
+from qbnb.validation import validate_listing
+from qbnb.listing_import import import_listings
+from qbnb.booking_queue import enqueue_booking
+from qbnb.replicas import note_write
+from qbnb.fragments import cached, page_etag, conditional_response
+
+'''
+This file defines the JSON API, for integrations that have no use for
+the HTML pages:
+
+    POST  /api/v1/login               {email, password}, sets the
+                                      session cookie the other
+                                      endpoints need
+    GET   /api/v1/listings            a page of listings, ?after= and
+                                      ?page_size= as on the home page
+    POST  /api/v1/listings            create a listing of the user
+    PATCH /api/v1/listings/<id>       update one of the user's listings
+    POST  /api/v1/listings/batch      many of the two above
+    GET   /api/v1/bookings            the user's bookings
+    POST  /api/v1/bookings            book a listing
+    POST  /api/v1/bookings/batch      many bookings, all or none, or
+                                      with ?atomic=0 those that can be
+    GET   /api/v1/users/me            the user's profile and balance
+    PATCH /api/v1/users/me            update it
+
+The endpoints apply the same rules as the HTML routes, through the
+same model functions. Errors are answered as {"error": reason} with a
+4xx status. Batch endpoints take a JSON array of operations, at most
+MAX_BATCH, and answer 200 with one result per operation, in order:
+the created or updated object, or an error. Listing operations are
+applied in the order given, so a later one sees the effect of the
+earlier ones; consecutive creations are checked and written together,
+see qbnb/listing_import.py. Bookings are all checked and written in
+one locked transaction, see create_bookings(), also with the booking
+queue on.
+'''
+
+# registered on the app by create_app()
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+MAX_BATCH = 1000
+
+
+def error(reason, status=400):
+    return jsonify(error=reason), status
+
+
+def authenticate(inner_function):
+    '''
+    Like controllers.authenticate, answering 401 instead of redirecting
+    to the login page
+    '''
+    @functools.wraps(inner_function)
+    def wrapped(*args, **kwargs):
+        email = session.get('logged_in')
+        user = get_session_user(email) if email else None
+        if user is None:
+            return error('login required', 401)
+        return inner_function(user, *args, **kwargs)
+    return wrapped
+
+
+def _json_object():
+    body = request.get_json(silent=True)
+    return body if isinstance(body, dict) else None
+
+
+def _json_batch():
+    body = request.get_json(silent=True)
+    if not isinstance(body, list) or not body or len(body) > MAX_BATCH:
+        return None
+    return body
+
+
+def listing_json(listing):
+    return {'id': listing.id, 'title': listing.title,
+            'description': listing.description, 'price': listing.price,
+            'last_modified_date': str(listing.last_modified_date),
+            'owner_email': listing.owner.email}
+
+
+def booking_json(booking):
+    return {'id': booking.id, 'listing_id': booking.listing_id,
+            'listing_title': booking.listing.title,
+            'start_date': booking.start_date, 'end_date': booking.end_date}
+
+
+def user_json(user):
+    return {'id': user.id, 'username': user.username, 'email': user.email,
+            'billing_address': user.billing_address,
+            'postal_code': user.postal_code,
+            'balance': get_balance(user.id)}
+
+
+@api.route('/login', methods=['POST'])
+def login_post():
+    body = _json_object() or {}
+    user = login(body.get('email'), body.get('password'))
+    if user is None:
+        return error('login failed', 401)
+    session['logged_in'] = user.email
+    return jsonify(user_json(user))
+
+
+@api.route('/listings', methods=['GET'])
+@authenticate
+def listings_get(user):
+    page_size = request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int)
+    page_size = min(max(page_size, 1), MAX_PAGE_SIZE)
+    after = request.args.get('after') or None
+    listings_version, _ = get_page_versions(user.id)
+    key = ('api/listings', after, page_size, listings_version)
+
+    def page():
+        listings, next_cursor = get_listings_page(after, page_size)
+        return {'listings': [listing_json(listing) for listing in listings],
+                'next': next_cursor}
+
+    return conditional_response(page_etag(*key),
+                                lambda: jsonify(cached(key, page)))
+
+
+def _listing_values(body):
+    if any(body.get(f) is not None and not isinstance(body.get(f), str)
+           for f in ('title', 'description', 'last_modified_date')):
+        return None, 'invalid field'
+    try:
+        price = int(body.get('price'))
+    except (TypeError, ValueError):
+        return None, 'invalid price'
+    return {'title': body.get('title'), 'description': body.get('description'),
+            'price': price,
+            'last_modified_date': body.get('last_modified_date')}, None
+
+
+@api.route('/listings', methods=['POST'])
+@authenticate
+def listings_post(user):
+    values, reason = _listing_values(_json_object() or {})
+    if values is None:
+        return error(reason)
+    listing = create_listing(values['title'], values['description'],
+                             values['price'], values['last_modified_date'],
+                             user.email)
+    if listing is None:
+        return error(validate_listing(
+            values['title'], values['description'], values['price'],
+            values['last_modified_date']) or 'title already used')
+    return jsonify(listing_json(listing)), 201
+
+
+def _update_listing(user, listing_id, body):
+    '''
+    Update one of the user's listings
+      Returns:
+        The listing, or None and the reason it was not updated
+    '''
+    title = body.get('title') or 'N/A'
+    description = body.get('description') or 'N/A'
+    if not isinstance(title, str) or not isinstance(description, str):
+        return None, 'invalid field'
+    try:
+        price = int(body.get('price', -1))
+    except (TypeError, ValueError):
+        return None, 'invalid price'
+    listing = db.session.get(Listing, listing_id)
+    if listing is None or listing.owner_id != user.id:
+        return None, 'no such listing'
+    listing = update_listing(user.email, title, description, price,
+                             listing_id)
+    if listing is None:
+        return None, 'update rejected'
+    return listing, None
+
+
+@api.route('/listings/<int:listing_id>', methods=['PATCH'])
+@authenticate
+def listing_patch(user, listing_id):
+    listing, reason = _update_listing(user, listing_id,
+                                      _json_object() or {})
+    if listing is None:
+        return error(reason, 404 if reason == 'no such listing' else 400)
+    return jsonify(listing_json(listing))
+
+
+def _create_listings(user, creates, results):
+    '''
+    Write a run of consecutive creations of a batch together, see
+    qbnb/listing_import.py, and set their results
+    '''
+    if not creates:
+        return
+    rejected = dict(import_listings([dict(row, owner_email=user.email)
+                                     for _, row in creates]))
+    titles = [row['title'] for position, (_, row) in enumerate(creates)
+              if position not in rejected]
+    created = {listing.title: listing for listing in Listing.query.filter(
+        Listing.title.in_(titles))} if titles else {}
+    for position, (index, row) in enumerate(creates):
+        if position in rejected:
+            results[index] = {'error': rejected[position]}
+        else:
+            results[index] = created[row['title']]
+    note_write()
+
+
+@api.route('/listings/batch', methods=['POST'])
+@authenticate
+def listings_batch(user):
+    '''
+    [{"op": "create", title, description, price, last_modified_date},
+     {"op": "update", "id": 1, title, description, price}, ...]
+    '''
+    operations = _json_batch()
+    if operations is None:
+        return error('expected an array of 1 to {} operations'.format(
+            MAX_BATCH))
+    results = [None] * len(operations)
+    # operations are applied in order; consecutive creations are held
+    # back and written together before the next update
+    creates = []
+    for index, operation in enumerate(operations):
+        if isinstance(operation, dict) and operation.get('op') == 'create':
+            creates.append((index, operation))
+            continue
+        _create_listings(user, creates, results)
+        creates = []
+        if not isinstance(operation, dict):
+            results[index] = {'error': 'expected an object'}
+        elif operation.get('op') == 'update':
+            listing_id = operation.get('id')
+            if not isinstance(listing_id, int):
+                results[index] = {'error': 'no such listing'}
+                continue
+            listing, reason = _update_listing(user, listing_id, operation)
+            results[index] = listing if listing is not None else {
+                'error': reason}
+        else:
+            results[index] = {'error': 'unknown op'}
+    _create_listings(user, creates, results)
+    return jsonify(results=[
+        result if isinstance(result, dict) else listing_json(result)
+        for result in results])
+
+
+@api.route('/bookings', methods=['GET'])
+@authenticate
+def bookings_get(user):
+    return jsonify(bookings=[booking_json(booking) for booking in
+                             get_user_bookings(user.id)])
+
+
+def _book(user, body):
+    '''
+    Book or queue one booking
+      Returns:
+        The JSON result and the HTTP status for it
+    '''
+    listing_title = body.get('listing_title')
+    start_date = body.get('start_date')
+    end_date = body.get('end_date')
+    if current_app.config.get('BOOKING_QUEUE'):
+        # decided by the queue writer, see qbnb/booking_queue.py
+        token = enqueue_booking(user.email, listing_title, start_date,
+                                end_date)
+        if token is None:
+            return {'error': 'booking failed'}, 400
+        return {'token': token, 'status_url': url_for(
+            'qbnb.booking_status', token=token)}, 202
+    booking = create_booking(user.email, listing_title, start_date, end_date)
+    if booking is None:
+        return {'error': 'booking failed'}, 400
+    return booking_json(booking), 201
+
+
+@api.route('/bookings', methods=['POST'])
+@authenticate
+def bookings_post(user):
+    result, status = _book(user, _json_object() or {})
+    return jsonify(result), status
+
+
+@api.route('/bookings/batch', methods=['POST'])
+@authenticate
+def bookings_batch(user):
+    '''
+    [{listing_title, start_date, end_date}, ...]
+    '''
+    operations = _json_batch()
+    if operations is None or not all(isinstance(operation, dict)
+                                     for operation in operations):
+        return error('expected an array of 1 to {} objects'.format(
+            MAX_BATCH))
+    atomic = request.args.get('atomic', '1') != '0'
+    results = create_bookings(
+        [(user.email, operation.get('listing_title'),
+          operation.get('start_date'), operation.get('end_date'))
+         for operation in operations], atomic)
+    return jsonify(results=[
+        booking_json(booking) if booking is not None else {'error': reason}
+        for booking, reason in results])
+
+
+@api.route('/users/me', methods=['GET'])
+@authenticate
+def me_get(user):
+    return jsonify(user_json(user))
+
+
+@api.route('/users/me', methods=['PATCH'])
+@authenticate
+def me_patch(user):
+    body = _json_object() or {}
+    fields = [body.get(name) or '' for name in (
+        'username', 'email', 'billing_address', 'postal_code')]
+    old_email = user.email
+    updated = update_user(old_email, *fields)
+    if updated is None:
+        _, reason = validate_user_update(*fields)
+        return error(reason or 'email already used')
+    if updated.email != old_email:
+        # the session follows the user to their new email
+        session['logged_in'] = updated.email
+    return jsonify(user_json(updated))
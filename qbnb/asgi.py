@@ -0,0 +1,15 @@
+from qbnb import create_app
+from qbnb.async_views import AsyncApp
+
+'''
+This file is the ASGI entry point of the optional async serving mode,
+see qbnb/async_views.py, for running qbnb under an ASGI server, e.g.:
+
+    uvicorn --workers 4 --host 0.0.0.0 --port 8081 qbnb.asgi:application
+
+It needs Python 3.9 or later and:  pip install -r requirements-async.txt
+(and aiomysql or asyncpg instead of aiosqlite for a server database).
+Create the tables first with:  python -m qbnb init-db
+'''
+
+application = AsyncApp(create_app())
@@ -0,0 +1,304 @@
+import asyncio
+import io
+import sys
+import time
+import sqlalchemy as sa
+from asgiref.wsgi import WsgiToAsgi
+from flask import current_app, render_template, request, session, redirect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from qbnb.models import db, User, Listing, Booking, LedgerEntry
+from qbnb.models import parse_booking_dates, balance_query, cached_user
+from qbnb.models import overlap_candidate_query, booking_allowed
+from qbnb.models import cache_user, listings_page_query, listings_page
+from qbnb.models import user_bookings_query, PAGE_VERSIONS_QUERY
+from qbnb.validation import valid_email, valid_password
+from qbnb.passwords import verify_password, needs_rehash, hash_password
+from qbnb.controllers import home_arguments, home_keys, home_response
+from qbnb.controllers import feed_fragment, bookings_fragment
+from qbnb.fragments import cached_async, not_modified, tagged
+from qbnb.pool import pool_options
+from qbnb.replicas import note_write
+from qbnb.sqlite_profile import sqlite_pragmas, apply_pragmas
+
+'''
+This file implements the optional async serving mode, served through
+qbnb/asgi.py by an ASGI server such as uvicorn.
+
+POST /login, GET / and POST /create_booking are coroutines on
+SQLAlchemy's async engine: aiosqlite for SQLite, aiomysql or asyncpg
+for server databases, or ASYNC_DATABASE_URI when set. A request
+waiting on the database then holds no thread, so a process keeps many
+of them in flight. The views apply the same rules, render the same
+pages and set the same session cookie as those of
+qbnb/controllers.py, in a Flask request context of their own, with
+the app's before and after request hooks. Password hashing, which
+holds the CPU rather than waiting, runs in a thread.
+
+Every other route is served by the WSGI app through asgiref, one
+request at a time, and so is /create_booking with the booking queue
+on. The async views read from the primary only, read replicas are
+not used.
+'''
+
+# async drivers of the database backends
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+def async_database_url(app):
+    '''
+    ASYNC_DATABASE_URI, or the app's database with an async driver
+    '''
+    if app.config.get('ASYNC_DATABASE_URI'):
+        return app.config['ASYNC_DATABASE_URI']
+    with app.app_context():
+        # as resolved by Flask-SQLAlchemy, e.g. relative SQLite paths
+        url = db.engine.url
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def _engine():
+    return current_app.extensions['qbnb_async_engine']
+
+
+def _environ(scope, body):
+    # the WSGI environ of an ASGI http scope, for the request context
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ[name] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ \
+                else value
+    return environ
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+class AsyncApp:
+    '''
+    ASGI application serving the routes of the async views, and every
+    other request with the WSGI app
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        # the QueuePool subclass of qbnb/pool.py is for sync engines
+        options = {key: value for key, value in
+                   pool_options(app.config).items() if key != 'poolclass'}
+        engine = create_async_engine(async_database_url(app), **options)
+        if engine.dialect.name == 'sqlite':
+            apply_pragmas(engine.sync_engine, sqlite_pragmas(app.config))
+        app.extensions['qbnb_async_engine'] = engine
+        self.routes = {('POST', '/login'): login_post, ('GET', '/'): home}
+        if not app.config.get('BOOKING_QUEUE'):
+            self.routes['POST', '/create_booking'] = booking_creation_post
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        view = None
+        if scope['type'] == 'http':
+            view = self.routes.get((scope['method'], scope['path']))
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+        response = await self._dispatch(view, scope, await _read_body(
+            receive))
+        await send({'type': 'http.response.start',
+                    'status': response.status_code,
+                    'headers': [(name.lower().encode('latin1'),
+                                 value.encode('latin1')) for name, value in
+                                response.headers.items()]})
+        await send({'type': 'http.response.body',
+                    'body': response.get_data()})
+
+    async def _dispatch(self, view, scope, body):
+        # Flask's wsgi_app and full_dispatch_request, awaiting the view.
+        # The contexts are context variables, so each request's task
+        # has its own.
+        app = self.app
+        context = app.request_context(_environ(scope, body))
+        error = None
+        try:
+            context.push()
+            try:
+                response = app.preprocess_request()
+                if response is None:
+                    response = await view()
+            except Exception as exception:
+                response = app.handle_user_exception(exception)
+            return app.finalize_request(response)
+        except Exception as exception:
+            error = exception
+            return app.make_response(app.handle_exception(exception))
+        finally:
+            context.pop(error)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.app.extensions['qbnb_async_engine'].dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+async def login_post():
+    email = request.form.get('email')
+    password = request.form.get('password')
+    user = None
+    if valid_email(email) and valid_password(password):
+        async with _engine().connect() as connection:
+            user = (await connection.execute(sa.select(
+                User.email, User.password).where(User.email == email))
+            ).first()
+            # the hash holds the CPU, not the event loop
+            if user is not None and not await asyncio.to_thread(
+                    verify_password, password, user.password):
+                user = None
+            if user is not None and needs_rehash(user.password):
+                hashed = await asyncio.to_thread(hash_password, password)
+                await connection.execute(sa.update(User).where(
+                    User.email == email).values(password=hashed))
+                await connection.commit()
+    if user is None:
+        return render_template('login.html', message='login failed')
+    session['logged_in'] = user.email
+    # code 303 is to force a 'GET' request
+    return redirect('/', code=303)
+
+
+async def home():
+    email = session.get('logged_in')
+    if email is None:
+        return redirect('/login')
+    async with AsyncSession(_engine()) as db_session:
+        user = cached_user(email)
+        if user is None:
+            user = (await db_session.execute(sa.select(User).where(
+                User.email == email))).scalar_one_or_none()
+            if user is None:
+                return redirect('/login')
+            cache_user(user)
+
+        after, page_size = home_arguments()
+        versions = tuple((await db_session.execute(
+            PAGE_VERSIONS_QUERY, {'user_id': user.id})).one())
+        etag, feed_key, bookings_key = home_keys(user, after, page_size,
+                                                 versions)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+
+        async def feed():
+            listings = (await db_session.execute(listings_page_query(
+                after, page_size))).scalars().all()
+            return feed_fragment(*listings_page(listings, page_size),
+                                 page_size)
+
+        async def bookings():
+            return bookings_fragment(user, (await db_session.execute(
+                user_bookings_query(user.id))).scalars().all())
+
+        feed = await cached_async(feed_key, feed)
+        user_bookings = await cached_async(bookings_key, bookings)
+    return tagged(home_response(user, feed, user_bookings), etag)
+
+
+async def create_booking_async(user_email, listing_title, start_date,
+                               end_date):
+    '''
+    create_booking() on the async engine
+      Returns:
+        True if the booking was made
+    '''
+    dates = parse_booking_dates(start_date, end_date)
+    if dates is None:
+        return False
+    start_date, end_date = dates
+    async with _engine().connect() as connection:
+        try:
+            # see lock_for_write(), the connection is fresh
+            if connection.dialect.name == 'sqlite':
+                await connection.exec_driver_sql('BEGIN IMMEDIATE')
+            row = (await connection.execute(sa.select(
+                Listing.id, Listing.price, Listing.owner_id, User.id
+            ).join(User, User.email == user_email).where(
+                Listing.title == listing_title).with_for_update())).first()
+            if row is None:
+                await connection.rollback()
+                return False
+            listing_id, price, owner_id, guest_id = row
+            balance = (await connection.execute(balance_query(
+                [guest_id]))).one()[1]
+            candidate = (await connection.execute(overlap_candidate_query(
+                listing_id, end_date))).first()
+            if not booking_allowed(owner_id, guest_id, price, balance,
+                                   candidate, start_date):
+                await connection.rollback()
+                return False
+            booking_id = (await connection.execute(sa.insert(Booking).values(
+                user_id=guest_id, listing_id=listing_id,
+                start_date=start_date, end_date=end_date))
+            ).inserted_primary_key[0]
+            now = time.time()
+            await connection.execute(sa.insert(LedgerEntry), [
+                {'user_id': guest_id, 'amount': -price,
+                 'booking_id': booking_id, 'created_at': now},
+                {'user_id': owner_id, 'amount': price,
+                 'booking_id': booking_id, 'created_at': now}])
+            await connection.commit()
+        except OperationalError:
+            # e.g. the write lock could not be taken in time
+            await connection.rollback()
+            return False
+    return True
+
+
+async def booking_creation_post():
+    booked = await create_booking_async(
+        request.form.get('user_email'), request.form.get('listing_title'),
+        request.form.get('start_date'), request.form.get('end_date'))
+    if not booked:
+        return render_template('create_booking.html',
+                               message="Booking Creation Failed.")
+    note_write()
+    return render_template('create_booking.html', message="Booking Created.")
@@ -0,0 +1,281 @@
+import secrets
+import threading
+import time
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+from qbnb.models import db, BookingRequest, Listing, User
+from qbnb.models import parse_booking_dates, lock_for_write, stage_booking
+
+'''
+This file implements queued bookings, enabled with BOOKING_QUEUE (env
+booking_queue=1).
+
+Instead of booking inside the request, /create_booking stores a
+booking_request row and answers with a token at once. A single writer
+takes the pending requests in the order they were queued and decides
+a batch of up to BOOKING_QUEUE_BATCH of them in one locked transaction,
+applying the same rules as create_booking(). So a burst on one listing
+costs one lock and one commit per batch instead of one per request,
+and the first guest to ask wins the dates. Queueing is batched too:
+concurrent requests of a process are inserted together, in the order
+they arrived, by whichever of them gets there first. Clients poll
+/booking_status/<token>, optionally with ?wait=<seconds> to hold the
+request until the booking is decided. A waiting request looks at the
+table less and less often, and is woken at once if the writer runs in
+its process. A request the writer cannot decide because it raises is
+logged and marked failed, and the writer carries on with the others.
+
+The queue is a table, so every server process can add to it and the
+writer can run anywhere: `python -m qbnb serve` starts it in a process
+of its own, `python -m qbnb booking-writer` runs it alone, and the
+development server runs it in a thread.
+'''
+
+PENDING = 'pending'
+BOOKED = 'booked'
+REJECTED = 'rejected'
+# the writer could not decide it, see _fail_poisoned()
+FAILED = 'failed'
+# most seconds between two looks at a pending booking
+MAX_POLL_INTERVAL = 0.2
+
+
+class _BookingQueue:
+    '''
+    The state a process keeps for the queue. insert() writes the rows
+    of concurrent callers in one transaction: the first caller to find
+    no insert running writes every row waiting, the others wait for
+    it. wait() returns after timeout seconds, or sooner when a writer
+    thread of this process commits a batch.
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = False
+        self.decided = threading.Condition()
+
+    def wait(self, timeout):
+        with self.decided:
+            self.decided.wait(timeout)
+
+    def notify(self):
+        with self.decided:
+            self.decided.notify_all()
+
+    def insert(self, row):
+        entry = {'row': row, 'done': False, 'ok': False}
+        with self.condition:
+            self.waiting.append(entry)
+            while self.running and not entry['done']:
+                self.condition.wait()
+            if entry['done']:
+                return entry['ok']
+            self.running = True
+            batch, self.waiting = self.waiting, []
+        ok = False
+        try:
+            db.session.execute(BookingRequest.__table__.insert(),
+                               [waiting['row'] for waiting in batch])
+            db.session.commit()
+            ok = True
+        except OperationalError:
+            db.session.rollback()
+        finally:
+            with self.condition:
+                for waiting in batch:
+                    waiting['done'] = True
+                    waiting['ok'] = ok
+                self.running = False
+                self.condition.notify_all()
+        return ok
+
+
+def _queue():
+    return current_app.extensions.setdefault('qbnb_booking_queue',
+                                             _BookingQueue())
+
+
+def enqueue_booking(user_email, listing_title, start_date, end_date):
+    '''
+    Queue a booking for the writer
+      Parameters:
+        user_email (string):    email of the guest
+        listing_title (string): title of the listing to book
+        start_date (string):    first night, formatted YYYY-MM-DD
+        end_date (string):      check-out day, formatted YYYY-MM-DD
+      Returns:
+        The token to poll the booking with, or None if the dates are
+        invalid, which needs no queueing to decide, or the request
+        could not be stored
+    '''
+    dates = parse_booking_dates(start_date, end_date)
+    if dates is None:
+        return None
+    token = secrets.token_hex(16)
+    if not _queue().insert({
+            'token': token, 'user_email': user_email or '',
+            'listing_title': listing_title or '', 'start_date': dates[0],
+            'end_date': dates[1], 'status': PENDING,
+            'queued_at': time.time()}):
+        return None
+    return token
+
+
+def get_booking_request(token, wait=0, interval=0.02):
+    '''
+    Look up a queued booking
+      Parameters:
+        token (string): as returned by enqueue_booking()
+        wait (float): seconds to wait for a pending booking to be
+            decided
+        interval (float): seconds before the second look while
+            waiting, doubled after every look up to MAX_POLL_INTERVAL
+      Returns:
+        The BookingRequest, pending if it was not decided in time, or
+        None for an unknown token
+    '''
+    deadline = time.monotonic() + wait
+    while True:
+        # the status alone while waiting, a look costs one index seek
+        status = db.session.execute(
+            db.select(BookingRequest.status).filter_by(token=token)
+        ).scalar()
+        remaining = deadline - time.monotonic()
+        if status != PENDING or remaining <= 0:
+            break
+        # end the read transaction, or the next look would not see
+        # the writer's commit
+        db.session.rollback()
+        _queue().wait(min(interval, remaining))
+        interval = min(interval * 2, MAX_POLL_INTERVAL)
+    if status is None:
+        return None
+    return BookingRequest.query.filter_by(token=token).first()
+
+
+def process_booking_requests(batch_size=100):
+    '''
+    Decide the oldest pending bookings, in queue order, in a single
+    transaction
+      Parameters:
+        batch_size (integer): most requests decided
+      Returns:
+        The number of requests decided
+    '''
+    # an empty queue should not cost the write lock
+    if BookingRequest.query.filter_by(status=PENDING).first() is None:
+        db.session.rollback()
+        return 0
+    try:
+        lock_for_write()
+        requests = BookingRequest.query.filter_by(status=PENDING).order_by(
+            BookingRequest.id).limit(batch_size).all()
+        # the guests and listings of the whole batch in two queries; a
+        # burst is mostly about the same few listings. Locked in id
+        # order, guests first as in create_bookings(), so that two
+        # batches cannot deadlock
+        guests = {user.email: user for user in User.query.filter(
+            User.email.in_({r.user_email for r in requests})
+        ).order_by(User.id).with_for_update()}
+        listings = {listing.title: listing for listing in Listing.query.filter(
+            Listing.title.in_({r.listing_title for r in requests})
+        ).order_by(Listing.id).with_for_update()}
+        decided = []
+        for request in requests:
+            listing = listings.get(request.listing_title)
+            guest = guests.get(request.user_email)
+            booking = None
+            if listing is not None and guest is not None:
+                # the bookings and balances changed by earlier requests
+                # of the batch are seen through the session
+                booking = stage_booking(listing, guest, request.start_date,
+                                        request.end_date)
+            decided.append((request, booking))
+        db.session.flush()
+        now = time.time()
+        for request, booking in decided:
+            request.status = REJECTED if booking is None else BOOKED
+            request.booking_id = booking.id if booking is not None else None
+            request.decided_at = now
+        db.session.commit()
+    except OperationalError:
+        # e.g. the write lock could not be taken in time, the batch is
+        # tried again
+        db.session.rollback()
+        return 0
+    return len(requests)
+
+
+def _fail_poisoned(batch_size):
+    '''
+    After a batch raised, decide its requests one at a time, marking
+    those that raise again as failed, so one bad request does not
+    hold up the queue
+      Returns:
+        The number of requests decided or failed
+    '''
+    done = 0
+    for _ in range(batch_size):
+        try:
+            decided = process_booking_requests(1)
+        except Exception:
+            db.session.rollback()
+            request = BookingRequest.query.filter_by(status=PENDING).order_by(
+                BookingRequest.id).first()
+            if request is None:
+                break
+            current_app.logger.exception(
+                'booking request %s failed', request.token)
+            request.status = FAILED
+            request.decided_at = time.time()
+            db.session.commit()
+            decided = 1
+        if not decided:
+            break
+        done += decided
+    return done
+
+
+def run_booking_writer(should_stop):
+    '''
+    Decide queued bookings until should_stop() returns True
+    '''
+    batch_size = current_app.config.get('BOOKING_QUEUE_BATCH', 100)
+    idle = current_app.config.get('BOOKING_QUEUE_IDLE', 0.02)
+    while not should_stop():
+        try:
+            try:
+                decided = process_booking_requests(batch_size)
+            except Exception:
+                current_app.logger.exception('booking batch failed')
+                db.session.rollback()
+                decided = _fail_poisoned(batch_size)
+        except Exception:
+            # e.g. the database is gone: nothing is decided, the writer
+            # keeps going and tries again
+            current_app.logger.exception('booking writer error')
+            decided = 0
+        db.session.remove()
+        if decided:
+            _queue().notify()
+        else:
+            time.sleep(idle)
+
+
+def start_booking_writer(app):
+    '''
+    Run the writer in a daemon thread of this process
+      Returns:
+        The thread and an Event that stops it when set
+    '''
+    stop = threading.Event()
+
+    def run():
+        with app.app_context():
+            run_booking_writer(stop.is_set)
+
+    thread = threading.Thread(target=run, name='booking-writer',
+                              daemon=True)
+    thread.start()
+    return thread, stop
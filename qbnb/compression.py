@@ -0,0 +1,77 @@
+import gzip
+from flask import current_app, request
+
+try:
+    # optional: pip install brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+This file compresses responses, with brotli when the module is
+installed and the client accepts it, otherwise with gzip.
+
+Responses of COMPRESS_MIN_SIZE bytes or more with a text mimetype are
+compressed, smaller ones would hardly shrink. Each encoding is a
+different representation, so a strong ETag gets a suffix naming the
+encoding (the ETag "abc" becomes "abc-gzip"). conditional_response()
+in qbnb/fragments.py matches a client's If-None-Match against every
+such variant and answers its 304 with the one the client sent.
+'''
+
+COMPRESSIBLE = ('text/html', 'text/plain', 'text/css', 'text/javascript',
+                'application/json', 'application/javascript')
+
+
+def encodings():
+    '''
+    The content codings this process can produce, preferred first
+    '''
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def etag_variants(etag):
+    '''
+    The ETag of a page and of its compressed representations
+    '''
+    return [etag] + ['{}-{}'.format(etag, coding) for coding in encodings()]
+
+
+def _compress(data, coding, config):
+    if coding == 'br':
+        return brotli.compress(data, quality=config.get(
+            'COMPRESS_BROTLI_QUALITY', 4))
+    return gzip.compress(data, compresslevel=config.get('COMPRESS_LEVEL', 6),
+                         mtime=0)
+
+
+def _compress_response(response):
+    config = current_app.config
+    if (response.status_code != 200 or response.direct_passthrough or
+            response.is_streamed or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESSIBLE):
+        return response
+    # the representation depends on the header whether or not it is
+    # compressed this time
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < config.get('COMPRESS_MIN_SIZE', 500):
+        return response
+    coding = next((coding for coding in encodings()
+                   if request.accept_encodings[coding]), None)
+    if coding is None:
+        return response
+    response.set_data(_compress(data, coding, config))
+    response.headers['Content-Encoding'] = coding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag('{}-{}'.format(etag, coding))
+    return response
+
+
+def init_compression(app):
+    '''
+    Compress the responses of the app
+    '''
+    app.after_request(_compress_response)
@@ -1,12 +1,49 @@
 import email
 import datetime
+import functools
 from flask import render_template, request, session, redirect
+from flask import make_response, url_for, Blueprint
+from flask import current_app, jsonify, Response
 from qbnb.models import login, User, Listing, register, create_listing
 from qbnb.models import update_listing, update_user, create_booking
-from qbnb.models import Booking
-
-
-from qbnb import app
+from qbnb.models import Booking, get_listings_page, get_user_bookings
+from qbnb.models import get_session_user, invalidate_cached_user
+from qbnb.models import search_listings, find_available_listings
+from qbnb.models import get_page_versions
+from qbnb.booking_queue import enqueue_booking, get_booking_request, BOOKED
+from qbnb.replicas import note_write
+from qbnb.metrics import export
+from qbnb.fragments import cached, cached_page, render_fragment
+from qbnb.fragments import page_etag, conditional_response
+
+
+# registered on the app by create_app()
+bp = Blueprint('qbnb', __name__)
+
+# number of listings shown per page on the home page feed
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# number of listings shown for a search
+MAX_SEARCH_RESULTS = 100
+# seconds /booking_status may hold a request waiting for the decision
+MAX_BOOKING_WAIT = 10
+
+
+def last_modified(listings):
+    '''
+    The Last-Modified date of a page of listings: the day the newest
+    of them changed, at midnight UTC, None for no listings
+    '''
+    days = [str(listing.last_modified_date)[:10] for listing in listings]
+    if not days:
+        return None
+    try:
+        day = datetime.datetime.strptime(max(days), '%Y-%m-%d')
+    except ValueError:
+        return None
+    # an owner may have dated a listing in the future
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return min(day.replace(tzinfo=datetime.timezone.utc), now)
 
 
 def authenticate(inner_function):
@@ -22,13 +59,15 @@ def authenticate(inner_function):
         pass
     """
 
+    @functools.wraps(inner_function)
     def wrapped_inner():
 
         # check did we store the key in the session
         if 'logged_in' in session:
             email = session['logged_in']
             try:
-                user = User.query.filter_by(email=email).one_or_none()
+                # served from the user cache on the common path
+                user = get_session_user(email)
                 if user:
                     # if the user exists, call the inner_function
                     # with user as parameter
@@ -43,12 +82,19 @@ def authenticate(inner_function):
     return wrapped_inner
 
 
-@app.route('/login', methods=['GET'])
+def _form_page(template, message):
+    # the forms only change with the templates
+    return conditional_response(
+        page_etag(template, message),
+        lambda: cached_page(template, (message,), message=message))
+
+
+@bp.route('/login', methods=['GET'])
 def login_get():
-    return render_template('login.html', message='Please login')
+    return _form_page('login.html', 'Please login')
 
 
-@app.route('/login', methods=['POST'])
+@bp.route('/login', methods=['POST'])
 def login_post():
     email = request.form.get('email')
     password = request.form.get('password')
@@ -71,7 +117,7 @@ def login_post():
         return render_template('login.html', message='login failed')
 
 
-@app.route('/')
+@bp.route('/')
 @authenticate
 def home(user):
     # authentication is done in the wrapper function
@@ -80,54 +126,129 @@ def home(user):
     # the login checking code all the time for other
     # front-end portals
 
-    # update this and replace with real listings once 
-    # create listing interface is implemented
-    listings = [
-        {'Title': 'Apartment 85',
-            'Description': "Exteremly garbage rent out place.",
-            'Price': 150,
-            'Date': "2022-01-01", 'Email': 'ownerman@gmail.com'},
-        {'Title': 'Apartment 68',
-            'Description': "A Appartment with a 1 table and a chair.",
-            'Price': 300, 'Date': "2022-02-01", 'Email': 'ownerman@gmail.com'},
-        {'Title': 'Apartment 100',
-            'Description': "Top tier apartment, coat hanger made of gold",
-            'Price': 1000, 'Date': "2022-03-01",
-            'Email': 'ownerman@gmail.com'},
-        {'Title': 'John Buckle House',
-            'Description': "This is just my house man, please buy.",
-            'Price': 500, 'Date': "2022-02-01",
-            'Email': 'johnbucklenickle@gmail.com'},
-        {'Title': 'Cardboard Box',
-            'Description': "It's next to the convenience store, convenient.",
-            'Price': 151, 'Date': "2022-01-01",
-            'Email': 'ineedatenantplease@gmail.com'},
-        {'Title': 'Worn Down House',
-            'Description': "Infested with squids. half-underwater.",
-            'Price': 500, 'Date': "2022-02-01",
-            'Email': 'pleasebymyplace@gmail.com'},
-    ]
-    bookings = [
-        {'Email': 'poorman@gmail.com', 'ListingTitle': 'Apartment 85',
-            'StartDate': '2022-01-01', 'EndDate': "2022-01-05"},
-        {'Email': 'poorman@gmail.com', 'ListingTitle': 'Cardboard Box',
-            'StartDate': '2022-01-05', 'EndDate': "2022-01-20"},
-        {'Email': 'johnwife@gmail.com', 'ListingTitle': 'John Bubkle House',
-            'StartDate': '2022-02-01', 'EndDate': "2022-03-04"},
-        {'Email': 'aquamanreal@gmail.com', 'ListingTitle': 'Worn Down House',
-            'StartDate': '2022-02-01', 'EndDate': "2022-03-02"},
-    ]
-    return render_template('index.html', user=user, listings=listings,
-                           bookings=bookings)
-
-
-@app.route('/register', methods=['GET'])
+    after, page_size = home_arguments()
+    # everything the page shows is named by these, so an unchanged
+    # page is answered without loading or rendering anything
+    etag, feed_key, bookings_key = home_keys(
+        user, after, page_size, get_page_versions(user.id))
+
+    def build():
+        # the feed is the same for every user
+        feed = cached(feed_key, lambda: feed_fragment(
+            *get_listings_page(after, page_size), page_size))
+        user_bookings = cached(bookings_key, lambda: bookings_fragment(
+            user, get_user_bookings(user.id)))
+        return home_response(user, feed, user_bookings)
+
+    return conditional_response(etag, build)
+
+
+# the parts of the home page shared with the async view, see
+# qbnb/async_views.py
+
+def home_arguments():
+    page_size = request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int)
+    page_size = min(max(page_size, 1), MAX_PAGE_SIZE)
+    return request.args.get('after') or None, page_size
+
+
+def home_keys(user, after, page_size, versions):
+    '''
+    The ETag of a home page and the cache keys of its fragments, for
+    the (listings, bookings) versions from get_page_versions()
+    '''
+    listings_version, bookings_version = versions
+    etag = page_etag('index.html', user.id, user.username, user.email,
+                     after, page_size, listings_version, bookings_version)
+    return (etag,
+            ('listing_feed.html', after, page_size, listings_version),
+            ('user_bookings.html', user.id, user.email, bookings_version,
+             listings_version))
+
+
+def feed_fragment(listings, next_cursor, page_size):
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for('qbnb.home', after=next_cursor,
+                           page_size=page_size)
+    return (render_fragment('listing_feed.html', listings=listings,
+                            next_url=next_url), next_url,
+            last_modified(listings))
+
+
+def bookings_fragment(user, bookings):
+    return render_fragment('user_bookings.html', bookings=bookings,
+                           user_email=user.email)
+
+
+def home_response(user, feed, user_bookings):
+    listing_feed, next_url, modified = feed
+    response = make_response(render_template(
+        'index.html', user=user, listing_feed=listing_feed,
+        user_bookings=user_bookings))
+    if next_url is not None:
+        # lets API clients follow the feed without parsing the page
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    response.last_modified = modified
+    return response
+
+
+@bp.route('/search')
+@authenticate
+def search(user):
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), MAX_SEARCH_RESULTS)
+    listings = search_listings(query, limit)
+    response = make_response(render_template(
+        'search.html', user=user, query=query, listings=listings))
+    response.last_modified = last_modified(listings)
+    return response
+
+
+@bp.route('/availability')
+@authenticate
+def availability(user):
+    start_date = request.args.get('start_date', '')
+    end_date = request.args.get('end_date', '')
+    min_price = request.args.get('min_price', type=int)
+    max_price = request.args.get('max_price', type=int)
+    page_size = request.args.get('page_size', DEFAULT_PAGE_SIZE, type=int)
+    page_size = min(max(page_size, 1), MAX_PAGE_SIZE)
+    # the cursor is the price and id of the last listing shown
+    try:
+        price, listing_id = request.args.get('after', '').split('-')
+        after = (int(price), int(listing_id))
+    except ValueError:
+        after = None
+    listings, next_cursor = [], None
+    if start_date and end_date:
+        listings, next_cursor = find_available_listings(
+            start_date, end_date, min_price, max_price, after, page_size)
+
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for(
+            '.availability', start_date=start_date, end_date=end_date,
+            min_price=min_price, max_price=max_price,
+            after='{}-{}'.format(*next_cursor), page_size=page_size)
+    response = make_response(render_template(
+        'availability.html', user=user, start_date=start_date,
+        end_date=end_date, min_price=min_price, max_price=max_price,
+        listings=listings, next_url=next_url))
+    response.last_modified = last_modified(listings)
+    if next_url is not None:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+@bp.route('/register', methods=['GET'])
 def register_get():
     # templates are stored in the templates folder
-    return render_template('register.html', message='')
+    return _form_page('register.html', '')
 
 
-@app.route('/register', methods=['POST'])
+@bp.route('/register', methods=['POST'])
 def register_post():
     email = request.form.get('email')
     name = request.form.get('name')
@@ -150,20 +271,20 @@ def register_post():
         return redirect('/login')
 
 
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     if 'logged_in' in session:
-        session.pop('logged_in', None)
+        invalidate_cached_user(session.pop('logged_in', None))
     return redirect('/')
 
 
-@app.route('/create_listing', methods=['GET'])
+@bp.route('/create_listing', methods=['GET'])
 def listing_creation_get():
     # templates are stored in the templates folder
-    return render_template('create_listing.html', message='Create Listing')
+    return _form_page('create_listing.html', 'Create Listing')
 
 
-@app.route('/create_listing', methods=['POST'])
+@bp.route('/create_listing', methods=['POST'])
 def listing_creation_post():
     title = request.form.get('title')
     description = request.form.get('description')
@@ -195,13 +316,13 @@ def listing_creation_post():
                                message="Listing Created.")
  
 
-@app.route('/update_listing', methods=['GET'])
+@bp.route('/update_listing', methods=['GET'])
 def listing_update_get():
     # templates are stored in the templates folder
-    return render_template('update_listing.html', message='Update Listing')
+    return _form_page('update_listing.html', 'Update Listing')
 
 
-@app.route('/update_listing', methods=['POST'])
+@bp.route('/update_listing', methods=['POST'])
 def listing_update_post():
     email = request.form.get('email')
     title = request.form.get('title')
@@ -232,13 +353,13 @@ def listing_update_post():
                                message="Listing Updated.")
 
 
-@app.route('/update_profile', methods=['GET'])
+@bp.route('/update_profile', methods=['GET'])
 def profile_update_get():
     # templates are stored in the templates folder
-    return render_template('update_profile.html', message='Update Profile')
+    return _form_page('update_profile.html', 'Update Profile')
 
 
-@app.route('/update_profile', methods=['POST'])
+@bp.route('/update_profile', methods=['POST'])
 def profile_update_post():
     old_email = request.form.get('old_email')
     new_email = request.form.get('new_email')
@@ -259,19 +380,30 @@ def profile_update_post():
                                message="User Profile update has failed.")
 
 
-@app.route('/create_booking', methods=['GET'])
+@bp.route('/create_booking', methods=['GET'])
 def booking_creation_get():
     # templates are stored in the templates folder
-    return render_template('create_booking.html', message='Create Booking')
+    return _form_page('create_booking.html', 'Create Booking')
 
 
-@app.route('/create_booking', methods=['POST'])
+@bp.route('/create_booking', methods=['POST'])
 def booking_creation_post():
     user_email = request.form.get('user_email')
     listing_title = request.form.get('listing_title')
     start_date = request.form.get('start_date')
     end_date = request.form.get('end_date')
     error_message = None
+
+    if current_app.config.get('BOOKING_QUEUE'):
+        # decided by the queue writer, see qbnb/booking_queue.py
+        token = enqueue_booking(user_email, listing_title,
+                                start_date, end_date)
+        if token is None:
+            return render_template('create_booking.html',
+                                   message="Booking Creation Failed.")
+        return render_template(
+            'create_booking.html', message="Booking Queued.",
+            status_url=url_for('.booking_status', token=token)), 202
         
     # use backend api to create the booking instance
     success = create_booking(user_email, listing_title, 
@@ -285,4 +417,24 @@ def booking_creation_post():
         return render_template('create_booking.html', message=error_message)
     else:
         return render_template('create_booking.html', 
-                               message="Booking Created.")
\ No newline at end of file
+                               message="Booking Created.")
+
+
+@bp.route('/booking_status/<token>')
+def booking_status(token):
+    wait = request.args.get('wait', 0, type=float)
+    wait = min(max(wait, 0), MAX_BOOKING_WAIT)
+    queued = get_booking_request(token, wait)
+    if queued is None:
+        return jsonify(error='unknown booking'), 404
+    if queued.status == BOOKED:
+        # the guest's next pages should show the booking
+        note_write()
+    return jsonify(token=token, status=queued.status,
+                   booking_id=queued.booking_id)
+
+
+@bp.route('/metrics')
+def metrics():
+    # Prometheus text exposition format
+    return Response(export(), mimetype='text/plain; version=0.0.4')
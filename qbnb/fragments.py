@@ -0,0 +1,155 @@
+import hashlib
+from flask import current_app, request, render_template
+from markupsafe import Markup
+from qbnb.cache import TTLCache
+from qbnb.compression import etag_variants
+
+'''
+This file caches rendered template fragments and answers repeat views
+of unchanged pages with 304 Not Modified.
+
+A fragment is cached under its template, the arguments it was
+rendered for and the versions of the data it shows (see
+get_page_versions()): listing writes bump the listings counter in the
+same transaction, and a guest's bookings are versioned by the id of
+their newest one. A write thus changes the keys instead of
+invalidating entries, so every process sees it on its next request,
+and the entries it made stale fall out of the LRU, which keeps
+FRAGMENT_CACHE_SIZE of them per process.
+
+Pages are tagged with a strong ETag made of the same keys and a
+digest of the templates: the same tag, the same bytes. A browser
+sending it back in If-None-Match gets a 304 before anything is loaded
+or rendered, and pages are marked to be revalidated on every view so
+that it does. Listing pages also carry a Last-Modified date, but
+If-Modified-Since is not answered with a 304: last_modified_date is a
+day, set by the owner, that bookings do not change.
+'''
+
+
+def _fragment_cache():
+    cache = current_app.extensions.get('qbnb_fragment_cache')
+    if cache is None:
+        cache = TTLCache(current_app.config.get('FRAGMENT_CACHE_SIZE', 256))
+        current_app.extensions['qbnb_fragment_cache'] = cache
+    return cache
+
+
+def _templates_digest():
+    # a deploy that changes a template changes every ETag
+    digest = current_app.extensions.get('qbnb_templates_digest')
+    if digest is None:
+        env = current_app.jinja_env
+        sha = hashlib.sha1()
+        for name in sorted(env.list_templates()):
+            sha.update(name.encode())
+            sha.update(env.loader.get_source(env, name)[0].encode())
+        digest = current_app.extensions['qbnb_templates_digest'] = \
+            sha.hexdigest()
+    return digest
+
+
+def cached(key, build):
+    '''
+    Build a value once per key
+      Parameters:
+        key (tuple): the template, arguments and data versions the
+            value depends on
+        build (function): returns the value, called when it is not
+            cached
+      Returns:
+        The cached or built value
+    '''
+    cache = _fragment_cache()
+    value = cache.get(key)
+    if value is None:
+        # built from the same database as the versions in the key
+        # were read from: a request's replica reads all go to one
+        # replica, see qbnb/replicas.py
+        value = build()
+        cache.set(key, value)
+    return value
+
+
+async def cached_async(key, build):
+    '''
+    cached() for a coroutine function build, see qbnb/async_views.py
+    '''
+    cache = _fragment_cache()
+    value = cache.get(key)
+    if value is None:
+        value = await build()
+        cache.set(key, value)
+    return value
+
+
+def render_fragment(template, **context):
+    '''
+    Render a template meant to be inserted into a page
+    '''
+    return Markup(render_template(template, **context))
+
+
+def cached_page(template, key, **context):
+    '''
+    Render a whole page once per key, for pages whose context is
+    entirely made of the key
+    '''
+    return cached((template,) + key,
+                  lambda: render_template(template, **context))
+
+
+def page_etag(*parts):
+    '''
+    The ETag of a page built from parts: the templates, arguments and
+    data versions it depends on
+    '''
+    return hashlib.sha1(repr((_templates_digest(),) + parts).encode()
+                        ).hexdigest()
+
+
+def not_modified(etag):
+    '''
+    The 304 response if the client already has the page tagged etag,
+    otherwise None
+    '''
+    # the client may hold a compressed representation, see
+    # qbnb/compression.py
+    held = next((tag for tag in etag_variants(etag)
+                 if request.if_none_match.contains(tag)), None)
+    if held is None:
+        return None
+    response = current_app.response_class(status=304)
+    response.vary.add('Accept-Encoding')
+    return tagged(response, held)
+
+
+def tagged(response, etag):
+    '''
+    Tag a response with etag, to be revalidated on every view
+    '''
+    response.set_etag(etag)
+    # kept by the browser only, which asks again on every view
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional_response(etag, build):
+    '''
+    Answer 304 if the client already has the page tagged etag,
+    otherwise with the response build() returns, tagged
+    '''
+    response = not_modified(etag)
+    if response is None:
+        response = tagged(current_app.make_response(build()), etag)
+    return response
+
+
+def fragment_cache_stats():
+    '''
+    Report the fragment cache counters for monitoring
+      Returns:
+        A dict with the cache size, maxsize, hits and misses
+    '''
+    return _fragment_cache().stats()
@@ -0,0 +1,141 @@
+import time
+import sqlalchemy as sa
+from flask import current_app
+from qbnb.models import db, User, LedgerEntry, BalanceSnapshot
+
+'''
+This file takes the balance snapshots and checks the ledger.
+
+Balances are not updated in place: a booking appends a debit of the
+guest and a credit of the owner to the ledger_entry table, and a
+balance is the user's snapshot (or without one the opening balance in
+the user table) plus the entries after it, see get_balance().
+Snapshots keep that sum short for users with many entries, such as
+popular hosts. take_snapshots() writes them, every
+BALANCE_SNAPSHOT_INTERVAL seconds in `python -m qbnb serve`, or once
+with:  python -m qbnb snapshot-balances
+
+Entries get their ids when inserted but only show once their
+transaction commits, so on a server database an entry may show after
+one with a higher id. A snapshot hence stops at the entries older than
+SNAPSHOT_SETTLE seconds, by which time every booking transaction has
+ended.
+
+reconcile_ledger() checks the ledger, the snapshots and the balances:
+python -m qbnb reconcile-ledger
+'''
+
+SNAPSHOT_SETTLE = 60
+
+
+def _balances_upto(user_ids, upto):
+    # each user's snapshot or opening balance plus their entries after
+    # it, up to and including entry upto
+    after = sa.func.coalesce(BalanceSnapshot.entry_id, 0)
+    delta = sa.select(sa.func.coalesce(sa.func.sum(LedgerEntry.amount), 0)
+                      ).where(LedgerEntry.user_id == User.id,
+                              LedgerEntry.id > after,
+                              LedgerEntry.id <= upto).scalar_subquery()
+    return db.session.execute(sa.select(
+        User.id, sa.func.coalesce(BalanceSnapshot.balance, User.balance) +
+        delta
+    ).outerjoin(BalanceSnapshot, BalanceSnapshot.user_id == User.id).where(
+        User.id.in_(user_ids))).all()
+
+
+def _write_snapshots(balances, upto):
+    now = time.time()
+    user_ids = [user_id for user_id, _ in balances]
+    db.session.execute(BalanceSnapshot.__table__.delete().where(
+        BalanceSnapshot.user_id.in_(user_ids)))
+    db.session.execute(BalanceSnapshot.__table__.insert(), [
+        {'user_id': user_id, 'entry_id': upto, 'balance': balance,
+         'taken_at': now} for user_id, balance in balances])
+
+
+def take_snapshots(batch_size=1000, settle=SNAPSHOT_SETTLE):
+    '''
+    Snapshot the balances of the users with ledger entries since the
+    last run
+      Parameters:
+        batch_size (integer): users snapshotted per transaction
+        settle (float): seconds an entry must be old to be included
+      Returns:
+        The number of users snapshotted
+    '''
+    upto = db.session.execute(sa.select(sa.func.max(LedgerEntry.id)).where(
+        LedgerEntry.created_at <= time.time() - settle)).scalar()
+    # every run snapshots everyone with entries up to its upto, so the
+    # entries after the newest snapshot are the ones to cover
+    last = db.session.execute(sa.select(
+        sa.func.coalesce(sa.func.max(BalanceSnapshot.entry_id), 0))).scalar()
+    if upto is None or upto <= last:
+        db.session.rollback()
+        return 0
+    user_ids = db.session.execute(sa.select(LedgerEntry.user_id).where(
+        LedgerEntry.id > last, LedgerEntry.id <= upto).distinct()
+    ).scalars().all()
+    for start in range(0, len(user_ids), batch_size):
+        balances = _balances_upto(user_ids[start:start + batch_size], upto)
+        _write_snapshots(balances, upto)
+        db.session.commit()
+    return len(user_ids)
+
+
+def run_snapshots(should_stop):
+    '''
+    Take snapshots every BALANCE_SNAPSHOT_INTERVAL seconds until
+    should_stop() returns True
+    '''
+    interval = current_app.config.get('BALANCE_SNAPSHOT_INTERVAL', 300)
+    next_run = time.monotonic()
+    while not should_stop():
+        if time.monotonic() >= next_run:
+            take_snapshots()
+            db.session.remove()
+            next_run = time.monotonic() + interval
+        time.sleep(min(1.0, interval))
+
+
+def reconcile_ledger():
+    '''
+    Check the ledger: the entries of every booking must cancel out,
+    every snapshot must match the entries it covers (the wrong ones
+    are rewritten from the ledger) and no balance may be negative
+      Returns:
+        A dict counting the problems found
+    '''
+    report = {'unbalanced bookings': 0, 'snapshots rewritten': 0,
+              'negative balances': 0}
+
+    # a booking moves its price from the guest to the owner
+    report['unbalanced bookings'] = len(db.session.execute(
+        sa.select(LedgerEntry.booking_id).where(
+            LedgerEntry.booking_id.isnot(None)
+        ).group_by(LedgerEntry.booking_id).having(sa.or_(
+            sa.func.sum(LedgerEntry.amount) != 0,
+            sa.func.count() != 2))).all())
+
+    covered = sa.select(sa.func.coalesce(sa.func.sum(LedgerEntry.amount), 0)
+                        ).where(LedgerEntry.user_id == BalanceSnapshot.user_id,
+                                LedgerEntry.id <= BalanceSnapshot.entry_id
+                                ).scalar_subquery()
+    wrong = db.session.execute(sa.select(
+        BalanceSnapshot.user_id, BalanceSnapshot.entry_id,
+        User.balance + covered
+    ).join(User, User.id == BalanceSnapshot.user_id).where(
+        BalanceSnapshot.balance != User.balance + covered)).all()
+    for user_id, entry_id, balance in wrong:
+        _write_snapshots([(user_id, balance)], entry_id)
+    report['snapshots rewritten'] = len(wrong)
+    db.session.commit()
+
+    totals = sa.select(LedgerEntry.user_id,
+                       sa.func.sum(LedgerEntry.amount).label('total')
+                       ).group_by(LedgerEntry.user_id).subquery()
+    report['negative balances'] = db.session.execute(
+        sa.select(sa.func.count()).select_from(User).outerjoin(
+            totals, totals.c.user_id == User.id
+        ).where(User.balance + sa.func.coalesce(totals.c.total, 0) < 0)
+    ).scalar()
+    return report
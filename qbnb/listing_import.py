@@ -0,0 +1,148 @@
+import csv
+import json
+import itertools
+from qbnb.models import db, User, Listing
+from qbnb.models import bump_data_version, LISTINGS_VERSION
+from qbnb.validation import validate_listing
+from qbnb.search import index_listing
+
+'''
+This file imports listings in bulk from CSV or JSON Lines files.
+
+Rows are streamed from the file and handled a chunk at a time: the
+R4-1 to R4-6 rules run on every row, then owners (R4-7) and taken
+titles (R4-8) are resolved with one IN query each for the whole
+chunk, and the accepted rows are written with one executemany and one
+commit, together with their search index entries. Only the current
+chunk is held in memory, so the file can be any size. Titles imported
+by earlier chunks are already committed, so the next chunk's title
+query sees them.
+
+Each row needs the fields title, description, price,
+last_modified_date and owner_email.
+
+Run it with:  python -m qbnb import-listings FILE [--chunk-size N]
+'''
+
+FIELDS = ('title', 'description', 'price', 'last_modified_date',
+          'owner_email')
+# the fields checked as text, the price may be a number
+TEXT_FIELDS = ('title', 'description', 'last_modified_date', 'owner_email')
+
+
+class UnreadableRow:
+    '''
+    A line of the file that is not a row, rejected by import_listings()
+    with its reason
+    '''
+
+    def __init__(self, reason):
+        self.reason = reason
+
+
+def read_listings(path, file_format=None):
+    '''
+    Stream listing rows from a file
+      Parameters:
+        path (string): a .csv file with a header row, or a .jsonl file
+            with one JSON object per line
+        file_format (string): 'csv' or 'jsonl', guessed from the file
+            extension if None
+      Returns:
+        A generator of dicts, one per row, and of UnreadableRow for
+        the lines of a .jsonl file that are not valid JSON
+    '''
+    if file_format is None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    with open(path, newline='', encoding='utf-8') as source:
+        if file_format == 'csv':
+            yield from csv.DictReader(source)
+        else:
+            for number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield UnreadableRow('invalid JSON on line {}'.format(
+                        number))
+
+
+def _check_row(row):
+    '''
+    Returns the row's insert values and None, or None and the reason
+    the row was rejected
+    '''
+    if isinstance(row, UnreadableRow):
+        return None, row.reason
+    if not isinstance(row, dict) or any(row.get(f) is None for f in FIELDS):
+        return None, 'missing field'
+    # JSON fields can be numbers, lists or objects
+    if not all(isinstance(row[f], str) for f in TEXT_FIELDS):
+        return None, 'invalid field'
+    try:
+        price = int(row['price'])
+    except (TypeError, ValueError):
+        return None, 'invalid price'
+    reason = validate_listing(row['title'], row['description'], price,
+                              row['last_modified_date'])
+    if reason is not None:
+        return None, reason
+    return {'title': row['title'], 'description': row['description'],
+            'price': price, 'last_modified_date': row['last_modified_date'],
+            'owner_email': row['owner_email']}, None
+
+
+def import_listings(rows, chunk_size=500):
+    '''
+    Create listings in bulk with the same rules as create_listing
+      Parameters:
+        rows (iterable): dicts with the listing fields, as from
+            read_listings()
+        chunk_size (integer): rows checked and written per transaction
+      Returns:
+        A list of (index, reason) pairs for the rows that were
+        rejected, index being the position in rows
+    '''
+    rejected = []
+    rows = iter(rows)
+    for offset in itertools.count(0, chunk_size):
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return rejected
+
+        checked = []
+        for index, row in enumerate(chunk, offset):
+            values, reason = _check_row(row)
+            if values is None:
+                rejected.append((index, reason))
+            else:
+                checked.append((index, values))
+
+        # R4-7 and R4-8 for the whole chunk in two queries
+        owners = dict(db.session.query(User.email, User.id).filter(
+            User.email.in_({v['owner_email'] for _, v in checked})))
+        taken = {title for (title,) in db.session.query(
+            Listing.title).filter(
+                Listing.title.in_({v['title'] for _, v in checked}))}
+
+        accepted = []
+        for index, values in checked:
+            owner_id = owners.get(values.pop('owner_email'))
+            if owner_id is None:
+                rejected.append((index, 'owner does not exist'))
+            elif values['title'] in taken:
+                rejected.append((index, 'title already used'))
+            else:
+                taken.add(values['title'])
+                values['owner_id'] = owner_id
+                accepted.append(values)
+        if accepted:
+            db.session.execute(Listing.__table__.insert(), accepted)
+            # the ids were assigned by the insert
+            for listing_id, title, description in db.session.query(
+                    Listing.id, Listing.title, Listing.description).filter(
+                        Listing.title.in_([v['title'] for v in accepted])):
+                index_listing(db.session, listing_id, title, description)
+            bump_data_version(LISTINGS_VERSION)
+        db.session.commit()
@@ -0,0 +1,424 @@
+import glob
+import json
+import os
+import threading
+import time
+from flask import current_app, g, request, has_request_context
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+from qbnb.models import db, user_cache_stats
+from qbnb.fragments import fragment_cache_stats
+from qbnb.pool import pool_stats
+
+'''
+This file instruments the application and exports the numbers in the
+Prometheus text format at /metrics:
+
+    qbnb_requests_total                   requests per route, method
+                                          and status
+    qbnb_request_duration_seconds         time to build the response
+    qbnb_request_queries                  SQL statements run, per
+                                          request: a jump here is an
+                                          N+1 query
+    qbnb_request_db_duration_seconds      time spent in them
+    qbnb_template_render_duration_seconds render_template() time, per
+                                          template
+
+The four after the first are histograms; these are labelled by route
+(the URL rule, so /update_listing?x=1 and /update_listing count
+together). A request that raises is counted as a 500.
+
+The user and fragment caches (user_cache_stats(), fragment_cache_stats())
+and the connection pools (pool_stats(), per engine) are exported too:
+
+    qbnb_cache_hits_total, qbnb_cache_misses_total, qbnb_cache_entries
+    qbnb_db_pool_checkouts_total, qbnb_db_pool_wait_seconds_total,
+    qbnb_db_pool_timeouts_total, qbnb_db_pool_connects_total,
+    qbnb_db_pool_invalidations_total, qbnb_db_pool_size,
+    qbnb_db_pool_checked_out, qbnb_db_pool_overflow
+
+Each process counts on its own. With several workers (python -m qbnb
+serve) every worker also writes its numbers to the file of its slot in
+METRICS_DIR, at most once a second, and /metrics adds up all the
+files, so it shows the whole server whichever worker answers. The
+worker that replaces an exited one takes over its slot and counts on
+from the numbers in the file, so the totals never go back and there
+are only ever as many files as workers.
+'''
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# seconds between two writes of a process's file to METRICS_DIR
+DUMP_INTERVAL = 1.0
+
+HISTOGRAMS = {
+    'qbnb_request_duration_seconds': (
+        DURATION_BUCKETS, 'Time to build the response, per route'),
+    'qbnb_request_queries': (
+        QUERY_BUCKETS, 'SQL statements run per request, per route'),
+    'qbnb_request_db_duration_seconds': (
+        DURATION_BUCKETS, 'Time spent running SQL per request, per route'),
+    'qbnb_template_render_duration_seconds': (
+        DURATION_BUCKETS, 'Time spent in render_template, per template'),
+}
+COUNTERS = {
+    'qbnb_requests_total': 'Requests handled, per route, method and status',
+    'qbnb_cache_hits_total': 'Cache hits, per cache',
+    'qbnb_cache_misses_total': 'Cache misses, per cache',
+    'qbnb_db_pool_checkouts_total': 'Connections checked out, per engine',
+    'qbnb_db_pool_wait_seconds_total':
+        'Time spent waiting for a connection, per engine',
+    'qbnb_db_pool_timeouts_total':
+        'Checkouts that timed out waiting, per engine',
+    'qbnb_db_pool_connects_total': 'Connections opened, per engine',
+    'qbnb_db_pool_invalidations_total':
+        'Connections found dead and replaced, per engine',
+}
+GAUGES = {
+    'qbnb_cache_entries': 'Entries held, per cache',
+    'qbnb_db_pool_size': 'Connections in the pool, per engine',
+    'qbnb_db_pool_checked_out': 'Connections in use, per engine',
+    'qbnb_db_pool_overflow': 'Connections over the pool size, per engine',
+}
+# counters read from the stats of the caches and pools, rather than
+# counted here: name -> key of the stats dict
+CACHE_COUNTERS = {'qbnb_cache_hits_total': 'hits',
+                  'qbnb_cache_misses_total': 'misses'}
+POOL_COUNTERS = {'qbnb_db_pool_checkouts_total': 'checkouts',
+                 'qbnb_db_pool_wait_seconds_total': 'wait_total',
+                 'qbnb_db_pool_timeouts_total': 'timeouts',
+                 'qbnb_db_pool_connects_total': 'connects',
+                 'qbnb_db_pool_invalidations_total': 'invalidations'}
+POOL_GAUGES = {'qbnb_db_pool_size': 'size',
+               'qbnb_db_pool_checked_out': 'checked_out',
+               'qbnb_db_pool_overflow': 'overflow'}
+SAMPLED_COUNTERS = set(CACHE_COUNTERS) | set(POOL_COUNTERS)
+
+
+class Registry:
+    '''
+    Thread-safe counters and histograms of one process, keyed by metric
+    name and label values
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., count above, sum]
+        self.histograms = {}
+        # counters and gauges read from elsewhere, see _sample(); the
+        # counters add to the numbers loaded from the worker's slot
+        self.samples = {}
+        self.sample_bases = {}
+        self.gauges = {}
+        self.dumped_at = 0.0
+
+    def increment(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][0]
+        key = (name, labels)
+        with self._lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(buckets) + 2)
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            values[index] += 1
+            values[-1] += value
+
+    def set_sample(self, name, labels, value):
+        with self._lock:
+            if name in SAMPLED_COUNTERS:
+                self.samples[name, labels] = value
+            else:
+                self.gauges[name, labels] = value
+
+    def state(self):
+        '''
+        The numbers as JSON-friendly lists, see render()
+        '''
+        with self._lock:
+            counters = dict(self.counters)
+            for key, value in self.sample_bases.items():
+                counters[key] = counters.get(key, 0) + value
+            for key, value in self.samples.items():
+                counters[key] = counters.get(key, 0) + value
+            return {
+                'counters': [[name, list(labels), value] for
+                             (name, labels), value in counters.items()],
+                'histograms': [[name, list(labels), list(values)] for
+                               (name, labels), values in
+                               self.histograms.items()],
+                'gauges': [[name, list(labels), value] for
+                           (name, labels), value in self.gauges.items()]}
+
+    def load(self, state):
+        '''
+        Count on from a state() of the process this one replaces
+        '''
+        with self._lock:
+            for name, labels, value in state['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                if name in SAMPLED_COUNTERS:
+                    self.sample_bases[key] = value
+                else:
+                    self.counters[key] = value
+            for name, labels, values in state['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.histograms[key] = list(values)
+
+
+def _registry():
+    registry = current_app.extensions.get('qbnb_metrics')
+    if registry is None:
+        registry = current_app.extensions.setdefault('qbnb_metrics',
+                                                     Registry())
+    return registry
+
+
+def _label_text(labels):
+    return ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in labels)
+
+
+def render(states):
+    '''
+    The Prometheus text format of one or more Registry.state()s, added
+    up
+    '''
+    counters = {}
+    histograms = {}
+    gauges = {}
+    for state in states:
+        for name, labels, value in state.get('gauges', ()):
+            key = (name, tuple(tuple(label) for label in labels))
+            gauges[key] = gauges.get(key, 0) + value
+        for name, labels, value in state['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in state['histograms']:
+            key = (name, tuple(tuple(label) for label in labels))
+            total = histograms.setdefault(key, [0] * len(values))
+            for index, value in enumerate(values):
+                total[index] += value
+
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append('{}{{{}}} {}'.format(name, _label_text(labels),
+                                                  value))
+    for name, help_text in GAUGES.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} gauge'.format(name))
+        for (metric, labels), value in sorted(gauges.items()):
+            if metric == name:
+                lines.append('{}{{{}}} {}'.format(name, _label_text(labels),
+                                                  value))
+    for name, (buckets, help_text) in HISTOGRAMS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    name, _label_text(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(
+                name, _label_text(labels), values[-1]))
+            lines.append('{}_count{{{}}} {}'.format(
+                name, _label_text(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def _path(directory):
+    # the worker's slot, see set_worker_slot(), or the process
+    slot = current_app.extensions.get('qbnb_metrics_slot')
+    if slot is None:
+        return os.path.join(directory, '{}.json'.format(os.getpid()))
+    return os.path.join(directory, 'worker-{}.json'.format(slot))
+
+
+def set_worker_slot(app, slot):
+    '''
+    Make this process the worker of the slot: it counts on from the
+    numbers its exited predecessor left in METRICS_DIR, and writes
+    them back to the same file
+    '''
+    directory = app.config.get('METRICS_DIR')
+    with app.app_context():
+        app.extensions['qbnb_metrics_slot'] = slot
+        # the parent counts nothing, start from the slot's numbers only
+        registry = app.extensions['qbnb_metrics'] = Registry()
+        if not directory:
+            return
+        try:
+            with open(_path(directory)) as file:
+                registry.load(json.load(file))
+        except FileNotFoundError:
+            pass
+
+
+def flush_metrics(app):
+    '''
+    Write this process's numbers to METRICS_DIR now, e.g. before it
+    exits, rather than waiting for the next request
+    '''
+    directory = app.config.get('METRICS_DIR')
+    if directory:
+        with app.app_context():
+            _dump(_registry(), directory)
+
+
+def _sample(registry):
+    # the counters the caches and pools keep themselves
+    for cache, stats in (('user', user_cache_stats()),
+                         ('fragment', fragment_cache_stats())):
+        labels = (('cache', cache),)
+        for name, key in CACHE_COUNTERS.items():
+            registry.set_sample(name, labels, stats[key])
+        registry.set_sample('qbnb_cache_entries', labels, stats['size'])
+    for bind, engine in db.engines.items():
+        stats = pool_stats(engine)
+        labels = (('engine', bind or 'default'),)
+        for name, key in list(POOL_COUNTERS.items()) + list(
+                POOL_GAUGES.items()):
+            if key in stats:
+                registry.set_sample(name, labels, stats[key])
+
+
+def _dump(registry, directory):
+    registry.dumped_at = time.monotonic()
+    _sample(registry)
+    path = _path(directory)
+    with open(path + '.tmp', 'w') as file:
+        json.dump(registry.state(), file)
+    # readers never see a half written file
+    os.replace(path + '.tmp', path)
+
+
+def export():
+    '''
+    The metrics of this process, or with METRICS_DIR set of every
+    process of the server, in the Prometheus text format
+    '''
+    registry = _registry()
+    directory = current_app.config.get('METRICS_DIR')
+    if not directory:
+        _sample(registry)
+        return render([registry.state()])
+    _dump(registry, directory)
+    states = []
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        try:
+            with open(path) as file:
+                states.append(json.load(file))
+        except (OSError, ValueError):
+            # replaced while being read, its numbers come next time
+            continue
+    return render(states)
+
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+def _request_started():
+    g.qbnb_request_start = time.perf_counter()
+    g.qbnb_queries = 0
+    g.qbnb_db_time = 0.0
+
+
+def _record(status):
+    # once per request, by whichever of the two hooks below runs first
+    start = g.pop('qbnb_request_start', None)
+    if start is None:
+        return
+    registry = _registry()
+    route = (('route', _route()),)
+    registry.increment('qbnb_requests_total', route + (
+        ('method', request.method), ('status', status)))
+    registry.observe('qbnb_request_duration_seconds', route,
+                     time.perf_counter() - start)
+    registry.observe('qbnb_request_queries', route, g.qbnb_queries)
+    registry.observe('qbnb_request_db_duration_seconds', route,
+                     g.qbnb_db_time)
+    directory = current_app.config.get('METRICS_DIR')
+    if directory and time.monotonic() - registry.dumped_at > DUMP_INTERVAL:
+        _dump(registry, directory)
+
+
+def _request_finished(response):
+    _record(response.status_code)
+    return response
+
+
+def _request_torn_down(exception):
+    # after_request hooks are skipped when an exception propagates out
+    # of the request, e.g. with PROPAGATE_EXCEPTIONS or when another
+    # hook raises; the server answers those with a 500
+    _record(500)
+
+
+def _template_started(app, template, context, **extra):
+    g.setdefault('qbnb_template_starts', []).append(time.perf_counter())
+
+
+def _template_finished(app, template, context, **extra):
+    starts = g.get('qbnb_template_starts')
+    if starts:
+        _registry().observe('qbnb_template_render_duration_seconds',
+                            (('template', template.name),),
+                            time.perf_counter() - starts.pop())
+
+
+def _query_started(conn, cursor, statement, parameters, context,
+                   executemany):
+    # a statement that fails leaves this behind for the next to replace
+    conn.info['qbnb_query_start'] = time.perf_counter()
+
+
+def _query_finished(conn, cursor, statement, parameters, context,
+                    executemany):
+    start = conn.info.pop('qbnb_query_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    # queries outside of a request, e.g. of the CLI, are not counted
+    if has_request_context() and 'qbnb_queries' in g:
+        g.qbnb_queries += 1
+        g.qbnb_db_time += elapsed
+
+
+def watch_queries(engine):
+    '''
+    Count the statements an engine runs, and their time, against the
+    current request
+    '''
+    if not event.contains(engine, 'before_cursor_execute', _query_started):
+        event.listen(engine, 'before_cursor_execute', _query_started)
+        event.listen(engine, 'after_cursor_execute', _query_finished)
+
+
+def init_metrics(app):
+    '''
+    Time every request and render_template() call of the app
+    '''
+    app.before_request(_request_started)
+    app.after_request(_request_finished)
+    app.teardown_request(_request_torn_down)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
@@ -0,0 +1,196 @@
+import sqlalchemy as sa
+from qbnb.models import User, Listing, Booking, parse_booking_dates
+
+'''
+This file converts a database created with the original schema, where
+listings were keyed by (title, description, owner email) and bookings
+by (user email, listing title), to integer ids with foreign keys.
+
+The conversion runs in place: the old tables are renamed to *_old,
+the new tables are created, rows are copied across in batches (one
+transaction per batch, so neither memory nor lock time grows with the
+table size) and the old tables are dropped at the end. If it is
+interrupted, running it again restarts the copy from the *_old tables.
+
+The old code accepted booking dates that were not zero-padded, such
+as 2022-1-5, and bookings overlapping others of the same listing.
+The new code compares dates as strings and relies on the bookings of
+a listing being disjoint, so dates are padded on the way, and a
+booking that is invalid or overlaps one already copied is left out
+and counted in the report.
+
+Run it with:  python -m qbnb migrate [--batch-size N]
+'''
+
+
+def _table_names(connection):
+    return set(sa.inspect(connection).get_table_names())
+
+
+class OldSchemaError(RuntimeError):
+    '''
+    Raised by init_db() on a database that still uses the old schema
+    '''
+
+
+def needs_migration(connection):
+    '''
+    Whether the database uses the old schema, or holds the tables of
+    an interrupted migration
+    '''
+    tables = _table_names(connection)
+    if 'listing_old' in tables or 'booking_old' in tables:
+        # a previous run was interrupted
+        return True
+    if 'listing' not in tables:
+        return False
+    columns = {c['name'] for c in sa.inspect(connection).get_columns(
+        'listing')}
+    return 'id' not in columns
+
+
+def _set_aside(connection, name):
+    '''
+    Rename a table to <name>_old, unless an earlier run already did
+    and left a partly filled new table behind, which is dropped.
+    '''
+    tables = _table_names(connection)
+    if name + '_old' in tables:
+        if name in tables:
+            connection.execute(sa.text('DROP TABLE ' + name))
+        return
+    # index names are global in SQLite, drop them so the new tables
+    # can reuse them
+    table = sa.Table(name, sa.MetaData(), autoload_with=connection)
+    for index in table.indexes:
+        index.drop(connection)
+    connection.execute(sa.text(
+        'ALTER TABLE {0} RENAME TO {0}_old'.format(name)))
+
+
+def _copy_listings(engine, batch_size, report):
+    old = sa.Table('listing_old', sa.MetaData(), autoload_with=engine)
+    users = User.__table__
+    listings = Listing.__table__
+    # walk the old primary key, so duplicated titles are all seen
+    after = ('', '', '')
+    last_title = None
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                sa.select(old.c.title, old.c.description, old.c.owner_id,
+                          old.c.price, old.c.last_modified_date, users.c.id)
+                .select_from(old.outerjoin(
+                    users, users.c.email == old.c.owner_id))
+                .where(sa.tuple_(old.c.title, old.c.description,
+                                 old.c.owner_id) > sa.tuple_(*after))
+                .order_by(old.c.title, old.c.description, old.c.owner_id)
+                .limit(batch_size)).all()
+            if not rows:
+                return
+            batch = []
+            for title, description, email, price, date, owner_id in rows:
+                after = (title, description, email)
+                # the old key allowed the same title more than once,
+                # keep the first one
+                if title == last_title:
+                    report['duplicate listings'] += 1
+                    continue
+                last_title = title
+                if owner_id is None:
+                    report['listings without owner'] += 1
+                    continue
+                batch.append({'title': title, 'description': description,
+                              'price': price, 'last_modified_date': date,
+                              'owner_id': owner_id})
+            if batch:
+                connection.execute(listings.insert(), batch)
+            report['listings'] += len(batch)
+
+
+def _copy_bookings(engine, batch_size, report):
+    old = sa.Table('booking_old', sa.MetaData(), autoload_with=engine)
+    users = User.__table__
+    listings = Listing.__table__
+    bookings = Booking.__table__
+    after = ('', '')
+    # the latest copied booking of a listing starting before a date,
+    # the only one that can overlap, see find_overlapping_booking()
+    latest_end = sa.select(bookings.c.end_date).where(
+        bookings.c.listing_id == sa.bindparam('listing_id'),
+        bookings.c.start_date < sa.bindparam('end_date')
+    ).order_by(bookings.c.start_date.desc()).limit(1)
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                sa.select(old.c.user_id, old.c.listing_id,
+                          old.c.start_date, old.c.end_date,
+                          users.c.id, listings.c.id)
+                .select_from(old.outerjoin(
+                    users, users.c.email == old.c.user_id
+                ).outerjoin(
+                    listings, listings.c.title == old.c.listing_id))
+                .where(sa.tuple_(old.c.user_id, old.c.listing_id) >
+                       sa.tuple_(*after))
+                .order_by(old.c.user_id, old.c.listing_id)
+                .limit(batch_size)).all()
+            if not rows:
+                return
+            batch = []
+            # listing id -> date ranges of the batch
+            staged = {}
+            for email, title, start, end, user_id, listing_id in rows:
+                after = (email, title)
+                if user_id is None or listing_id is None:
+                    report['orphaned bookings'] += 1
+                    continue
+                dates = parse_booking_dates(start, end)
+                if dates is None:
+                    report['bookings with invalid dates'] += 1
+                    continue
+                start, end = dates
+                copied_end = connection.execute(latest_end, {
+                    'listing_id': listing_id, 'end_date': end}).scalar()
+                if (copied_end is not None and copied_end > start) or any(
+                        other_start < end and other_end > start for
+                        other_start, other_end in staged.get(listing_id,
+                                                             ())):
+                    report['overlapping bookings'] += 1
+                    continue
+                staged.setdefault(listing_id, []).append((start, end))
+                batch.append({'user_id': user_id, 'listing_id': listing_id,
+                              'start_date': start, 'end_date': end})
+            if batch:
+                connection.execute(bookings.insert(), batch)
+            report['bookings'] += len(batch)
+
+
+def migrate_schema(engine, batch_size=1000):
+    '''
+    Convert the listing and booking tables to the integer id schema
+      Parameters:
+        engine (Engine): engine of the database to convert
+        batch_size (integer): rows copied per transaction
+      Returns:
+        A dict counting the rows copied and skipped, empty if the
+        database did not need converting
+    '''
+    with engine.begin() as connection:
+        if not needs_migration(connection):
+            return {}
+        _set_aside(connection, 'booking')
+        _set_aside(connection, 'listing')
+        Listing.__table__.create(connection)
+        Booking.__table__.create(connection)
+
+    report = {'listings': 0, 'duplicate listings': 0,
+              'listings without owner': 0,
+              'bookings': 0, 'orphaned bookings': 0,
+              'bookings with invalid dates': 0, 'overlapping bookings': 0}
+    _copy_listings(engine, batch_size, report)
+    _copy_bookings(engine, batch_size, report)
+
+    with engine.begin() as connection:
+        connection.execute(sa.text('DROP TABLE booking_old'))
+        connection.execute(sa.text('DROP TABLE listing_old'))
+    return report
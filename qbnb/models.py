@@ -1,19 +1,39 @@
 from http.client import REQUEST_HEADER_FIELDS_TOO_LARGE
-from qbnb import app
+from qbnb.validation import validate_registration, valid_email
+from qbnb.validation import validate_registrations, validate_listing
+from qbnb.validation import valid_password, valid_username
+from qbnb.validation import valid_postal_code, valid_title
+from qbnb.passwords import hash_password, verify_password, needs_rehash
+from qbnb.cache import TTLCache
+from qbnb.replicas import RoutingSession, replica_reads, note_write
+from qbnb.search import create_search_index, index_listing
+from qbnb.search import search_listing_ids
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-import re
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import make_transient_to_detached
+import sqlalchemy as sa
 import email
 import datetime
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 '''
 This file defines data models and related business logics
 '''
 
-db = SQLAlchemy(app)
+# bound to the app by create_app(); the session class routes the
+# reads of @replica_reads functions to read replicas
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
 class User(db.Model):
-    # may need to edit these eg. password should probably not be db.string()
+    # password holds a salted hash, see qbnb/passwords.py. balance is
+    # the opening balance: bookings append to the ledger instead of
+    # updating it, see get_balance()
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(), unique=True, nullable=False)
     password = db.Column(db.String(), nullable=False)
@@ -44,58 +64,138 @@ class Review(db.Model):
 
 
 class Listing(db.Model):
-    # may need to edit these, eg. not sure about owner_id?
-    title = db.Column(db.String(), primary_key=True)
-    description = db.Column(db.String(), primary_key=True)
+    # availability search walks listings by price, see
+    # find_available_listings()
+    __table_args__ = (
+        db.Index('ix_listing_price', 'price', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # R4-8: titles are unique, and the unique index also serves
+    # lookups by title and the keyset-paginated home page feed
+    title = db.Column(db.String(80), unique=True, nullable=False)
+    description = db.Column(db.String(2000), nullable=False)
     price = db.Column(db.Integer, unique=False, nullable=False)
     last_modified_date = db.Column(db.String(), unique=False, nullable=False)
-    owner_id = db.Column(db.String(), primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                         nullable=False, index=True)
+
+    owner = db.relationship('User')
 
 
 class Booking(db.Model):
-    user_id = db.Column(db.String(), primary_key=True)
-    listing_id = db.Column(db.String(), primary_key=True)
+    # bookings of one listing never overlap, so ordering them by
+    # start_date also orders them by end_date. The composite index
+    # lets the overlap check seek straight to the one booking that
+    # could collide instead of scanning the listing's history.
+    __table_args__ = (
+        db.Index('ix_booking_listing_start', 'listing_id', 'start_date'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False, index=True)
+    listing_id = db.Column(db.Integer, db.ForeignKey('listing.id'),
+                           nullable=False)
+    start_date = db.Column(db.String(10), nullable=False)
+    end_date = db.Column(db.String(10), nullable=False)
+
+    user = db.relationship('User')
+    listing = db.relationship('Listing')
+
+
+class LedgerEntry(db.Model):
+    # append-only: every change of a balance is a row here, a booking
+    # debits the guest and credits the owner
+    __table_args__ = (
+        db.Index('ix_ledger_entry_user', 'user_id', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'),
+                           index=True)
+    created_at = db.Column(db.Float, nullable=False)
+
+    booking = db.relationship('Booking')
+
+
+class BalanceSnapshot(db.Model):
+    # a user's balance including every ledger entry up to entry_id,
+    # written by the snapshot job, see qbnb/ledger.py
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    entry_id = db.Column(db.Integer, nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+    taken_at = db.Column(db.Float, nullable=False)
+
+
+class BookingRequest(db.Model):
+    # a booking waiting for the queue writer, see qbnb/booking_queue.py.
+    # The id orders the queue; status is 'pending', 'booked',
+    # 'rejected' or 'failed'.
+    __table_args__ = (
+        db.Index('ix_booking_request_status', 'status', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), unique=True, nullable=False)
+    user_email = db.Column(db.String(), nullable=False)
+    listing_title = db.Column(db.String(), nullable=False)
     start_date = db.Column(db.String(), nullable=False)
     end_date = db.Column(db.String(), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    booking_id = db.Column(db.Integer, db.ForeignKey('booking.id'))
+    # time.time() when queued and when decided
+    queued_at = db.Column(db.Float, nullable=False)
+    decided_at = db.Column(db.Float)
 
 
-db.create_all()
+class DataVersion(db.Model):
+    # counters bumped by the writes that change what the pages show,
+    # see qbnb/fragments.py
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
 
 
-def register(name, email, password):
-    # check that neither password or user is empty
-    if (password is None) or (email is None):
-        return None
-
-    # check that email is valid
-    email_regex = re.compile(r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]\
-    +)*|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+\
-    /-9=?A-Z^-~]+)*|\[[\t -Z^-~]*])")
+# bumped by listing writes and by changes of owner emails, which the
+# listings show
+LISTINGS_VERSION = 'listings'
 
-    if not re.match(email_regex, email):
-        return None
-    
-    # check password is valid
-    password_regex = re.compile(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*[-+_\
-    !@#$%^&*., ?])\S{6,}$")
-    if not re.match(password_regex, password):
-        return None
 
-    # check username is valid
-    valid_name = True
-    user_list = list(name)
-    if ((len(name) <= 2) or (len(name) >= 20)):
-        return None
+def init_db():
+    '''
+    Create the tables and indexes that do not exist yet, run it once
+    per database with:  python -m qbnb init-db
+    Raises OldSchemaError on a database created with the old listing
+    and booking schema, which python -m qbnb migrate converts first.
+    '''
+    # imported here, qbnb/migrate.py imports this module
+    from qbnb.migrate import needs_migration, OldSchemaError
+    with db.engine.connect() as connection:
+        if needs_migration(connection):
+            # the indexes below are on columns the old tables lack
+            raise OldSchemaError(
+                'The database uses the old listing/booking schema, run '
+                '`python -m qbnb migrate` first.')
+    # on the primary only, replicas get the schema through replication
+    db.create_all(bind_key=None)
+    # create_all skips the tables that exist, add the indexes they
+    # gained since
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    create_search_index(db.session)
+    if db.session.get(DataVersion, LISTINGS_VERSION) is None:
+        db.session.add(DataVersion(name=LISTINGS_VERSION, version=0))
+    db.session.commit()
 
-    for i in range(len(user_list)):
-        if (i == 0) or (i == len(user_list) - 1):
-            if (user_list[i].isalnum() is False):
-                valid_name = False
-        else:
-            if (user_list[i].isalnum() is not True) and (user_list[i] != ' '):
-                valid_name = False
 
-    if valid_name is False:
+def register(name, email, password):
+    # check that the email, password and username are all valid
+    if validate_registration(name, email, password) is not None:
         return None
 
     # check if the email has been used:
@@ -106,16 +206,133 @@ def register(name, email, password):
     # create a new user 
     # shipping address is empty, postal code is empty, balance = 100
      
-    user = User(username=name, email=email, password=password, 
+    user = User(username=name, email=email,
+                password=hash_password(password),
                 billing_address='', postal_code='', balance=100)
     # add it to the current database session
     db.session.add(user)
     # actually save the user object
     db.session.commit()
+    note_write()
 
     return user
 
 
+def bump_data_version(name):
+    '''
+    Count a change of the data a version covers, as part of the
+    current transaction
+    '''
+    updated = db.session.execute(sa.update(DataVersion).where(
+        DataVersion.name == name).values(version=DataVersion.version + 1))
+    if updated.rowcount == 0:
+        # a database initialised before the counters existed
+        db.session.add(DataVersion(name=name, version=1))
+
+
+# built once, constructing it costs more than running it
+PAGE_VERSIONS_QUERY = sa.select(
+    sa.func.coalesce(sa.select(DataVersion.version).where(
+        DataVersion.name == LISTINGS_VERSION).scalar_subquery(), 0),
+    sa.func.coalesce(sa.select(sa.func.max(Booking.id)).where(
+        Booking.user_id == sa.bindparam('user_id')).scalar_subquery(), 0))
+
+
+@replica_reads
+def get_page_versions(user_id):
+    '''
+    The data versions of a user's pages, in one query
+      Parameters:
+        user_id (integer): id of the logged in user
+      Returns:
+        The listings counter and the id of the user's newest booking.
+        Bookings are only ever added, and those of one guest one at a
+        time under the lock of their row, so the id only grows.
+    '''
+    return tuple(db.session.execute(PAGE_VERSIONS_QUERY,
+                                    {'user_id': user_id}).one())
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def register_many(records, chunk_size=1000, workers=None):
+    '''
+    Register many users at once, e.g. when importing accounts
+      Parameters:
+        records (iterable): (name, email, password) tuples
+        chunk_size (integer): users validated, checked and inserted
+            per transaction
+        workers (integer): threads hashing passwords, defaults to
+            the number of CPUs
+      Returns:
+        A list of (index, reason) pairs for the records that were
+        rejected, index being the position in records
+    '''
+    # hashlib releases the GIL while deriving keys, so threads hash
+    # in parallel; they have no app context, so resolve the cost here
+    iterations = current_app.config.get('PASSWORD_HASH_ITERATIONS')
+    rejected = []
+    with ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        for offset, chunk in zip(itertools.count(0, chunk_size),
+                                 _chunks(records, chunk_size)):
+            reasons = validate_registrations(chunk)
+            # R1-7: emails used in the database, one IN query per chunk
+            emails = {email for (_, email, _), reason in zip(chunk, reasons)
+                      if reason is None}
+            existing = {email for (email,) in db.session.query(
+                User.email).filter(User.email.in_(emails))}
+
+            accepted = []
+            for index, (name, email, password), reason in zip(
+                    itertools.count(offset), chunk, reasons):
+                if reason is None and email in existing:
+                    reason = 'email already used'
+                if reason is not None:
+                    rejected.append((index, reason))
+                    continue
+                # later duplicates within the chunk are rejected too
+                existing.add(email)
+                accepted.append((index, name, email, password))
+
+            hashes = pool.map(lambda record: hash_password(
+                record[3], iterations), accepted)
+            # R1-8 to R1-10: empty address and postal code, balance 100
+            rows = [(index, {'username': name, 'email': email,
+                             'password': hashed, 'billing_address': '',
+                             'postal_code': '', 'balance': 100})
+                    for (index, name, email, _), hashed in zip(accepted,
+                                                               hashes)]
+            while rows:
+                try:
+                    # written with a single executemany
+                    db.session.execute(User.__table__.insert(),
+                                       [values for _, values in rows])
+                    db.session.commit()
+                    break
+                except IntegrityError:
+                    # an email was registered by someone else since the
+                    # check above, check the chunk again
+                    db.session.rollback()
+                    taken = {email for (email,) in db.session.query(
+                        User.email).filter(User.email.in_(
+                            [values['email'] for _, values in rows]))}
+                    if not taken:
+                        raise
+                    rejected.extend((index, 'email already used')
+                                    for index, values in rows
+                                    if values['email'] in taken)
+                    rows = [(index, values) for index, values in rows
+                            if values['email'] not in taken]
+    return sorted(rejected)
+
+
 # email = db.Column(db.String(), unique=True, nullable=False)
 #     password = db.Column(db.String(), nullable=False)
 #     username = db.Column(db.String(), unique=True, nullable=False)
@@ -127,6 +344,7 @@ def register(name, email, password):
 # R2-2: The login function should check if the supplied 
 # inputs meet the same email/password requirements 
 # as above, before checking the database.
+@replica_reads
 def login(email, password):
     '''
     Check login information
@@ -141,24 +359,125 @@ def login(email, password):
     # length 6, at least one upper case, at least one lower case,
     #  and at least one special character.
 
-    email_regex = re.compile(r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]\
-    +)*|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+\
-    /-9=?A-Z^-~]+)*|\[[\t -Z^-~]*])")
-    password_regex = re.compile(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*[-+_\
-    !@#$%^&*., ?])\S{6,}$")
-
     # check email and password requirements
-    if not re.match(email_regex, email):
-        return None
-    if not re.match(password_regex, password):
+    if not valid_email(email) or not valid_password(password):
         return None
 
-    valids = User.query.filter_by(email=email, password=password).all()
-    if len(valids) != 1:
+    user = User.query.filter_by(email=email).one_or_none()
+    if user is None or not verify_password(password, user.password):
         return None
-    return valids[0]
+    # upgrade plain text rows and hashes made with an old work factor
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+        note_write()
+    return user
     
 
+def _user_cache():
+    cache = current_app.extensions.get('qbnb_user_cache')
+    if cache is None:
+        cache = TTLCache(current_app.config.get('USER_CACHE_SIZE', 1024),
+                         current_app.config.get('USER_CACHE_TTL', 30))
+        current_app.extensions['qbnb_user_cache'] = cache
+    return cache
+
+
+def balance_query(user_ids):
+    '''
+    The statement selecting (user id, balance) of the users, see
+    get_balances()
+    '''
+    # the snapshot, or the opening balance without one, plus the
+    # entries after it: a primary key lookup and a range of
+    # ix_ledger_entry_user
+    after = sa.func.coalesce(BalanceSnapshot.entry_id, 0)
+    delta = sa.select(sa.func.coalesce(sa.func.sum(LedgerEntry.amount), 0)
+                      ).where(LedgerEntry.user_id == User.id,
+                              LedgerEntry.id > after).scalar_subquery()
+    return sa.select(
+        User.id, sa.func.coalesce(BalanceSnapshot.balance, User.balance) +
+        delta
+    ).outerjoin(BalanceSnapshot, BalanceSnapshot.user_id == User.id).where(
+        User.id.in_(user_ids))
+
+
+def get_balance(user_id):
+    '''
+    The current balance of a user, None if there is no such user
+    '''
+    return db.session.execute(balance_query([user_id])).scalars(1).first()
+
+
+def get_balances(user_ids):
+    '''
+    The current balances of several users, as a dict by user id
+    '''
+    return dict(db.session.execute(balance_query(list(user_ids))).all())
+
+
+@replica_reads
+def get_session_user(email):
+    '''
+    Load the logged in user, from the user cache when possible
+      Parameters:
+        email (string): the email stored in the session
+      Returns:
+        The user object attached to the current database session,
+        or None if there is no such user
+    '''
+    cached = cached_user(email)
+    if cached is not None:
+        # attach a copy to this request's session without a query
+        return db.session.merge(cached, load=False)
+
+    user = User.query.filter_by(email=email).one_or_none()
+    if user is not None:
+        cache_user(user)
+    return user
+
+
+def cached_user(email):
+    '''
+    The detached copy of a user in the user cache, None if not cached
+    '''
+    return _user_cache().get(email)
+
+
+def cache_user(user):
+    '''
+    Put a detached copy of a loaded user in the user cache
+    '''
+    cache = _user_cache()
+    if cache.maxsize > 0:
+        # a copy, so the cached object is never bound to (or expired
+        # by) any request's session
+        snapshot = User(**{column.key: getattr(user, column.key)
+                           for column in User.__table__.columns})
+        make_transient_to_detached(snapshot)
+        cache.set(user.email, snapshot)
+
+
+def invalidate_cached_user(*emails):
+    '''
+    Drop users from the user cache after their row changed
+      Parameters:
+        emails (string): emails of the users to drop
+    '''
+    cache = _user_cache()
+    for email in emails:
+        cache.pop(email)
+
+
+def user_cache_stats():
+    '''
+    Report the user cache counters for monitoring
+      Returns:
+        A dict with the cache size, maxsize, hits and misses
+    '''
+    return _user_cache().stats()
+
+
 # R3-1: A user is only able to update his/her user name, 
 # user email, billing address, and postal code.
 # R3-2: postal code should be non-empty, alphanumeric-only, 
@@ -169,6 +488,40 @@ def login(email, password):
 # and space allowed only if it is not as the prefix or suffix.
 # R1-6: User name has to be longer than 2 characters 
 # and less than 20 characters.
+def validate_user_update(username, new_email, billing_address, postal_code):
+    '''
+    Check a profile update against R3-1 to R3-4 without touching
+    the database
+      Parameters:
+        username (string): updated username, empty to keep it
+        new_email (string): updated email, empty to keep it
+        billing_address (string): updated billing address, empty to keep it
+        postal_code (string): updated postal code, required
+      Returns:
+        A (changes, reason) pair: the attributes to set on the user and
+        None, or None and the reason the update was rejected
+    '''
+    changes = {}
+    if not postal_code:
+        return None, 'postal code is required'
+    postal_spaceless = postal_code.replace(' ', '')
+    if not valid_postal_code(postal_spaceless):
+        return None, 'invalid postal code'
+    changes['postal_code'] = postal_spaceless
+
+    if username:
+        if not valid_username(username):
+            return None, 'invalid username'
+        changes['username'] = username
+    if new_email:
+        if len(new_email) < 3 or not valid_email(new_email):
+            return None, 'invalid email'
+        changes['email'] = new_email
+    if billing_address:
+        changes['billing_address'] = billing_address
+    return changes, None
+
+
 def update_user(old_email, username, new_email, billing_address, postal_code):
     '''
     Update user information
@@ -181,52 +534,104 @@ def update_user(old_email, username, new_email, billing_address, postal_code):
       Returns:
         The user object if update succeeded otherwise None
     '''
+    # validate everything first, so a bad field never leaves
+    # the profile half updated
+    changes, _ = validate_user_update(username, new_email,
+                                      billing_address, postal_code)
+    if not changes:
+        return None
+
     # checks to make sure user to be updated is a valid user
     user = User.query.filter_by(email=old_email).first()
     if user is None:
         return None
-    edited = 0
-
-    if postal_code:
-        postal_spaceless = postal_code.replace(' ', '')
-        if not re.match(r"[a-zA-Z][0-9][a-zA-Z][0-9][a-zA-Z][0-9]",
-                        postal_spaceless):
-            return None
-        else:
-            user.postal_code = postal_spaceless
-            edited += 1
-            db.session.commit()
-    else:
-        return None
-
-    if username:
-        if re.match(r"^[a-zA-Z0-9][a-zA-Z0-9 ]{1,17}[a-zA-Z0-9]$", username):
-            user.username = username
-            edited += 1
-            db.session.commit()
-        else:
-            return None
-    if new_email:
-        if (len(new_email) < 3):
-            return None
-        if re.match(r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]\
-    +)*|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+\
-    /-9=?A-Z^-~]+)*|\[[\t -Z^-~]*])", new_email):
-            user.email = new_email
-            edited += 1
-            db.session.commit()
-        else:
-            return None
-    if billing_address:
-        user.billing_address = billing_address
-        edited += 1
+    for attribute, value in changes.items():
+        setattr(user, attribute, value)
+    try:
+        if 'email' in changes:
+            # listings show their owner's email
+            bump_data_version(LISTINGS_VERSION)
+        # one atomic write for the whole profile
         db.session.commit()
-
-    if edited == 0:
+    except IntegrityError:
+        # the new email belongs to someone else
+        db.session.rollback()
         return None
+    # the row changed, stop serving the cached copy
+    invalidate_cached_user(old_email, new_email)
+    note_write()
     return user
 
 
+def update_users(updates, batch_size=500):
+    '''
+    Apply many profile updates, committing once per batch
+      Parameters:
+        updates (iterable): (old_email, username, new_email,
+            billing_address, postal_code) tuples, as for update_user
+        batch_size (integer): updates written per commit
+      Returns:
+        A list of (index, reason) pairs for the updates that were
+        rejected, index being the position in updates
+    A batch that fails to commit is rolled back and the error raised.
+    '''
+    rejected = []
+    for offset, chunk in zip(itertools.count(0, batch_size),
+                             _chunks(updates, batch_size)):
+        checked = []
+        emails_changed = False
+        for index, (old_email, username, new_email, billing_address,
+                    postal_code) in enumerate(chunk, offset):
+            changes, reason = validate_user_update(
+                username, new_email, billing_address, postal_code)
+            if changes is None:
+                rejected.append((index, reason))
+            else:
+                checked.append((index, old_email, changes))
+
+        # (old email, new email) of the users this batch changes
+        changed = []
+        # the users being updated, and the users already holding any
+        # requested new email, in two queries for the whole batch
+        users = {user.email: user for user in User.query.filter(
+            User.email.in_({old for _, old, _ in checked}))}
+        wanted = {changes['email'] for _, _, changes in checked
+                  if 'email' in changes}
+        taken = {user.email: user for user in User.query.filter(
+            User.email.in_(wanted))} if wanted else {}
+
+        for index, old_email, changes in checked:
+            user = users.get(old_email)
+            if user is None:
+                rejected.append((index, 'no such user'))
+                continue
+            email = changes.get('email', user.email)
+            if taken.get(email, user) is not user:
+                rejected.append((index, 'email already used'))
+                continue
+            taken[email] = user
+            for attribute, value in changes.items():
+                setattr(user, attribute, value)
+            changed.append((old_email, email))
+            if 'email' in changes:
+                emails_changed = True
+        try:
+            if emails_changed:
+                bump_data_version(LISTINGS_VERSION)
+            db.session.commit()
+        except Exception:
+            # e.g. a new email registered by someone else in the
+            # meantime; this batch is not applied, the earlier ones are
+            db.session.rollback()
+            raise
+        # the rows changed, stop serving the cached copies; only after
+        # the commit, or a reader could cache the old row again
+        for old_email, email in changed:
+            invalidate_cached_user(old_email, email)
+        note_write()
+    return rejected
+
+
 def create_listing(title_prod, desc_prod, price_prod, date, owner_email):
     '''
     R4-1: The title of the product has to be alphanumeric-only,
@@ -242,47 +647,8 @@ def create_listing(title_prod, desc_prod, price_prod, date, owner_email):
           must exist in the database.
     R4-8: A user cannot create products that have the same title.
     '''
-    # check if the title of the product meets the requirements
-    if len(title_prod) <= 80:
-        if title_prod[0] != " " and title_prod[-1] != " ":
-            # go through each word and check that they are only alphanumerics
-            title_check_regex = title_prod.split(" ")
-            for word in title_check_regex:
-                if not re.match(r'^[a-zA-Z0-9]+$', word):
-                    return None
-        else:
-            return None
-    else:
-        return None
-    
-    # check that the description of the product meets the requirements
-    if len(desc_prod) < len(title_prod):
-        return None
-    elif len(desc_prod) < 20 or len(desc_prod) > 2000:
-        return None
-
-    # price should be in range [10:10000]    
-    if price_prod < 10 or price_prod > 10000:
-        return None
-
-    # Year-Month-Date check if valid
-    try:
-        # check that the date exists in the calender
-        datetime.datetime.strptime(date, '%Y-%m-%d')
-
-        # check that the year is between 2021 and 2025,
-        # if so check that its valid
-        if int(date[:4]) >= 2021 and int(date[:4]) <= 2025:
-            if date[:4] == "2021" and date[5:7] == "01":
-                if date[8:10] == "01":
-                    return None
-
-            elif date[:4] == "2025" and date[5:7] == "01":
-                if date[8:10] != "01" or date[8:10] != "02":
-                    return None                 
-        else:
-            return None
-    except ValueError:
+    # R4-1 to R4-6
+    if validate_listing(title_prod, desc_prod, price_prod, date) is not None:
         return None
 
     # check owner id
@@ -302,12 +668,149 @@ def create_listing(title_prod, desc_prod, price_prod, date, owner_email):
     # database and return the listing
     new_listing = Listing(title=title_prod, description=desc_prod,
                           price=price_prod, last_modified_date=date,
-                          owner_id=owner_email)
+                          owner_id=user.id)
     db.session.add(new_listing)
+    # the id is needed for the search index
+    db.session.flush()
+    index_listing(db.session, new_listing.id, title_prod, desc_prod)
+    bump_data_version(LISTINGS_VERSION)
     db.session.commit()
+    note_write()
     return new_listing
 
 
+def listings_page_query(after, page_size):
+    '''
+    The statement selecting the listings of a page of the feed, one
+    more than page_size to tell whether a next page exists, see
+    get_listings_page()
+    '''
+    # keyset pagination: seek past the cursor on the unique title
+    # index instead of using OFFSET, so every page costs the same no
+    # matter how deep into the catalogue it is. Owners are loaded in
+    # the same query since the page shows their emails.
+    query = sa.select(Listing).options(joinedload(Listing.owner)).order_by(
+        Listing.title)
+    if after:
+        query = query.where(Listing.title > after)
+    return query.limit(page_size + 1)
+
+
+def listings_page(listings, page_size):
+    '''
+    Split the rows of listings_page_query() into the page and the
+    cursor of the next page
+    '''
+    if len(listings) > page_size:
+        listings = listings[:page_size]
+        return listings, listings[-1].title
+    return listings, None
+
+
+@replica_reads
+def get_listings_page(after=None, page_size=20):
+    '''
+    Fetch one page of listings ordered by title
+      Parameters:
+        after (string): title of the last listing on the previous page,
+            None for the first page
+        page_size (integer): number of listings on a page
+      Returns:
+        The listings on the page and the cursor of the next page,
+        which is None when this is the last page
+    '''
+    return listings_page(db.session.execute(listings_page_query(
+        after, page_size)).scalars().all(), page_size)
+
+
+def user_bookings_query(user_id):
+    '''
+    The statement selecting a user's bookings, see get_user_bookings()
+    '''
+    return sa.select(Booking).options(joinedload(Booking.listing)).where(
+        Booking.user_id == user_id).order_by(Booking.start_date)
+
+
+@replica_reads
+def get_user_bookings(user_id):
+    '''
+    Fetch the bookings made by a user
+      Parameters:
+        user_id (integer): id of the user who made the bookings
+      Returns:
+        The user's bookings ordered by start date, with their listings
+    '''
+    return db.session.execute(user_bookings_query(user_id)).scalars().all()
+
+
+@replica_reads
+def search_listings(query, limit=20):
+    '''
+    Full-text search over listing titles and descriptions
+      Parameters:
+        query (string): the words to look for, all must match
+        limit (integer): the most listings returned
+      Returns:
+        The matching listings with their owners, best match first
+    '''
+    ids = search_listing_ids(db.session, query, limit)
+    if not ids:
+        return []
+    listings = {listing.id: listing for listing in Listing.query.options(
+        joinedload(Listing.owner)).filter(Listing.id.in_(ids))}
+    return [listings[i] for i in ids if i in listings]
+
+
+@replica_reads
+def find_available_listings(start_date, end_date, min_price=None,
+                            max_price=None, after=None, page_size=20):
+    '''
+    Fetch one page of the listings free for a date range
+      Parameters:
+        start_date (string): first night, formatted YYYY-MM-DD
+        end_date (string):   check-out day, formatted YYYY-MM-DD
+        min_price (integer): lowest price, None for no lower bound
+        max_price (integer): highest price, None for no upper bound
+        after ((integer, integer)): (price, id) of the last listing on
+            the previous page, None for the first page
+        page_size (integer): number of listings on a page
+      Returns:
+        The free listings on the page, cheapest first, and the cursor
+        of the next page, which is None when this is the last page.
+        Invalid dates give an empty page.
+    '''
+    dates = parse_booking_dates(start_date, end_date)
+    if dates is None:
+        return [], None
+    start_date, end_date = dates
+    # the same check as find_overlapping_booking(), per listing: only
+    # the latest booking starting before end_date can overlap, and it
+    # is a single seek on ix_booking_listing_start
+    latest_end = sa.select(Booking.end_date).where(
+        Booking.listing_id == Listing.id,
+        Booking.start_date < end_date
+    ).order_by(Booking.start_date.desc()).limit(1).scalar_subquery()
+    query = Listing.query.options(joinedload(Listing.owner)).filter(
+        sa.func.coalesce(latest_end, '') <= start_date
+    ).order_by(Listing.price, Listing.id)
+    # the price range and the keyset cursor are both a range scan of
+    # ix_listing_price, so a page costs about page_size seeks divided
+    # by the share of free listings, however deep it is
+    if min_price is not None:
+        query = query.filter(Listing.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Listing.price <= max_price)
+    if after is not None:
+        query = query.filter(
+            sa.tuple_(Listing.price, Listing.id) > sa.tuple_(*after))
+    # one extra row tells us whether a next page exists
+    listings = query.limit(page_size + 1).all()
+    if len(listings) > page_size:
+        listings = listings[:page_size]
+        return listings, (listings[-1].price, listings[-1].id)
+    return listings, None
+
+
 # R5-1: One can update all attributes of the listing, except
 # owner_id and last_modified_date.
 # R5-2: Price can be only increased but cannot be decreased :)
@@ -315,34 +818,34 @@ def create_listing(title_prod, desc_prod, price_prod, date, owner_email):
 # operation is successful.
 # R5-4: When updating an attribute, one has to make sure that
 # it follows the same requirements as above.
-def update_listing(owner_id, title, description, price):
+def update_listing(owner_email, title, description, price, listing_id=None):
     '''
     Update user information
       Parameters:
-        owner_id (string): owner's id
+        owner_email (string): owner's email
         title (string): to update owner's title
         desciption (string): to update owner's description
         price (intger): to update owner's price,
             set to -1 if not to be updated
         last_modified date (string): to update owner's last_modified_date
+        listing_id (integer): the owner's listing to update, None for
+            their first one
       Returns:
         The listing object if update succeeded otherwise None
     '''
     # checks to make sure listing to be updated is a valid listing
-    listing = Listing.query.filter_by(owner_id=owner_id).first()
+    query = Listing.query.join(Listing.owner).filter(
+        User.email == owner_email)
+    if listing_id is not None:
+        query = query.filter(Listing.id == listing_id)
+    listing = query.order_by(Listing.id).first()
     if listing is None:
         return None
     # checks to make sure each attribute is successfull
     
     # check if the title of the product meets the requirements
     if title != "N/A":
-        if len(title) <= 80 and title[0] != " " and title[-1] != " ":
-            # go through each word and check that they are only alphanumerics
-            title_check_regex = title.split(" ")
-            for word in title_check_regex:
-                if not re.match(r'^[a-zA-Z0-9]+$', word):
-                    return None
-        else:
+        if not valid_title(title):
             return None
 
         # make sure the title hasn't been used before
@@ -371,50 +874,315 @@ def update_listing(owner_id, title, description, price):
     if price != -1:
         listing.price = price
     # updates the last_modified_date since all operations were successfull
-    listing.last_modified_date = datetime.date.today()
+    # stored as text like the dates given to create_listing()
+    listing.last_modified_date = datetime.date.today().isoformat()
+    index_listing(db.session, listing.id, listing.title, listing.description)
+    bump_data_version(LISTINGS_VERSION)
+    db.session.commit()
+    note_write()
     return listing
 
 
-def create_booking(user_email, listing_title, start_date, end_date):
-    listing = Listing.query.filter_by(title=listing_title).first()
-    if listing is None:
-        return None
-    price = listing.price
-    owner_email = listing.owner_id
-    owner = User.query.filter_by(email=owner_email).first()
-    user = User.query.filter_by(email=user_email).first()
-    if user is None:
-        return None
+def overlap_candidate_query(listing_id, end_date):
+    '''
+    The statement selecting the one booking of the listing that can
+    overlap a range ending on end_date, see find_overlapping_booking()
+    '''
+    # Existing bookings of a listing are disjoint, so the only one that
+    # can overlap the new range is the latest booking starting before
+    # end_date. That is a single seek on ix_booking_listing_start and
+    # costs the same for a listing with 10 or 100k past bookings.
+    # ISO dates compare correctly as strings.
+    return sa.select(Booking).where(
+        Booking.listing_id == listing_id,
+        Booking.start_date < end_date
+    ).order_by(Booking.start_date.desc()).limit(1)
+
+
+def find_overlapping_booking(listing_id, start_date, end_date):
+    '''
+    Find a booking of the listing that overlaps [start_date, end_date)
+      Parameters:
+        listing_id (integer): listing the booking is made against
+        start_date (string): first night, formatted YYYY-MM-DD
+        end_date (string):   check-out day, formatted YYYY-MM-DD
+      Returns:
+        The overlapping booking object if there is one otherwise None
+    '''
+    candidate = db.session.execute(overlap_candidate_query(
+        listing_id, end_date)).scalar()
+    if candidate is not None and candidate.end_date > start_date:
+        return candidate
+    return None
+
+
+def booking_allowed(owner_id, guest_id, price, balance, candidate,
+                    start_date):
+    '''
+    The booking rules, shared by stage_booking() and the async
+    create_booking_async(), on values read under the write lock
+      Parameters:
+        owner_id (integer):  owner of the listing
+        guest_id (integer):  user making the booking
+        price (integer):     price of the listing
+        balance (integer):   current balance of the guest
+        candidate:           the row of overlap_candidate_query(),
+                             or None
+        start_date (string): first night, formatted YYYY-MM-DD
+      Returns:
+        True if the booking can be made
+    '''
+    # A user cannot book a listing for his/her listing.
+    if owner_id == guest_id:
+        return False
+    # A user cannot book a listing that costs more than his/her balance.
+    if balance < price:
+        return False
+    # A user cannot book a listing that is already
+    # booked with the overlapped dates.
+    return candidate is None or candidate.end_date <= start_date
+
+
+def lock_for_write():
+    '''
+    Start the current transaction as a writer, so that rows read from
+    here on cannot change underneath it before it commits.
+    SQLite has no row locks and ignores SELECT ... FOR UPDATE, so there
+    the transaction is opened with BEGIN IMMEDIATE, which takes the
+    database write lock up front. Other backends rely on the
+    with_for_update() row locks taken by the caller's queries.
+    '''
+    connection = db.session.connection()
+    if connection.dialect.name == 'sqlite':
+        raw = connection.connection.dbapi_connection
+        # pysqlite only begins implicitly before a write, so a session
+        # that has not written yet is not in a database transaction
+        if not raw.in_transaction:
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
 
+def parse_booking_dates(start_date, end_date):
+    '''
+    Check the dates of a booking
+      Parameters:
+        start_date (string): first night, formatted YYYY-MM-DD
+        end_date (string):   check-out day, formatted YYYY-MM-DD
+      Returns:
+        The (start_date, end_date) pair zero-padded so they keep
+        sorting correctly as strings, or None if they are invalid
+    '''
     try:
         # check that the dates exist in the calender
-        datetime.datetime.strptime(start_date, '%Y-%m-%d')
-        datetime.datetime.strptime(end_date, '%Y-%m-%d')
+        start_date = datetime.datetime.strptime(
+            start_date, '%Y-%m-%d').date().isoformat()
+        end_date = datetime.datetime.strptime(
+            end_date, '%Y-%m-%d').date().isoformat()
+    except (TypeError, ValueError):
+        return None
+    # A booking has to end after it starts.
+    if start_date >= end_date:
+        return None
+    return start_date, end_date
 
-    except ValueError:
+
+def add_booking(user_email, listing_title, start_date, end_date):
+    '''
+    Apply the booking rules and stage the booking in the current
+    transaction, without committing. The caller is expected to have
+    called lock_for_write() and to commit or roll back afterwards.
+      Parameters:
+        user_email (string):    email of the guest
+        listing_title (string): title of the listing to book
+        start_date (string):    first night, as from parse_booking_dates
+        end_date (string):      check-out day, as from parse_booking_dates
+      Returns:
+        The new booking object if the rules passed otherwise None
+    '''
+    # listing and guest in one round trip, row-locked. The owner's
+    # row is neither locked nor written, so the bookings of a popular
+    # host's listings do not queue up behind it.
+    row = db.session.query(Listing, User).join(
+        User, User.email == user_email
+    ).filter(
+        Listing.title == listing_title
+    ).with_for_update().first()
+    if row is None:
         return None
+    listing, user = row
+    return stage_booking(listing, user, start_date, end_date)
 
-    # A user cannot book a listing for his/her listing.
-    if owner_email == user_email:
+
+def stage_booking(listing, user, start_date, end_date):
+    '''
+    The booking rules of add_booking(), for a listing and the guest
+    already loaded and row-locked
+      Returns:
+        The new booking object if the rules passed otherwise None
+    '''
+    price = listing.price
+    candidate = db.session.execute(overlap_candidate_query(
+        listing.id, end_date)).scalar()
+    if not booking_allowed(listing.owner_id, user.id, price,
+                           get_balance(user.id), candidate, start_date):
         return None
-    # A user cannot book a listing that costs more than his/her balance.
-    if user.balance < price:
+
+    new_booking = Booking(user_id=user.id, listing_id=listing.id,
+                          start_date=start_date, end_date=end_date)
+    db.session.add(new_booking)
+
+    # move the price from the guest to the owner
+    now = time.time()
+    db.session.add_all([
+        LedgerEntry(user_id=user.id, amount=-price, booking=new_booking,
+                    created_at=now),
+        LedgerEntry(user_id=listing.owner_id, amount=price,
+                    booking=new_booking, created_at=now)])
+    return new_booking
+
+
+def create_booking(user_email, listing_title, start_date, end_date):
+    '''
+    Book a listing for a date range
+      Parameters:
+        user_email (string):    email of the guest
+        listing_title (string): title of the listing to book
+        start_date (string):    first night, formatted YYYY-MM-DD
+        end_date (string):      check-out day, formatted YYYY-MM-DD
+      Returns:
+        The booking object if booking succeeded otherwise None
+    '''
+    dates = parse_booking_dates(start_date, end_date)
+    if dates is None:
         return None
-    # A user cannot book a listing that is already 
-    # booked with the overlapped dates.
-    previous_bookings = Booking.query.filter_by(listing_id=listing_title).all()
-    for i in previous_bookings:
-        if ((i.start_date > start_date and i.start_date < end_date) or 
-                (i.end_date > start_date and i.end_date < end_date)):
+
+    # the checks and the writes happen in one locked transaction, so
+    # two concurrent bookings cannot both pass the overlap or balance
+    # checks, and the whole booking costs a single commit
+    try:
+        lock_for_write()
+        new_booking = add_booking(user_email, listing_title, *dates)
+        if new_booking is None:
+            db.session.rollback()
             return None
+        db.session.commit()
+    except OperationalError:
+        # e.g. the write lock could not be taken in time
+        db.session.rollback()
+        return None
+    note_write()
+    return new_booking
 
-    new_booking = Booking(user_id=user_email, listing_id=listing_title,
-                          start_date=start_date, end_date=end_date)
 
-    # change user and owner balances
-    owner.balance += price
-    user.balance -= price
+def _overlaps(ranges, start_date, end_date):
+    return any(start < end_date and end > start_date
+               for start, end in ranges)
 
-    db.session.add(new_booking)
-    db.session.commit()
-    return new_booking
\ No newline at end of file
+
+def create_bookings(requests, atomic=True):
+    '''
+    Book many listings in one locked transaction, with the rules of
+    create_booking applied to the requests in order
+      Parameters:
+        requests (iterable): (user_email, listing_title, start_date,
+            end_date) tuples, as for create_booking
+        atomic (boolean): book all of them or none; if False, the
+            requests that pass are booked and the others skipped
+      Returns:
+        A list of (booking, reason) pairs, one per request: the new
+        booking and None, or None and the reason it was not booked
+    '''
+    requests = list(requests)
+    results = [None] * len(requests)
+    checked = []
+    for index, (user_email, listing_title, start_date, end_date) in \
+            enumerate(requests):
+        dates = parse_booking_dates(start_date, end_date)
+        if dates is None:
+            results[index] = (None, 'invalid dates')
+        else:
+            checked.append((index, user_email, listing_title) + dates)
+    if not checked:
+        return results
+
+    try:
+        lock_for_write()
+        # guests and listings of the whole batch in two queries,
+        # locked in id order so that two batches cannot deadlock
+        guests = {user.email: user for user in User.query.filter(
+            User.email.in_({c[1] for c in checked})
+        ).order_by(User.id).with_for_update()}
+        listings = {listing.title: listing for listing in Listing.query.filter(
+            Listing.title.in_({c[2] for c in checked})
+        ).order_by(Listing.id).with_for_update()}
+        balances = get_balances(
+            {user.id for user in guests.values()} |
+            {listing.owner_id for listing in listings.values()})
+
+        # the existing bookings that could overlap any request of
+        # their listing, in one query
+        spans = {}
+        for _, _, title, start_date, end_date in checked:
+            listing = listings.get(title)
+            if listing is not None:
+                first, last = spans.get(listing.id, (start_date, end_date))
+                spans[listing.id] = (min(first, start_date),
+                                     max(last, end_date))
+        taken = {}
+        if spans:
+            for listing_id, start_date, end_date in db.session.query(
+                    Booking.listing_id, Booking.start_date,
+                    Booking.end_date).filter(sa.or_(*[
+                        sa.and_(Booking.listing_id == listing_id,
+                                Booking.start_date < last,
+                                Booking.end_date > first)
+                        for listing_id, (first, last) in spans.items()])):
+                taken.setdefault(listing_id, []).append(
+                    (start_date, end_date))
+
+        now = time.time()
+        for index, user_email, title, start_date, end_date in checked:
+            guest = guests.get(user_email)
+            listing = listings.get(title)
+            if guest is None:
+                results[index] = (None, 'no such user')
+            elif listing is None:
+                results[index] = (None, 'no such listing')
+            elif listing.owner_id == guest.id:
+                results[index] = (None, 'own listing')
+            elif balances[guest.id] < listing.price:
+                results[index] = (None, 'insufficient balance')
+            elif _overlaps(taken.get(listing.id, ()), start_date, end_date):
+                results[index] = (None, 'dates taken')
+            else:
+                # the later requests see this one's dates and payment
+                taken.setdefault(listing.id, []).append(
+                    (start_date, end_date))
+                balances[guest.id] -= listing.price
+                balances[listing.owner_id] += listing.price
+                booking = Booking(user_id=guest.id, listing_id=listing.id,
+                                  start_date=start_date, end_date=end_date)
+                db.session.add_all([booking, LedgerEntry(
+                    user_id=guest.id, amount=-listing.price,
+                    booking=booking, created_at=now), LedgerEntry(
+                    user_id=listing.owner_id, amount=listing.price,
+                    booking=booking, created_at=now)])
+                results[index] = (booking, None)
+
+        if atomic and any(booking is None for booking, _ in results):
+            db.session.rollback()
+            return [(None, reason or 'another booking of the batch failed')
+                    for _, reason in results]
+        db.session.flush()
+        ids = [booking.id for booking, _ in results if booking is not None]
+        db.session.commit()
+    except OperationalError:
+        # e.g. the write lock could not be taken in time
+        db.session.rollback()
+        return [(None, 'try again')] * len(requests)
+    note_write()
+    if ids:
+        # the commit expired the bookings, reload them with their
+        # listings at once rather than one query each on first use
+        Booking.query.options(joinedload(Booking.listing)).filter(
+            Booking.id.in_(ids)).all()
+    return results
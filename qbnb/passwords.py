@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import hmac
+import os
+from flask import current_app
+from qbnb.cache import TTLCache
+
+'''
+This file defines how user passwords are hashed and verified.
+
+Passwords are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>".
+The work factor comes from the PASSWORD_HASH_ITERATIONS config value,
+and a hash made with a different work factor is flagged by
+needs_rehash() so login can upgrade it transparently.
+
+Setting PASSWORD_VERIFY_CACHE_SIZE above 0 keeps recent successful
+verifications for PASSWORD_VERIFY_CACHE_TTL seconds, so a burst of
+logins for the same account only pays for the key derivation once.
+'''
+
+ALGORITHM = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 260000
+SALT_BYTES = 16
+
+# cache keys are keyed with this per-process secret, so the cache
+# never holds anything that could be brute forced offline
+_cache_key_secret = os.urandom(32)
+
+
+def _iterations():
+    return current_app.config.get('PASSWORD_HASH_ITERATIONS',
+                                  DEFAULT_ITERATIONS)
+
+
+def _verify_cache():
+    cache = current_app.extensions.get('qbnb_password_cache')
+    if cache is None:
+        cache = TTLCache(
+            current_app.config.get('PASSWORD_VERIFY_CACHE_SIZE', 0),
+            current_app.config.get('PASSWORD_VERIFY_CACHE_TTL', 60))
+        current_app.extensions['qbnb_password_cache'] = cache
+    return cache
+
+
+def _derive(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'),
+                               salt, iterations)
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('ascii')
+
+
+def hash_password(password, iterations=None):
+    '''
+    Hash a password with a fresh random salt
+      Parameters:
+        password (string): the plain text password
+        iterations (integer): work factor, the configured one if None
+      Returns:
+        The encoded hash to store in User.password
+    '''
+    if iterations is None:
+        iterations = _iterations()
+    salt = os.urandom(SALT_BYTES)
+    return '{}${}${}${}'.format(ALGORITHM, iterations, _b64(salt),
+                                _b64(_derive(password, salt, iterations)))
+
+
+def verify_password(password, encoded):
+    '''
+    Check a plain text password against a stored value
+      Parameters:
+        password (string): the plain text password
+        encoded (string): the stored value, an encoded hash or a
+            plain text password saved before hashing was introduced
+      Returns:
+        True if the password matches otherwise False
+    '''
+    parts = encoded.split('$')
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        # legacy plain text row; needs_rehash() flags it for upgrade
+        return hmac.compare_digest(encoded.encode('utf-8'),
+                                   password.encode('utf-8'))
+
+    cache = _verify_cache()
+    cache_key = None
+    if cache.maxsize > 0:
+        cache_key = (encoded, hmac.new(_cache_key_secret,
+                                       password.encode('utf-8'),
+                                       hashlib.sha256).digest())
+        if cache.get(cache_key):
+            return True
+
+    _, iterations, salt, expected = parts
+    derived = _derive(password, base64.b64decode(salt), int(iterations))
+    matched = hmac.compare_digest(_b64(derived), expected)
+    if matched and cache_key is not None:
+        cache.set(cache_key, True)
+    return matched
+
+
+def needs_rehash(encoded):
+    '''
+    Check whether a stored value was made with other settings
+      Parameters:
+        encoded (string): the stored value
+      Returns:
+        True if it should be replaced by hash_password()
+    '''
+    parts = encoded.split('$')
+    return (len(parts) != 4 or parts[0] != ALGORITHM or
+            parts[1] != str(_iterations()))
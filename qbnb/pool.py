@@ -0,0 +1,147 @@
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+'''
+This file configures the connection pool used for server databases
+(the MySQL deployment) and keeps metrics about it.
+
+The pool is sized by the DB_POOL_* settings (see default_config()).
+Stale connections, e.g. ones MySQL closed after its idle timeout
+(wait_timeout), are handled two ways:
+
+    DB_POOL_RECYCLE   connections older than this many seconds are
+                      replaced on checkout, keep it below wait_timeout
+    DB_POOL_PRE_PING  every checkout is tested with a cheap ping and a
+                      dead connection is replaced before the request
+                      sees it; the first dead one found also marks
+                      every older pooled connection stale, so a burst
+                      after an idle period reconnects instead of
+                      failing
+
+The connections are handed out last in, first out, so under light load
+the same few stay warm and the extra ones age out instead of being
+kept barely alive.
+'''
+
+
+class PoolMetrics:
+    '''
+    Thread-safe counters for one engine's pool
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {'checkouts': self.checkouts,
+                    'wait_total': self.wait_total,
+                    'wait_max': self.wait_max,
+                    'timeouts': self.timeouts,
+                    'connects': self.connects,
+                    'invalidations': self.invalidations}
+
+
+class MeteredQueuePool(QueuePool):
+    '''
+    A QueuePool that records how long each checkout waited for a
+    connection, including the time spent opening a new one
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        begin = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.record_wait(time.perf_counter() - begin, True)
+            raise
+        self.metrics.record_wait(time.perf_counter() - begin)
+        return record
+
+    def recreate(self):
+        # dispose() swaps in a new pool, keep counting into the same
+        # metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def pool_options(config):
+    '''
+    Engine options for the connection pool
+      Parameters:
+        config (dict): the app config, read for the DB_POOL_* settings
+      Returns:
+        A dict of keyword arguments for create_engine()
+    '''
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_use_lifo': True,
+    }
+
+
+def watch_pool(engine):
+    '''
+    Count the connections engine's pool opens and invalidates
+    '''
+    def count(name):
+        metrics = getattr(engine.pool, 'metrics', None)
+        if metrics is not None:
+            metrics.count(name)
+
+    # listeners on the engine survive engine.dispose()
+    event.listen(engine, 'connect', lambda *args: count('connects'))
+    event.listen(engine, 'invalidate', lambda *args: count('invalidations'))
+
+
+def pool_stats(engine):
+    '''
+    Report the state of engine's connection pool
+      Parameters:
+        engine (Engine): the engine, e.g. db.engine
+      Returns:
+        A dict with the pool's current size, connections checked out
+        and overflow, and when it is a MeteredQueuePool the checkout
+        count, total and longest wait in seconds, timeouts, and
+        connections opened and invalidated
+    '''
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(),
+                     overflow=pool.overflow())
+    metrics = getattr(pool, 'metrics', None)
+    if metrics is not None:
+        stats.update(metrics.snapshot())
+    return stats
@@ -0,0 +1,112 @@
+import functools
+import random
+import time
+import sqlalchemy as sa
+from flask import current_app, has_request_context, session
+from flask_sqlalchemy.session import Session
+
+'''
+This file routes reads to read replicas.
+
+Replicas are configured with SQLALCHEMY_REPLICA_URIS (env
+db_replica_strings, comma separated) and become the binds replica0,
+replica1, ... next to the primary database. Model functions decorated
+with @replica_reads run their queries on a random replica, the same
+one until the transaction ends so that its reads agree with each
+other; everything else, and any write or flush, goes to the primary.
+
+Replicas lag behind the primary, so a user who just wrote keeps
+reading from the primary for REPLICA_READ_YOUR_WRITES seconds. The
+deadline is kept in the user's (signed) session cookie, so it holds
+whichever worker process serves the next request. Outside of a
+request there is no user to pin, so only the session's own unflushed
+or uncommitted writes keep reads on the primary.
+'''
+
+REPLICA_PREFIX = 'replica'
+# session cookie key holding the end of the read-your-writes window
+PIN_KEY = 'primary_until'
+
+
+def replica_key(index):
+    return '{}{}'.format(REPLICA_PREFIX, index)
+
+
+class RoutingSession(Session):
+    '''
+    Session sending the reads of @replica_reads functions to a replica
+    '''
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if isinstance(clause, sa.UpdateBase):
+            # a write through session.execute(), reads of this
+            # transaction must see it
+            self.info['primary_writes'] = True
+        elif (bind is None and self.info.get('replica_reads') and
+              not self._flushing and not self.info.get('primary_writes')):
+            replicas = [engine for key, engine in self._db.engines.items()
+                        if key and key.startswith(REPLICA_PREFIX)]
+            # pending changes would be invisible on a replica
+            if replicas and not (self.new or self.dirty or self.deleted):
+                if self.info.get('replica') is None:
+                    self.info['replica'] = random.choice(replicas)
+                return self.info['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+
+def _flushed(session, context):
+    session.info['primary_writes'] = True
+
+
+def _ended(session, *args):
+    session.info.pop('primary_writes', None)
+
+
+def _transaction_ended(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('replica', None)
+
+
+sa.event.listen(RoutingSession, 'after_flush', _flushed)
+sa.event.listen(RoutingSession, 'after_transaction_end', _transaction_ended)
+sa.event.listen(RoutingSession, 'after_commit', _ended)
+sa.event.listen(RoutingSession, 'after_rollback', _ended)
+
+
+def pinned_to_primary():
+    '''
+    True while the current request's user is in their read-your-writes
+    window
+    '''
+    return has_request_context() and session.get(PIN_KEY, 0) > time.time()
+
+
+def replica_reads(function):
+    '''
+    Decorator for read-only model functions, which may then be served
+    by a replica
+    '''
+    @functools.wraps(function)
+    def wrapped(*args, **kwargs):
+        if pinned_to_primary():
+            return function(*args, **kwargs)
+        info = current_app.extensions['sqlalchemy'].session().info
+        previous = info.get('replica_reads', False)
+        info['replica_reads'] = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            info['replica_reads'] = previous
+    return wrapped
+
+
+def note_write():
+    '''
+    Start the current user's read-your-writes window, call it after a
+    write made on their behalf
+    '''
+    if has_request_context() and current_app.config.get(
+            'SQLALCHEMY_REPLICA_URIS'):
+        session[PIN_KEY] = time.time() + current_app.config.get(
+            'REPLICA_READ_YOUR_WRITES', 5)
@@ -0,0 +1,280 @@
+import heapq
+import math
+import re
+import threading
+import time
+import sqlalchemy as sa
+from flask import current_app
+
+'''
+This file implements full-text search over listing titles and
+descriptions, with one of two backends:
+
+    fts5    SQLite built with FTS5: the listing_search virtual table
+            in the same database, written in the same transaction as
+            the listing itself.
+    memory  any other database: an inverted index kept in this
+            process, built from the listing table on the first search
+            and updated when this process commits listing changes.
+            Listings created by other processes are picked up by id on
+            every search; edits made by other processes show up when
+            the index is rebuilt, every SEARCH_INDEX_TTL seconds.
+
+Queries are split into words and a listing must contain all of them.
+Both backends rank with BM25, a word in the title counting
+SEARCH_TITLE_WEIGHT times as much as one in the description.
+
+Ranking every match of a word found in most listings costs time in
+proportion to the catalogue, and such a word says little about
+relevance anyway. So when more than SEARCH_RANK_CANDIDATES listings
+match, the in-process index only ranks the newest that many, and FTS5
+(whose bm25() reads every match to weigh the words) returns the newest
+listings with all the words in their title, then the newest others.
+'''
+
+FTS_TABLE = 'listing_search'
+WORD_REGEX = re.compile(r'\w+')
+# BM25 parameters, the defaults FTS5 uses as well
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return WORD_REGEX.findall(text.lower())
+
+
+def _use_fts5(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    options = {row[0] for row in connection.exec_driver_sql(
+        'PRAGMA compile_options')}
+    return 'ENABLE_FTS5' in options
+
+
+def search_backend(session):
+    '''
+    'fts5' or 'memory', decided once per app
+    '''
+    backend = current_app.extensions.get('qbnb_search_backend')
+    if backend is None:
+        backend = 'fts5' if _use_fts5(session.connection()) else 'memory'
+        current_app.extensions['qbnb_search_backend'] = backend
+    return backend
+
+
+def create_search_index(session):
+    '''
+    Create the FTS5 table and fill it from the listing table if it
+    did not exist yet. Nothing to do for the memory backend.
+    '''
+    if search_backend(session) != 'fts5':
+        return
+    exists = session.execute(sa.text(
+        "SELECT 1 FROM sqlite_master WHERE name = :name"),
+        {'name': FTS_TABLE}).first()
+    if exists is None:
+        session.execute(sa.text(
+            'CREATE VIRTUAL TABLE {} USING fts5(title, description)'
+            .format(FTS_TABLE)))
+        rebuild_search_index(session)
+
+
+def rebuild_search_index(session):
+    '''
+    Re-index every listing, e.g. after a migration or bulk load that
+    bypassed create_listing
+    '''
+    if search_backend(session) == 'fts5':
+        session.execute(sa.text('DELETE FROM ' + FTS_TABLE))
+        session.execute(sa.text(
+            'INSERT INTO {} (rowid, title, description) '
+            'SELECT id, title, description FROM listing'.format(FTS_TABLE)))
+    else:
+        current_app.extensions.pop('qbnb_search_index', None)
+
+
+def index_listing(session, listing_id, title, description):
+    '''
+    Add or replace a listing in the index as part of the session's
+    transaction
+    '''
+    if search_backend(session) == 'fts5':
+        session.execute(sa.text(
+            'DELETE FROM {} WHERE rowid = :id'.format(FTS_TABLE)),
+            {'id': listing_id})
+        session.execute(sa.text(
+            'INSERT INTO {} (rowid, title, description) '
+            'VALUES (:id, :title, :description)'.format(FTS_TABLE)),
+            {'id': listing_id, 'title': title, 'description': description})
+    else:
+        # applied once the transaction commits, see _apply_pending
+        session.info.setdefault('search_pending', []).append(
+            (listing_id, title, description))
+
+
+def search_listing_ids(session, query, limit=20):
+    '''
+    Find the listings matching every word of the query
+      Parameters:
+        session (Session): the database session
+        query (string): the words to look for
+        limit (integer): the most results returned
+      Returns:
+        The ids of the matching listings, best match first
+    '''
+    words = tokenize(query)
+    if not words or limit <= 0:
+        return []
+    weight = current_app.config.get('SEARCH_TITLE_WEIGHT', 10.0)
+    candidates = current_app.config.get('SEARCH_RANK_CANDIDATES', 2000)
+    if search_backend(session) == 'fts5':
+        return _fts5_search(session, words, limit, weight, candidates)
+    return _memory_index(session).search(words, limit, weight, candidates)
+
+
+def _fts5_search(session, words, limit, weight, candidates):
+    match = ' '.join('"{}"'.format(word) for word in words)
+
+    def newest(expression, count):
+        # walks the index in rowid order and stops at the LIMIT
+        return [row[0] for row in session.execute(sa.text(
+            'SELECT rowid FROM {0} WHERE {0} MATCH :match '
+            'ORDER BY rowid DESC LIMIT :count'.format(FTS_TABLE)),
+            {'match': expression, 'count': count})]
+
+    if len(newest(match, candidates + 1)) <= candidates:
+        return [row[0] for row in session.execute(sa.text(
+            'SELECT rowid FROM {0} WHERE {0} MATCH :match '
+            'ORDER BY bm25({0}, :weight, 1.0), rowid '
+            'LIMIT :limit'.format(FTS_TABLE)),
+            {'match': match, 'weight': weight, 'limit': limit})]
+    ids = newest('title : ({})'.format(match), limit)
+    if len(ids) < limit:
+        seen = set(ids)
+        ids += [i for i in newest(match, limit + len(ids))
+                if i not in seen][:limit - len(ids)]
+    return ids
+
+
+class InvertedIndex:
+    '''
+    In-process index: for every word, the listings containing it and
+    how often it occurs in their title and description
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        # listing id -> (title length, description length, words)
+        self.documents = {}
+        self.title_length = 0
+        self.description_length = 0
+        self.max_id = 0
+        self.built_at = time.monotonic()
+
+    def add(self, listing_id, title, description):
+        with self.lock:
+            self._remove(listing_id)
+            title_words = tokenize(title)
+            description_words = tokenize(description)
+            counts = {}
+            for word in title_words:
+                title_count, description_count = counts.get(word, (0, 0))
+                counts[word] = (title_count + 1, description_count)
+            for word in description_words:
+                title_count, description_count = counts.get(word, (0, 0))
+                counts[word] = (title_count, description_count + 1)
+            for word, frequencies in counts.items():
+                postings = self.postings.setdefault(word, {})
+                newer = postings and listing_id < next(reversed(postings))
+                postings[listing_id] = frequencies
+                if newer:
+                    # an updated listing goes back in its place,
+                    # search() relies on the postings being in id order
+                    self.postings[word] = dict(sorted(postings.items()))
+            self.documents[listing_id] = (len(title_words),
+                                          len(description_words),
+                                          tuple(counts))
+            self.title_length += len(title_words)
+            self.description_length += len(description_words)
+
+    def _remove(self, listing_id):
+        document = self.documents.pop(listing_id, None)
+        if document is None:
+            return
+        title_length, description_length, words = document
+        for word in words:
+            postings = self.postings[word]
+            del postings[listing_id]
+            if not postings:
+                del self.postings[word]
+        self.title_length -= title_length
+        self.description_length -= description_length
+
+    def search(self, words, limit, weight, candidates):
+        with self.lock:
+            lists = [self.postings.get(word) for word in set(words)]
+            if not all(lists):
+                return []
+            lists.sort(key=len)
+            count = len(self.documents)
+            average = (weight * self.title_length +
+                       self.description_length) / count
+            idf = [math.log(1 + (count - len(p) + 0.5) / (len(p) + 0.5))
+                   for p in lists]
+            scored = []
+            # walk the rarest word's listings, newest first, checking
+            # the others
+            for listing_id in reversed(lists[0]):
+                score = 0.0
+                title_length, description_length, _ = \
+                    self.documents[listing_id]
+                norm = K1 * (1 - B + B * (weight * title_length +
+                                          description_length) / average)
+                for postings, word_idf in zip(lists, idf):
+                    frequencies = postings.get(listing_id)
+                    if frequencies is None:
+                        break
+                    frequency = weight * frequencies[0] + frequencies[1]
+                    score += word_idf * frequency * (K1 + 1) / (
+                        frequency + norm)
+                else:
+                    scored.append((score, -listing_id))
+                    if len(scored) == candidates:
+                        break
+            return [-negated for _, negated in heapq.nlargest(limit, scored)]
+
+
+def _memory_index(session):
+    index = current_app.extensions.get('qbnb_search_index')
+    ttl = current_app.config.get('SEARCH_INDEX_TTL', 600)
+    if index is None or time.monotonic() - index.built_at > ttl:
+        index = InvertedIndex()
+        current_app.extensions['qbnb_search_index'] = index
+    # catch up with listings created since the last search
+    rows = session.execute(sa.text(
+        'SELECT id, title, description FROM listing WHERE id > :after '
+        'ORDER BY id'), {'after': index.max_id}).all()
+    for listing_id, title, description in rows:
+        index.add(listing_id, title, description)
+    if rows:
+        index.max_id = max(index.max_id, rows[-1][0])
+    return index
+
+
+def _apply_pending(session):
+    pending = session.info.pop('search_pending', None)
+    if pending:
+        index = current_app.extensions.get('qbnb_search_index')
+        # without an index yet, the first search builds it anyway
+        if index is not None:
+            for listing_id, title, description in pending:
+                index.add(listing_id, title, description)
+
+
+def _discard_pending(session, *args):
+    session.info.pop('search_pending', None)
+
+
+sa.event.listen(sa.orm.Session, 'after_commit', _apply_pending)
+sa.event.listen(sa.orm.Session, 'after_rollback', _discard_pending)
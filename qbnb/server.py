@@ -0,0 +1,227 @@
+import os
+import signal
+import socket
+import sys
+import time
+from werkzeug.serving import BaseWSGIServer
+
+'''
+This file defines the production server: a pre-forking WSGI server in
+the style of gunicorn's sync workers.
+
+The parent process loads the application once, binds the listening
+socket and forks the workers, which share that socket and each handle
+one request at a time. The parent only supervises:
+
+    SIGHUP           restart the workers gracefully, one by one: the
+                     next is told to stop once the replacement of
+                     the previous one is up, so all but one keep
+                     serving throughout
+    SIGTERM, SIGINT  stop the workers gracefully and exit
+
+A worker exits after finishing its current request when told to stop,
+and on its own after max_requests requests (recycling it bounds any
+slow leak); the parent replaces every worker that exits while the
+server is running. Services, such as the booking queue writer, are
+long running functions given a process of their own next to the
+workers, and are supervised the same way. POSIX only, since it relies
+on fork().
+'''
+
+# seconds a worker waits for a connection before checking its signals
+POLL_INTERVAL = 0.5
+# seconds workers get to finish their request when the server stops
+GRACEFUL_TIMEOUT = 30
+
+
+class _WorkerServer(BaseWSGIServer):
+
+    def __init__(self, host, port, app, fd):
+        super().__init__(host, port, app, fd=fd)
+        self.timeout = POLL_INTERVAL
+        self.handled = 0
+
+    def finish_request(self, request, client_address):
+        super().finish_request(request, client_address)
+        self.handled += 1
+
+
+def _child_signals(post_fork, slot, ready):
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    if post_fork is not None:
+        post_fork(slot)
+    # tell the parent this child is up, see _started()
+    os.write(ready, b'.')
+    os.close(ready)
+    return stopping
+
+
+def _run_worker(app, listener, max_requests, post_fork, worker_exit,
+                slot, ready):
+    stopping = _child_signals(post_fork, slot, ready)
+
+    host, port = listener.getsockname()[:2]
+    server = _WorkerServer(host, port, app, listener.fileno())
+    while not stopping:
+        # returns after one request, or after POLL_INTERVAL without one;
+        # a connection taken by a sibling worker is skipped because the
+        # shared socket is non-blocking
+        server.handle_request()
+        if max_requests and server.handled >= max_requests:
+            break
+    if worker_exit is not None:
+        worker_exit(slot)
+
+
+def _run_service(service, post_fork, ready):
+    stopping = _child_signals(post_fork, None, ready)
+    service(lambda: bool(stopping))
+
+
+def serve(app, host='0.0.0.0', port=8081, workers=2, max_requests=0,
+          post_fork=None, services=(), worker_exit=None):
+    '''
+    Run the application with pre-forked workers until stopped
+      Parameters:
+        app (Flask): the loaded WSGI application
+        host (string): address to listen on
+        port (integer): port to listen on
+        workers (integer): number of worker processes
+        max_requests (integer): requests a worker serves before it is
+            replaced, 0 to never recycle
+        post_fork (callable): called in every child right after the
+            fork, e.g. to drop database connections inherited from
+            the parent, with the worker's slot: 0 to workers - 1, the
+            same for a worker and the one that replaces it, or None
+            in a service's process
+        services (list): functions to run in processes of their own,
+            each called with a function that returns True once it
+            should return
+        worker_exit (callable): called in a worker with its slot when
+            it stops serving, before it exits
+    '''
+    # socket.create_server() is Python 3.8+
+    listener = socket.socket(
+        socket.AF_INET6 if ':' in host else socket.AF_INET)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(2048)
+    listener.setblocking(False)
+    # pid -> ('worker', slot) or ('service', index of the service)
+    children = {}
+    # pid -> read end of the pipe of a child that is not up yet
+    starting = {}
+    # children still to be restarted after a SIGHUP, and the one
+    # being restarted
+    restarts = []
+    state = {'running': True, 'restart': False, 'restarting': None}
+
+    def spawn(kind, index):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            os.close(ready_read)
+            try:
+                if kind == 'worker':
+                    _run_worker(app, listener, max_requests, post_fork,
+                                worker_exit, index, ready_write)
+                else:
+                    _run_service(services[index], post_fork, ready_write)
+            except Exception:
+                code = 1
+                sys.excepthook(*sys.exc_info())
+            finally:
+                os._exit(code)
+        os.close(ready_write)
+        os.set_blocking(ready_read, False)
+        children[pid] = (kind, index)
+        starting[pid] = ready_read
+
+    def shutdown(signum, frame):
+        state['running'] = False
+
+    def restart(signum, frame):
+        state['restart'] = True
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGHUP, restart)
+
+    print('Serving on http://{}:{} with {} workers'.format(
+        host, listener.getsockname()[1], workers), flush=True)
+    for slot in range(workers):
+        spawn('worker', slot)
+    for index in range(len(services)):
+        spawn('service', index)
+
+    while state['running']:
+        if state['restart']:
+            state['restart'] = False
+            restarts[:] = list(children)
+        _reap(children)
+        running = set(children.values())
+        for slot in range(workers):
+            if state['running'] and ('worker', slot) not in running:
+                spawn('worker', slot)
+        for index in range(len(services)):
+            if state['running'] and ('service', index) not in running:
+                spawn('service', index)
+        _started(starting)
+        # the child being restarted has exited and its replacement is
+        # up: the next one finishes its request and exits, and is
+        # replaced above, so the socket keeps being served
+        if restarts and state['restarting'] not in children and \
+                not starting:
+            state['restarting'] = restarts.pop(0)
+            _signal(state['restarting'], signal.SIGTERM)
+        time.sleep(0.1)
+
+    for pid in list(children):
+        _signal(pid, signal.SIGTERM)
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    while children and time.monotonic() < deadline:
+        _reap(children)
+        time.sleep(0.1)
+    for pid in list(children):
+        _signal(pid, signal.SIGKILL)
+    _reap(children, block=True)
+    _started(starting)
+    listener.close()
+
+
+def _signal(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def _started(starting):
+    # forget the children that are up, or that died before
+    for pid, ready in list(starting.items()):
+        try:
+            os.read(ready, 1)
+        except BlockingIOError:
+            continue
+        os.close(ready)
+        del starting[pid]
+
+
+def _reap(children, block=False):
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            children.clear()
+            return
+        if pid == 0:
+            return
+        children.pop(pid, None)
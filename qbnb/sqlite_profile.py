@@ -0,0 +1,70 @@
+from sqlalchemy import event
+
+'''
+This file tunes the connections of the SQLite backend, used when
+db_string is unset.
+
+SQLITE_PROFILE picks the pragmas run on every new connection:
+
+    wal      write-ahead logging: readers no longer block on a writer
+             (nor the writer on readers), and with synchronous=NORMAL
+             a commit appends to the log instead of fsyncing a
+             rollback journal, the log being synced at checkpoints.
+             A power cut can lose the last commits but never corrupts
+             the database. Also waits for locks instead of failing
+             at once, and memory maps the file and gives each
+             connection a larger page cache.
+    default  SQLite's own settings, nothing is run
+
+SQLITE_PRAGMAS can add to or override the profile's pragmas. WAL mode
+is stored in the database file, so switching a file back to the
+default profile also needs PRAGMA journal_mode=DELETE.
+'''
+
+PROFILES = {
+    'default': {},
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # milliseconds to wait for another connection's lock
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        # negative means KiB, i.e. 64 MiB
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def sqlite_pragmas(config):
+    '''
+    The pragmas for the configured SQLite profile
+      Parameters:
+        config (dict): the app config, read for SQLITE_PROFILE and
+            SQLITE_PRAGMAS
+      Returns:
+        A dict of pragma names and values
+    '''
+    profile = config.get('SQLITE_PROFILE', 'wal')
+    if profile not in PROFILES:
+        raise ValueError('unknown SQLITE_PROFILE {!r}, expected one of '
+                         '{}'.format(profile, ', '.join(PROFILES)))
+    return dict(PROFILES[profile], **config.get('SQLITE_PRAGMAS', {}))
+
+
+def apply_pragmas(engine, pragmas):
+    '''
+    Run the pragmas on every new connection of engine
+    '''
+    if not pragmas:
+        return
+    statements = ['PRAGMA {}={}'.format(name, value)
+                  for name, value in pragmas.items()]
+
+    def connected(dbapi_connection, record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    event.listen(engine, 'connect', connected)
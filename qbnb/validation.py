@@ -0,0 +1,155 @@
+import datetime
+import re
+
+'''
+This file defines the input validation rules shared by the models.
+Every pattern is compiled once at import time, so the hot paths
+(login in particular) only pay for the match itself.
+'''
+
+# R1-3: The email has to follow addr-spec defined in RFC 5322
+EMAIL_REGEX = re.compile(
+    r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*"
+    r"|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")"
+    r"@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]+)*"
+    r"|\[[\t -Z^-~]*])")
+
+# R1-4: Password has to meet the required complexity: minimum
+# length 6, at least one upper case, at least one lower case,
+# and at least one special character.
+PASSWORD_REGEX = re.compile(
+    r"^(?=.*[a-z])(?=.*[A-Z])(?=.*[-+_!@#$%^&*., ?])\S{6,}$")
+
+# R3-3: Postal code has to be a valid Canadian postal code.
+POSTAL_CODE_REGEX = re.compile(r"[a-zA-Z][0-9][a-zA-Z][0-9][a-zA-Z][0-9]")
+
+# R4-1: The title of the product has to be alphanumeric-only,
+# and space allowed only if it is not as prefix and suffix.
+TITLE_REGEX = re.compile(r"[a-zA-Z0-9]+(?: [a-zA-Z0-9]+)*")
+
+
+def valid_email(email):
+    return bool(email) and EMAIL_REGEX.match(email) is not None
+
+
+def valid_password(password):
+    return bool(password) and PASSWORD_REGEX.match(password) is not None
+
+
+def valid_username(name):
+    # R1-5: non-empty, alphanumeric-only, space allowed only if it is
+    # not the prefix or suffix.
+    # R1-6: longer than 2 characters and less than 20 characters.
+    # Checking the ends and then the whole name with the spaces taken
+    # out runs as two C-level string scans instead of a Python loop.
+    return (bool(name) and 2 < len(name) < 20 and
+            name[0] != ' ' and name[-1] != ' ' and
+            name.replace(' ', '').isalnum())
+
+
+def valid_postal_code(postal_code):
+    return bool(postal_code) and \
+        POSTAL_CODE_REGEX.match(postal_code) is not None
+
+
+def valid_title(title):
+    # R4-2: The title of the product is no longer than 80 characters.
+    return bool(title) and len(title) <= 80 and \
+        TITLE_REGEX.fullmatch(title) is not None
+
+
+def valid_listing_date(date):
+    # R4-6: last_modified_date must be after 2021-01-02
+    # and before 2025-01-02.
+    try:
+        # check that the date exists in the calender
+        datetime.datetime.strptime(date, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return False
+    # check that the year is between 2021 and 2025,
+    # if so check that its valid
+    if not 2021 <= int(date[:4]) <= 2025:
+        return False
+    if date[:4] == "2021" and date[5:7] == "01":
+        return date[8:10] != "01"
+    if date[:4] == "2025" and date[5:7] == "01":
+        return False
+    return True
+
+
+def validate_listing(title, description, price, date):
+    '''
+    Check a listing against R4-1 to R4-6
+      Parameters:
+        title (string):       title of the product
+        description (string): description of the product
+        price (integer):      price of the product
+        date (string):        last_modified_date, formatted YYYY-MM-DD
+      Returns:
+        None if the listing is valid otherwise the reason
+        it was rejected
+    '''
+    if not valid_title(title):
+        return 'invalid title'
+    # R4-3: description between 20 and 2000 characters
+    # R4-4: description longer than the title
+    if not description or len(description) < len(title) or \
+            not 20 <= len(description) <= 2000:
+        return 'invalid description'
+    # R4-5: Price has to be of range [10, 10000].
+    if not 10 <= price <= 10000:
+        return 'invalid price'
+    if not valid_listing_date(date):
+        return 'invalid date'
+    return None
+
+
+def validate_registration(name, email, password):
+    '''
+    Check a registration against R1-1 and R1-3 to R1-6
+      Parameters:
+        name (string):     user name
+        email (string):    user email
+        password (string): user password
+      Returns:
+        None if the registration is valid otherwise the reason
+        it was rejected
+    '''
+    # R1-1: Email cannot be empty. password cannot be empty.
+    if not email or not password:
+        return 'email and password are required'
+    if not valid_email(email):
+        return 'invalid email'
+    if not valid_password(password):
+        return 'invalid password'
+    if not valid_username(name):
+        return 'invalid username'
+    return None
+
+
+def validate_registrations(records):
+    '''
+    Check many registrations at once
+      Parameters:
+        records (iterable): (name, email, password) tuples
+      Returns:
+        A list with, for each record in order, None if it is valid
+        otherwise the reason it was rejected
+    '''
+    # bind the rules to locals once instead of per record
+    email_match = EMAIL_REGEX.match
+    password_match = PASSWORD_REGEX.match
+    username_ok = valid_username
+    reasons = []
+    for name, email, password in records:
+        if not email or not password:
+            reasons.append('email and password are required')
+        elif email_match(email) is None:
+            reasons.append('invalid email')
+        elif password_match(password) is None:
+            reasons.append('invalid password')
+        elif not username_ok(name):
+            reasons.append('invalid username')
+        else:
+            reasons.append(None)
+    return reasons
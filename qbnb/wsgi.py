@@ -0,0 +1,13 @@
+from qbnb import create_app
+
+'''
+This file is the WSGI entry point, for running qbnb under an external
+WSGI server, e.g.:
+
+    gunicorn --workers 4 --bind 0.0.0.0:8081 qbnb.wsgi:application
+
+The built-in equivalent is:  python -m qbnb serve --workers 4
+Create the tables first with:  python -m qbnb init-db
+'''
+
+application = create_app()
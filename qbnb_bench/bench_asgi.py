@@ -0,0 +1,170 @@
+'''
+Concurrent connections the async (ASGI) mode and the threaded WSGI
+mode each keep up with, one process apiece: uvicorn serving
+qbnb.asgi:application against werkzeug's thread-per-connection server
+serving qbnb.wsgi:application. 16, 64 and 256 clients each hold a
+connection open at all times, fetching the home page, a different
+page of the feed each time, and now and then booking a listing.
+Reports requests/sec, latency percentiles, failed requests and the
+peak resident memory of the server process.
+Needs:  pip install -r requirements-async.txt
+'''
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+PORT = 8098
+CONCURRENCY = [16, 64, 256]
+SECONDS = 5.0
+LISTINGS = 500
+PAGE_SIZE = 20
+# one request in this many is a booking
+BOOKING_EVERY = 10
+
+SERVERS = {
+    'wsgi threads': [sys.executable, '-c',
+                     'from werkzeug.serving import run_simple\n'
+                     'from qbnb.wsgi import application\n'
+                     'run_simple("127.0.0.1", {port}, application, '
+                     'threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', '--host', '127.0.0.1',
+             '--port', '{port}', '--log-level', 'warning',
+             '--no-access-log', 'qbnb.asgi:application'],
+}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def peak_rss(pid):
+    # VmHWM, the high water mark of the resident set, in KB
+    with open('/proc/{}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+
+def setup(environment):
+    os.environ.update(environment)
+    from qbnb import create_app
+    from qbnb.models import db, init_db, register, Listing
+    app = create_app()
+    with app.app_context():
+        init_db()
+        owner = register('bench owner', 'owner@bench.com', '123aB!')
+        db.session.execute(Listing.__table__.insert(), [
+            {'title': 'bench listing {:05d}'.format(i),
+             'description': 'A quiet flat near the park, number {}'.format(
+                 i), 'price': 10, 'last_modified_date': '2022-03-04',
+             'owner_id': owner.id} for i in range(LISTINGS)])
+        db.session.commit()
+        register('bench guest', 'guest@bench.com', '123aB!')
+    # the session cookie is signed with SECRET_KEY, valid for both
+    client = app.test_client()
+    client.post('/login', data={'email': 'guest@bench.com',
+                                'password': '123aB!'})
+    return 'session=' + client.get_cookie('session').value
+
+
+def request_bytes(cookie, index):
+    if index % BOOKING_EVERY == 0:
+        day = 1 + index // BOOKING_EVERY
+        body = urllib.parse.urlencode({
+            'user_email': 'guest@bench.com',
+            'listing_title': 'bench listing {:05d}'.format(
+                random.randrange(LISTINGS)),
+            'start_date': '2030-01-01', 'end_date': '2030-01-{:02d}'.format(
+                2 + day % 27)}).encode()
+        head = ('POST /create_booking HTTP/1.1\r\nContent-Type: '
+                'application/x-www-form-urlencoded\r\nContent-Length: '
+                '{}\r\n'.format(len(body)))
+    else:
+        body = b''
+        after = 'bench listing {:05d}'.format(
+            random.randrange(LISTINGS)).replace(' ', '+')
+        head = 'GET /?after={}&page_size={} HTTP/1.1\r\n'.format(
+            after, PAGE_SIZE)
+    return (head + 'Host: 127.0.0.1\r\nCookie: {}\r\nConnection: close'
+            '\r\n\r\n'.format(cookie)).encode() + body
+
+
+async def client(cookie, counter, latencies, errors, stop_at):
+    while time.monotonic() < stop_at:
+        counter[0] += 1
+        begin = time.perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                '127.0.0.1', PORT), 10)
+            writer.write(request_bytes(cookie, counter[0]))
+            response = await asyncio.wait_for(reader.read(), 30)
+            writer.close()
+            if response[9:12] not in (b'200', b'202'):
+                raise OSError(response[:12])
+            latencies.append(time.perf_counter() - begin)
+        except (OSError, asyncio.TimeoutError):
+            errors.append(1)
+
+
+async def load(cookie, clients):
+    counter, latencies, errors = [0], [], []
+    stop_at = time.monotonic() + SECONDS
+    await asyncio.gather(*[client(cookie, counter, latencies, errors,
+                                  stop_at) for _ in range(clients)])
+    return latencies, errors
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(name, clients, environment, cookie):
+    command = [part.format(port=PORT) for part in SERVERS[name]]
+    server = subprocess.Popen(command, env=environment,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(PORT)
+        latencies, errors = asyncio.run(load(cookie, clients))
+        rss = peak_rss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    print('{:<12} clients={:<4} {:6.0f} req/s  p50={:7.1f}ms  '
+          'p99={:7.1f}ms  errors={:<5} rss={:6.1f}MB'.format(
+              name, clients, len(latencies) / SECONDS,
+              percentile(latencies, 0.5) * 1000,
+              percentile(latencies, 0.99) * 1000, len(errors),
+              rss / 1024))
+
+
+def main():
+    environment = dict(os.environ)
+    environment['db_string'] = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'bench.sqlite')
+    environment['password_hash_iterations'] = '1000'
+    cookie = setup(environment)
+    for clients in CONCURRENCY:
+        for name in SERVERS:
+            run(name, clients, environment, cookie)
+
+
+if __name__ == '__main__':
+    main()
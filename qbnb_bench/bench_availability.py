@@ -0,0 +1,122 @@
+'''
+Availability search over 100k listings with 1M bookings, ten per
+listing spread over 2023 so that roughly a third of the nights are
+taken. Compares find_available_listings() with what answering the
+question took before it: loading the listings in the price range and
+running the create_booking overlap check on each one.
+'''
+import datetime
+import os
+import random
+import statistics
+import tempfile
+import time
+
+db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+os.environ['db_string'] = 'sqlite:///' + db_file
+
+from qbnb import app  # noqa: E402
+from qbnb.models import db, init_db, register, Listing, Booking  # noqa: E402
+from qbnb.models import find_available_listings  # noqa: E402
+from qbnb.models import find_overlapping_booking  # noqa: E402
+
+app.config['PASSWORD_HASH_ITERATIONS'] = 1000
+app.app_context().push()
+init_db()
+
+LISTINGS = 100000
+BOOKINGS_PER_LISTING = 10
+BATCH = 10000
+REPEAT = 50
+YEAR = datetime.date(2023, 1, 1)
+
+random.seed(11)
+
+
+def day(offset):
+    return (YEAR + datetime.timedelta(days=offset)).isoformat()
+
+
+def fill(owner_id):
+    for start in range(0, LISTINGS, BATCH):
+        db.session.execute(Listing.__table__.insert(), [
+            {'title': 'listing {}'.format(i), 'description': 'x' * 30,
+             'price': random.randint(10, 1000),
+             'last_modified_date': '2022-03-04', 'owner_id': owner_id}
+            for i in range(start, start + BATCH)])
+    # one stay in each tenth of the year, so they never overlap
+    segment = 365 // BOOKINGS_PER_LISTING
+    rows = []
+    for listing_id in range(1, LISTINGS + 1):
+        for part in range(BOOKINGS_PER_LISTING):
+            nights = random.randint(2, 20)
+            first = part * segment + random.randint(0, segment - nights)
+            rows.append({'user_id': owner_id, 'listing_id': listing_id,
+                         'start_date': day(first),
+                         'end_date': day(first + nights)})
+        if len(rows) >= BATCH:
+            db.session.execute(Booking.__table__.insert(), rows)
+            rows = []
+    db.session.commit()
+
+
+def before(start_date, end_date, min_price, max_price):
+    listings = Listing.query.filter(
+        Listing.price >= min_price, Listing.price <= max_price).all()
+    return [listing for listing in listings
+            if not find_overlapping_booking(listing.id, start_date,
+                                            end_date)]
+
+
+def timed(function, *args, repeat=REPEAT):
+    values = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        function(*args)
+        values.append(time.perf_counter() - begin)
+        db.session.remove()
+    values.sort()
+    return statistics.median(values) * 1000, \
+        values[int(len(values) * 0.99)] * 1000
+
+
+def walk(pages, *args):
+    after = None
+    for _ in range(pages):
+        _, after = find_available_listings(*args, after=after)
+        if after is None:
+            return
+
+
+def main():
+    owner = register('bench owner', 'owner@bench.com', '123aB!')
+    begin = time.perf_counter()
+    fill(owner.id)
+    db.session.execute(db.text('ANALYZE'))
+    db.session.commit()
+    print('{} listings, {} bookings loaded in {:.0f} s'.format(
+        LISTINGS, LISTINGS * BOOKINGS_PER_LISTING,
+        time.perf_counter() - begin))
+
+    # (label, nights, min price, max price)
+    cases = [('3 nights, any price', 3, 10, 1000),
+             ('3 nights, 100-150', 3, 100, 150),
+             ('2 weeks, any price', 14, 10, 1000),
+             ('2 weeks, 100-150', 14, 100, 150),
+             ('6 weeks, 100-150', 42, 100, 150)]
+    for label, nights, low, high in cases:
+        first = random.randint(0, 300)
+        dates = (day(first), day(first + nights))
+        free = len(before(*dates, low, high))
+        total = Listing.query.filter(Listing.price.between(low, high)).count()
+        page = timed(find_available_listings, *dates, low, high)
+        pages = timed(walk, 10, *dates, low, high, repeat=10)
+        scan = timed(before, *dates, low, high, repeat=3)
+        print('{:<20} free {:>6}/{:<6} first page {:6.2f}ms '
+              '(p99 {:6.2f}ms)  10 pages {:7.1f}ms  before {:8.0f}ms'
+              .format(label, free, total, page[0], page[1], pages[0],
+                      scan[0]))
+
+
+if __name__ == '__main__':
+    main()
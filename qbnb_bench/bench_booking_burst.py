@@ -0,0 +1,131 @@
+'''
+A promotion burst: hundreds of guests book the same listing within a
+fraction of a second, ten of them for each date slot. Compares booking
+inside the request (create_booking from many threads at once) with the
+booking queue (enqueue, then long-poll while the writer decides
+batches in a process of its own, as `python -m qbnb serve` runs it).
+
+Reports throughput, the latency from arrival to decision, and
+fairness: the share of slots won by the guest who asked first.
+'''
+import datetime
+import multiprocessing
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from qbnb import create_app
+from qbnb.models import db, init_db, register_many, create_listing, User
+from qbnb.models import Booking, create_booking
+from qbnb.booking_queue import enqueue_booking, get_booking_request
+from qbnb.booking_queue import run_booking_writer
+
+GUESTS = 200
+PER_SLOT = 10
+# seconds between two arrivals
+SPACING = 0.001
+PASSWORD = '123aB!'
+FIRST_NIGHT = datetime.date(2030, 1, 1)
+
+
+def make_app():
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                      'PASSWORD_HASH_ITERATIONS': 1000})
+    with app.app_context():
+        init_db()
+        register_many([('bench guest', 'guest{}@bench.com'.format(i),
+                        PASSWORD) for i in range(GUESTS + 1)])
+        db.session.execute(User.__table__.update().values(balance=10 ** 6))
+        db.session.commit()
+        create_listing('Promoted listing', 'the listing everyone wants', 10,
+                       '2022-03-04', 'guest{}@bench.com'.format(GUESTS))
+    return app
+
+
+def dates(guest):
+    start = FIRST_NIGHT + datetime.timedelta(days=3 * (guest // PER_SLOT))
+    return start.isoformat(), (start + datetime.timedelta(days=2)).isoformat()
+
+
+def direct(guest):
+    create_booking('guest{}@bench.com'.format(guest), 'Promoted listing',
+                   *dates(guest))
+
+
+def queued(guest):
+    token = enqueue_booking('guest{}@bench.com'.format(guest),
+                            'Promoted listing', *dates(guest))
+    get_booking_request(token, wait=60)
+
+
+def writer_process(app, stop):
+    with app.app_context():
+        # the parent's connections stay with the parent
+        db.engine.dispose(close=False)
+        run_booking_writer(stop.is_set)
+
+
+def burst(app, book):
+    # guests arrive in a shuffled order, so slot and arrival differ
+    order = sorted(range(GUESTS), key=lambda guest: (guest * 7919) % GUESTS)
+    arrived = {}
+    finished = {}
+    start = time.perf_counter() + 0.5
+
+    def guest_thread(position, guest):
+        with app.app_context():
+            time.sleep(max(0, start + position * SPACING -
+                           time.perf_counter()))
+            arrived[guest] = time.perf_counter()
+            book(guest)
+            finished[guest] = time.perf_counter()
+            db.session.remove()
+
+    threads = [threading.Thread(target=guest_thread, args=(position, guest))
+               for position, guest in enumerate(order)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        winners = {}
+        for booking in Booking.query.all():
+            guest = int(booking.user.email[5:].split('@')[0])
+            winners[guest // PER_SLOT] = guest
+    first = {}
+    for guest in order:
+        first.setdefault(guest // PER_SLOT, guest)
+    latencies = sorted(finished[g] - arrived[g] for g in range(GUESTS))
+    elapsed = max(finished.values()) - min(arrived.values())
+    slots = GUESTS // PER_SLOT
+    return {'throughput': GUESTS / elapsed,
+            'median': statistics.median(latencies) * 1000,
+            'p99': latencies[int(GUESTS * 0.99)] * 1000,
+            'booked': len(winners), 'slots': slots,
+            'fair': sum(winners.get(s) == first[s] for s in range(slots))}
+
+
+def main():
+    context = multiprocessing.get_context('fork')
+    for label in ('direct', 'queued'):
+        app = make_app()
+        stop = context.Event()
+        writer = None
+        if label == 'queued':
+            writer = context.Process(target=writer_process, args=(app, stop))
+            writer.start()
+        result = burst(app, direct if label == 'direct' else queued)
+        if writer is not None:
+            stop.set()
+            writer.join()
+        print('{:<7} {throughput:6.0f} req/s  median={median:7.1f}ms '
+              'p99={p99:7.1f}ms  slots booked {booked}/{slots}  '
+              'won by the first guest {fair}/{slots}'.format(label, **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Measures the create_booking overlap check as a listing's booking
+history grows from 10 to 100k rows. The indexed lookup should stay
+flat while the old load-everything-and-scan approach grows linearly.
+'''
+import os
+import tempfile
+import time
+import datetime
+
+db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+os.environ['db_string'] = 'sqlite:///' + db_file
+
+from qbnb import app  # noqa: E402
+from qbnb.models import db, Booking, find_overlapping_booking  # noqa: E402
+from qbnb.models import init_db  # noqa: E402
+
+app.app_context().push()
+init_db()
+
+SIZES = [10, 100, 1000, 10000, 100000]
+REPEAT = 200
+
+
+def fill(listing_id, count):
+    # back to back two night stays starting 2000-01-01
+    day = datetime.date(2000, 1, 1)
+    rows = []
+    for i in range(count):
+        start = day + datetime.timedelta(days=2 * i)
+        end = start + datetime.timedelta(days=2)
+        rows.append({'user_id': i + 1,
+                     'listing_id': listing_id,
+                     'start_date': start.isoformat(),
+                     'end_date': end.isoformat()})
+    db.session.execute(Booking.__table__.insert(), rows)
+    db.session.commit()
+    return (day + datetime.timedelta(days=count)).isoformat()
+
+
+def linear_scan(listing_id, start_date, end_date):
+    # the pre-index implementation, kept here for comparison
+    for i in Booking.query.filter_by(listing_id=listing_id).all():
+        if i.start_date < end_date and i.end_date > start_date:
+            return i
+    return None
+
+
+def timed(check, *args):
+    begin = time.perf_counter()
+    for _ in range(REPEAT):
+        check(*args)
+    return (time.perf_counter() - begin) / REPEAT * 1e6
+
+
+def main():
+    for size in SIZES:
+        listing_id = size
+        middle = fill(listing_id, size)
+        end = (datetime.date.fromisoformat(middle) +
+               datetime.timedelta(days=1)).isoformat()
+        indexed = timed(find_overlapping_booking, listing_id, middle, end)
+        scan = timed(linear_scan, listing_id, middle, end) \
+            if size <= 10000 else float('nan')
+        db.session.expunge_all()
+        print('bookings={:>6}  indexed={:8.1f}us  scan={:10.1f}us'.format(
+            size, indexed, scan))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Bytes on the wire and server CPU per request for the home page with
+20 and 100 listings: sent plain, gzipped, with brotli when the module
+is installed, and revalidated with If-None-Match (a 304). Requests go
+through the test client, so the CPU time is the app's own, without a
+socket in the way.
+'''
+import os
+import statistics
+import tempfile
+import time
+
+from qbnb import create_app
+from qbnb.compression import encodings
+from qbnb.models import db, init_db, register, Listing
+
+LISTINGS = 1000
+PAGE_SIZES = [20, 100]
+REQUESTS = 300
+
+
+def wire_bytes(response):
+    # status line, headers and body as HTTP/1.1 would send them
+    head = 'HTTP/1.1 {}\r\n'.format(response.status) + ''.join(
+        '{}: {}\r\n'.format(name, value)
+        for name, value in response.headers.items()) + '\r\n'
+    return len(head.encode()) + len(response.data)
+
+
+def fill(owner_id):
+    rows = [{'title': 'bench listing {:05d}'.format(i),
+             'description': 'A quiet flat near the park, number {}, with a '
+                            'kitchen, two bedrooms and a balcony over the '
+                            'garden.'.format(i),
+             'price': 100 + i % 900, 'last_modified_date': '2022-03-04',
+             'owner_id': owner_id} for i in range(LISTINGS)]
+    db.session.execute(Listing.__table__.insert(), rows)
+    db.session.commit()
+
+
+def measure(client, path, headers):
+    timings = []
+    for _ in range(REQUESTS):
+        begin = time.process_time()
+        response = client.get(path, headers=headers)
+        timings.append(time.process_time() - begin)
+    return response, statistics.mean(timings)
+
+
+def main():
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                      'PASSWORD_HASH_ITERATIONS': 1000})
+    with app.app_context():
+        init_db()
+        owner = register('bench owner', 'owner@bench.com', '123aB!')
+        fill(owner.id)
+    client = app.test_client()
+    client.post('/login', data={'email': 'owner@bench.com',
+                                'password': '123aB!'})
+
+    for page_size in PAGE_SIZES:
+        path = '/?page_size={}'.format(page_size)
+        print('home page, {} listings'.format(page_size))
+        for coding in ('identity',) + encodings():
+            headers = {'Accept-Encoding': coding}
+            response, cpu = measure(client, path, headers)
+            print('  {:<9} {:7d} bytes  {:5.2f} ms cpu'.format(
+                coding, wire_bytes(response), cpu * 1000))
+            headers['If-None-Match'] = response.headers['ETag']
+            response, cpu = measure(client, path, headers)
+            assert response.status_code == 304
+            print('  {:<9} {:7d} bytes  {:5.2f} ms cpu'.format(
+                '304', wire_bytes(response), cpu * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+'''
+Booking throughput on a popular host: writer threads book different
+listings of the same owner at once, with the ledger (create_booking)
+and with the balances updated in place as before the ledger (kept here
+for comparison). Then the cost of reading that host's balance as
+their ledger grows, with and without a snapshot.
+'''
+import datetime
+import os
+import tempfile
+import threading
+import time
+
+from qbnb import create_app
+from qbnb.models import db, init_db, register_many, User, Listing, Booking
+from qbnb.models import LedgerEntry, create_booking, lock_for_write
+from qbnb.models import find_overlapping_booking, get_balance
+from qbnb.models import parse_booking_dates
+from qbnb.ledger import take_snapshots
+from sqlalchemy.orm import aliased
+
+THREADS = [1, 4, 8]
+LISTINGS = 64
+SECONDS = 5.0
+ENTRIES = [1000, 10000, 100000]
+REPEAT = 200
+PASSWORD = '123aB!'
+FIRST_NIGHT = datetime.date(2030, 1, 1)
+
+
+def in_place_booking(user_email, listing_title, start_date, end_date):
+    # create_booking before the ledger: owner and guest rows locked
+    # and updated
+    start_date, end_date = parse_booking_dates(start_date, end_date)
+    lock_for_write()
+    owner = aliased(User)
+    guest = aliased(User)
+    row = db.session.query(Listing, owner, guest).join(
+        owner, owner.id == Listing.owner_id
+    ).join(guest, guest.email == user_email).filter(
+        Listing.title == listing_title).with_for_update().first()
+    listing, owner, user = row
+    if (owner.id == user.id or user.balance < listing.price or
+            find_overlapping_booking(listing.id, start_date, end_date)):
+        db.session.rollback()
+        return None
+    booking = Booking(user_id=user.id, listing_id=listing.id,
+                      start_date=start_date, end_date=end_date)
+    owner.balance += listing.price
+    user.balance -= listing.price
+    db.session.add(booking)
+    db.session.commit()
+    return booking
+
+
+def make_app(threads):
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                      'PASSWORD_HASH_ITERATIONS': 1000})
+    with app.app_context():
+        init_db()
+        register_many([('bench user', 'user{}@bench.com'.format(i),
+                        PASSWORD) for i in range(threads + 1)])
+        db.session.execute(User.__table__.update().values(balance=10 ** 9))
+        host = User.query.filter_by(email='user0@bench.com').one()
+        db.session.execute(Listing.__table__.insert(), [
+            {'title': 'Host listing {}'.format(i), 'description': 'x' * 30,
+             'price': 10, 'last_modified_date': '2022-03-04',
+             'owner_id': host.id} for i in range(LISTINGS)])
+        db.session.commit()
+    return app
+
+
+def writer(app, number, book, latencies, stop_at):
+    with app.app_context():
+        count = 0
+        while time.monotonic() < stop_at:
+            count += 1
+            # a fresh night on one of the host's listings
+            start = FIRST_NIGHT + datetime.timedelta(days=count)
+            begin = time.perf_counter()
+            book('user{}@bench.com'.format(number),
+                 'Host listing {}'.format((number * 7 + count) % LISTINGS),
+                 start.isoformat(),
+                 (start + datetime.timedelta(days=1)).isoformat())
+            latencies.append(time.perf_counter() - begin)
+            db.session.remove()
+
+
+def throughput(threads, book):
+    app = make_app(threads)
+    latencies = []
+    stop_at = time.monotonic() + SECONDS
+    workers = [threading.Thread(target=writer,
+                                args=(app, number + 1, book, latencies,
+                                      stop_at))
+               for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    latencies.sort()
+    return (len(latencies) / SECONDS,
+            latencies[int(len(latencies) * 0.99)] * 1000)
+
+
+def balance_reads():
+    app = make_app(1)
+    with app.app_context():
+        host = User.query.filter_by(email='user0@bench.com').one()
+        written = 0
+        for size in ENTRIES:
+            db.session.execute(LedgerEntry.__table__.insert(), [
+                {'user_id': host.id, 'amount': 10, 'created_at': 0}
+                for _ in range(size - written)])
+            db.session.commit()
+            written = size
+            timings = []
+            for snapshot in (False, True):
+                if snapshot:
+                    take_snapshots(settle=0)
+                begin = time.perf_counter()
+                for _ in range(REPEAT):
+                    get_balance(host.id)
+                timings.append((time.perf_counter() - begin) / REPEAT * 1e6)
+            print('host entries={:>6}  balance read: no snapshot {:8.1f}us'
+                  '  snapshot {:6.1f}us'.format(size, *timings))
+            # the next size starts without a snapshot again
+            db.session.execute(db.text('DELETE FROM balance_snapshot'))
+            db.session.commit()
+
+
+def main():
+    for threads in THREADS:
+        for label, book in (('in place', in_place_booking),
+                            ('ledger', create_booking)):
+            rate, p99 = throughput(threads, book)
+            print('threads={} {:<8} {:6.0f} bookings/s  p99={:6.1f}ms'.format(
+                threads, label, rate, p99))
+    balance_reads()
+
+
+if __name__ == '__main__':
+    main()
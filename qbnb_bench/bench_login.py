@@ -0,0 +1,46 @@
+'''
+Reports logins per second for a range of password hashing work
+factors, with the verification cache off and on.
+'''
+import os
+import tempfile
+import time
+
+db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+os.environ['db_string'] = 'sqlite:///' + db_file
+
+from qbnb import app  # noqa: E402
+from qbnb.models import init_db, register, login  # noqa: E402
+
+app.app_context().push()
+init_db()
+
+COSTS = [10000, 100000, 260000, 600000]
+SECONDS = 2.0
+
+
+def logins_per_second(email, password):
+    count = 0
+    begin = time.perf_counter()
+    while time.perf_counter() - begin < SECONDS:
+        assert login(email, password) is not None
+        count += 1
+    return count / (time.perf_counter() - begin)
+
+
+def main():
+    for cost in COSTS:
+        app.config['PASSWORD_HASH_ITERATIONS'] = cost
+        email = 'bench{}@bench.com'.format(cost)
+        register('bench user', email, '123aB!')
+        results = []
+        for cache_size in (0, 1024):
+            app.config['PASSWORD_VERIFY_CACHE_SIZE'] = cache_size
+            app.extensions.pop('qbnb_password_cache', None)
+            results.append(logins_per_second(email, '123aB!'))
+        print('iterations={:>7}  no cache={:8.1f}/s  cache={:8.1f}/s'.format(
+            cost, *results))
+
+
+if __name__ == '__main__':
+    main()
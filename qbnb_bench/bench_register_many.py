@@ -0,0 +1,48 @@
+'''
+Compares account import throughput: register in a loop against
+register_many, at a cheap and at the default password work factor.
+'''
+import os
+import sys
+import tempfile
+import time
+
+db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+os.environ['db_string'] = 'sqlite:///' + db_file
+
+from qbnb import app  # noqa: E402
+from qbnb.models import init_db, register, register_many  # noqa: E402
+
+app.app_context().push()
+init_db()
+
+# (work factor, accounts) pairs: a near-free hash isolates the database
+# path, the default cost is slow on purpose and scales with CPU cores
+RUNS = [(1, 5000), (1000, 2000), (260000, 200)]
+
+
+def records(prefix, count):
+    return [('import user', '{}{}@bench.com'.format(prefix, i), '123aB!')
+            for i in range(count)]
+
+
+def main():
+    for cost, count in RUNS:
+        app.config['PASSWORD_HASH_ITERATIONS'] = cost
+
+        begin = time.perf_counter()
+        for name, email, password in records('loop{}-'.format(cost), count):
+            register(name, email, password)
+        loop = count / (time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        assert register_many(records('bulk{}-'.format(cost), count)) == []
+        bulk = count / (time.perf_counter() - begin)
+
+        print('iterations={:>6}  register={:8.0f}/s  register_many={:8.0f}/s'
+              '  ({:.0f}x)'.format(cost, loop, bulk, bulk / loop))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+'''
+Search latency over a synthetic corpus of a million listings on the
+FTS5 backend, and of 100k listings on the in-process index (which
+keeps every posting in Python objects, so a million listings would
+need several GB). Words follow a Zipf distribution, so queries range
+from rare words to ones found in a large share of the listings.
+'''
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from qbnb import create_app
+from qbnb.models import db, init_db, register, search_listings, Listing
+from qbnb.search import rebuild_search_index
+
+CORPUS = {'fts5': 1000000, 'memory': 100000}
+VOCABULARY = 20000
+QUERIES = 200
+BATCH = 10000
+
+random.seed(7)
+WORDS = ['w{}x'.format(rank) for rank in range(VOCABULARY)]
+CUMULATIVE_WEIGHTS = list(itertools.accumulate(
+    1.0 / (rank + 1) for rank in range(VOCABULARY)))
+
+
+def sentence(count):
+    return ' '.join(random.choices(WORDS, cum_weights=CUMULATIVE_WEIGHTS,
+                                   k=count))
+
+
+def fill(size, owner_id):
+    for start in range(0, size, BATCH):
+        rows = [{'title': 'listing {} {}'.format(i, sentence(3)),
+                 'description': sentence(random.randint(15, 30)),
+                 'price': 100, 'last_modified_date': '2022-03-04',
+                 'owner_id': owner_id}
+                for i in range(start, min(start + BATCH, size))]
+        db.session.execute(Listing.__table__.insert(), rows)
+    db.session.commit()
+
+
+def queries():
+    # (label, words drawn from this rank range, number of words)
+    kinds = [('rare word', (5000, 20000), 1),
+             ('mid word', (100, 1000), 1),
+             ('common word', (0, 10), 1),
+             ('two words', (0, 1000), 2)]
+    return [(label, ' '.join(WORDS[random.randrange(*ranks)]
+                             for _ in range(words)))
+            for label, ranks, words in kinds for _ in range(QUERIES)]
+
+
+def measure(backend, size):
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                      'PASSWORD_HASH_ITERATIONS': 1000})
+    with app.app_context():
+        app.extensions['qbnb_search_backend'] = backend
+        init_db()
+        owner = register('bench owner', 'owner@bench.com', '123aB!')
+        begin = time.perf_counter()
+        fill(size, owner.id)
+        rebuild_search_index(db.session)
+        db.session.commit()
+        # the first search builds the in-process index
+        search_listings(WORDS[0])
+        print('{} {} listings indexed in {:.0f} s'.format(
+            backend, size, time.perf_counter() - begin))
+
+        timings = {}
+        for label, query in queries():
+            begin = time.perf_counter()
+            search_listings(query, 20)
+            timings.setdefault(label, []).append(
+                time.perf_counter() - begin)
+            db.session.remove()
+        for label, values in timings.items():
+            values.sort()
+            print('  {:<12} median={:6.2f}ms p99={:6.2f}ms'.format(
+                label, statistics.median(values) * 1000,
+                values[int(len(values) * 0.99)] * 1000))
+
+
+def main():
+    for backend in sys.argv[1:] or CORPUS:
+        measure(backend, CORPUS[backend])
+
+
+if __name__ == '__main__':
+    main()
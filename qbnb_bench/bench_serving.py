@@ -0,0 +1,89 @@
+'''
+Load test for the production server: starts python -m qbnb serve with
+1, 2 and 4 workers and reports requests/sec and latency percentiles
+for concurrent clients fetching the login page.
+'''
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PORT = 8097
+WORKER_COUNTS = [1, 2, 4]
+CLIENTS = 16
+SECONDS = 5.0
+PATH = '/login'
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def client(latencies, errors, stop_at):
+    while time.monotonic() < stop_at:
+        begin = time.perf_counter()
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', PORT, 10)
+            connection.request('GET', PATH)
+            connection.getresponse().read()
+            connection.close()
+            latencies.append(time.perf_counter() - begin)
+        except OSError:
+            errors.append(1)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(workers, environment):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'qbnb', 'serve', '--host', '127.0.0.1',
+         '--port', str(PORT), '--workers', str(workers)],
+        env=environment, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(PORT)
+        latencies, errors = [], []
+        stop_at = time.monotonic() + SECONDS
+        threads = [threading.Thread(target=client,
+                                    args=(latencies, errors, stop_at))
+                   for _ in range(CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies.sort()
+    print('workers={}  {:7.0f} req/s  p50={:6.1f}ms  p99={:6.1f}ms  '
+          'errors={}'.format(workers, len(latencies) / SECONDS,
+                             percentile(latencies, 0.5) * 1000,
+                             percentile(latencies, 0.99) * 1000,
+                             len(errors)))
+
+
+def main():
+    environment = dict(os.environ)
+    environment['db_string'] = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'bench.sqlite')
+    subprocess.run([sys.executable, '-m', 'qbnb', 'init-db'],
+                   env=environment, check=True, stdout=subprocess.DEVNULL)
+    for workers in WORKER_COUNTS:
+        run(workers, environment)
+
+
+if __name__ == '__main__':
+    main()
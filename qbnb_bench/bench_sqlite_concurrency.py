@@ -0,0 +1,120 @@
+'''
+Concurrent read/write load on the SQLite backend with the default and
+the wal profile: reader threads log in while writer threads create
+listings and bookings. Reports operations per second, p99 latency and
+errors (e.g. "database is locked") for each side.
+'''
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+
+from qbnb import create_app
+from qbnb.models import db, init_db, User, Listing
+from qbnb.models import register_many, login
+from qbnb.models import create_listing, create_booking
+
+USERS = 200
+# (reader threads, writer threads)
+MIXES = [(0, 2), (4, 0), (4, 2)]
+SECONDS = 5.0
+PASSWORD = '123aB!'
+FIRST_NIGHT = datetime.date(2030, 1, 1)
+
+
+def seed():
+    register_many([('bench user', 'user{}@bench.com'.format(i), PASSWORD)
+                   for i in range(USERS)])
+    # enough money for every booking the run can make
+    db.session.execute(User.__table__.update().values(balance=10 ** 9))
+    db.session.commit()
+    for i in range(USERS):
+        create_listing('Seed listing {}'.format(i),
+                       'a listing made for the benchmark', 10,
+                       '2022-03-04', 'user{}@bench.com'.format(i))
+
+
+def reader(stats, stop_at):
+    while time.monotonic() < stop_at:
+        email = 'user{}@bench.com'.format(random.randrange(USERS))
+        begin = time.perf_counter()
+        try:
+            assert login(email, PASSWORD) is not None
+            stats['latencies'].append(time.perf_counter() - begin)
+        except Exception:
+            stats['errors'] += 1
+        # end the transaction as a request would
+        db.session.remove()
+
+
+def writer(number, stats, stop_at):
+    count = 0
+    while time.monotonic() < stop_at:
+        count += 1
+        begin = time.perf_counter()
+        try:
+            if count % 2:
+                create_listing('Writer {} listing {}'.format(number, count),
+                               'a listing made for the benchmark', 10,
+                               '2022-03-04', 'user0@bench.com')
+            else:
+                # a fresh night per booking so none is rejected
+                start = FIRST_NIGHT + datetime.timedelta(
+                    days=100000 * number + count)
+                end = start + datetime.timedelta(days=1)
+                create_booking('user1@bench.com', 'Seed listing 2',
+                               start.isoformat(), end.isoformat())
+            stats['latencies'].append(time.perf_counter() - begin)
+        except Exception:
+            stats['errors'] += 1
+        db.session.remove()
+
+
+def threads_for(app, target, args_list):
+    def in_context(*args):
+        with app.app_context():
+            target(*args)
+
+    return [threading.Thread(target=in_context, args=args)
+            for args in args_list]
+
+
+def report(name, stats):
+    latencies = sorted(stats['latencies'])
+    p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+    return '{} {:7.0f}/s p99={:6.1f}ms errors={}'.format(
+        name, len(latencies) / SECONDS, p99 * 1000, stats['errors'])
+
+
+def main():
+    for profile in ('default', 'wal'):
+        db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                          'SQLITE_PROFILE': profile,
+                          'PASSWORD_HASH_ITERATIONS': 1000,
+                          'USER_CACHE_SIZE': 0})
+        with app.app_context():
+            init_db()
+            seed()
+            assert Listing.query.count() == USERS
+        for readers, writers in MIXES:
+            stop_at = time.monotonic() + SECONDS
+            read_stats = {'latencies': [], 'errors': 0}
+            write_stats = {'latencies': [], 'errors': 0}
+            threads = threads_for(app, reader,
+                                  [(read_stats, stop_at)] * readers)
+            threads += threads_for(app, writer, [(i, write_stats, stop_at)
+                                                 for i in range(writers)])
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            print('{:<8} R={} W={}  {}  {}'.format(
+                profile, readers, writers, report('logins', read_stats),
+                report('writes', write_stats)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''
+Measures cold start in fresh interpreters: importing qbnb, building the
+app with create_app(), serving the first request through the test
+client, and the wall time of python -m qbnb --help. Reports the median
+of several runs.
+'''
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RUNS = 9
+
+# prints milliseconds since start after each stage
+PROBE = '''
+import time
+begin = time.perf_counter()
+import qbnb
+imported = time.perf_counter()
+app = qbnb.create_app()
+built = time.perf_counter()
+assert app.test_client().get('/login').status_code == 200
+served = time.perf_counter()
+print(*[(t - begin) * 1000 for t in (imported, built, served)])
+'''
+
+
+def main():
+    environment = dict(os.environ)
+    environment['db_string'] = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'bench.sqlite')
+    stages = []
+    cli = []
+    for _ in range(RUNS):
+        output = subprocess.run([sys.executable, '-c', PROBE],
+                                env=environment, check=True,
+                                capture_output=True, text=True).stdout
+        stages.append([float(value) for value in output.split()])
+        begin = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'qbnb', '--help'],
+                       env=environment, check=True,
+                       stdout=subprocess.DEVNULL)
+        cli.append((time.perf_counter() - begin) * 1000)
+    names = ['import qbnb', 'create_app()', 'first request']
+    for index, name in enumerate(names):
+        print('{:<16}{:7.1f} ms'.format(
+            name, statistics.median(run[index] for run in stages)))
+    print('{:<16}{:7.1f} ms'.format('cli --help', statistics.median(cli)))
+
+
+if __name__ == '__main__':
+    main()
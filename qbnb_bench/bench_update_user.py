@@ -0,0 +1,66 @@
+'''
+Compares profile update throughput: the old one-commit-per-field
+update_user, the single-commit update_user, and batched update_users.
+'''
+import os
+import tempfile
+import time
+
+db_file = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+os.environ['db_string'] = 'sqlite:///' + db_file
+
+from qbnb import app  # noqa: E402
+from qbnb.models import db, User, update_user, update_users  # noqa: E402
+from qbnb.models import init_db  # noqa: E402
+
+app.app_context().push()
+init_db()
+
+USERS = 1000
+
+
+def per_field_commits(old_email, username, billing_address, postal_code):
+    # what update_user used to do: one commit per changed field
+    user = User.query.filter_by(email=old_email).first()
+    user.postal_code = postal_code
+    db.session.commit()
+    user.username = username
+    db.session.commit()
+    user.billing_address = billing_address
+    db.session.commit()
+
+
+def report(name, updates, seconds, commits):
+    print('{:<22} {:8.0f} updates/s  {:8.0f} commits/s'.format(
+        name, updates / seconds, commits / seconds))
+
+
+def main():
+    db.session.execute(User.__table__.insert(), [
+        {'email': 'bench{}@bench.com'.format(i), 'password': 'x',
+         'username': 'bench', 'billing_address': '', 'postal_code': '',
+         'balance': 100} for i in range(USERS)])
+    db.session.commit()
+    emails = ['bench{}@bench.com'.format(i) for i in range(USERS)]
+
+    begin = time.perf_counter()
+    for email in emails:
+        per_field_commits(email, 'bench one', '1 Road', 'A1A1A1')
+    report('commit per field', USERS, time.perf_counter() - begin,
+           USERS * 3)
+
+    begin = time.perf_counter()
+    for email in emails:
+        update_user(email, 'bench two', '', '2 Road', 'B2B2B2')
+    report('update_user', USERS, time.perf_counter() - begin, USERS)
+
+    for batch_size in (100, 1000):
+        begin = time.perf_counter()
+        update_users([(email, 'bench three', '', '3 Road', 'C3C3C3')
+                      for email in emails], batch_size=batch_size)
+        report('update_users({})'.format(batch_size), USERS,
+               time.perf_counter() - begin, USERS // batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Compares the per-call cost of input validation before and after the
+shared validation engine: re.compile + re.match per call against
+precompiled patterns, the per-character username loop against the
+fast path, and one-at-a-time against batch validation.
+'''
+import re
+import timeit
+
+from qbnb.validation import valid_email, valid_password, valid_username
+from qbnb.validation import validate_registration, validate_registrations
+
+EMAIL = 'somebody@example.com'
+PASSWORD = '123aB!xyz'
+NAME = 'some user 123'
+NUMBER = 100000
+
+
+def old_login_checks(email, password):
+    # what login did on every call before
+    email_regex = re.compile(r"([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+/-9=?A-Z^-~]\
+    +)*|\"([]!#-[^-~ \t]|(\\[\t -~]))+\")@([-!#-'*+/-9=?A-Z^-~]+(\.[-!#-'*+\
+    /-9=?A-Z^-~]+)*|\[[\t -Z^-~]*])")
+    password_regex = re.compile(r"^(?=.*[a-z])(?=.*[A-Z])(?=.*[-+_\
+    !@#$%^&*., ?])\S{6,}$")
+    if not re.match(email_regex, email):
+        return False
+    if not re.match(password_regex, password):
+        return False
+    return True
+
+
+def new_login_checks(email, password):
+    return valid_email(email) and valid_password(password)
+
+
+def old_username(name):
+    user_list = list(name)
+    if ((len(name) <= 2) or (len(name) >= 20)):
+        return False
+    valid_name = True
+    for i in range(len(user_list)):
+        if (i == 0) or (i == len(user_list) - 1):
+            if (user_list[i].isalnum() is False):
+                valid_name = False
+        else:
+            if (user_list[i].isalnum() is not True) and (user_list[i] != ' '):
+                valid_name = False
+    return valid_name
+
+
+def per_call(func, *args):
+    seconds = timeit.timeit(lambda: func(*args), number=NUMBER)
+    return seconds / NUMBER * 1e9
+
+
+def main():
+    print('login checks     old={:7.0f}ns  new={:7.0f}ns'.format(
+        per_call(old_login_checks, EMAIL, PASSWORD),
+        per_call(new_login_checks, EMAIL, PASSWORD)))
+    print('username check   old={:7.0f}ns  new={:7.0f}ns'.format(
+        per_call(old_username, NAME),
+        per_call(valid_username, NAME)))
+
+    records = [(NAME, str(i) + EMAIL, PASSWORD) for i in range(10000)]
+    single = timeit.timeit(
+        lambda: [validate_registration(*r) for r in records], number=10)
+    batch = timeit.timeit(
+        lambda: validate_registrations(records), number=10)
+    print('10k registrations one-by-one={:6.1f}ms  batch={:6.1f}ms'.format(
+        single * 100, batch * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+from qbnb import app
+from qbnb.models import register, db, User
+
+'''
+This file tests the JSON API under /api/v1 through the test client.
+'''
+
+
+def api_client(email, password):
+    client = app.test_client()
+    response = client.post('/api/v1/login',
+                           json={'email': email, 'password': password})
+    assert response.status_code == 200
+    return client
+
+
+def listing(title, price=50):
+    return {'title': title, 'description': 'A calm flat for the api tests',
+            'price': price, 'last_modified_date': '2022-03-04'}
+
+
+def test_api_requires_login():
+    client = app.test_client()
+    assert client.get('/api/v1/users/me').status_code == 401
+    response = client.post('/api/v1/login', json={'email': 'nobody@api.com',
+                                                  'password': 'abC12!'})
+    assert response.status_code == 401
+    assert response.get_json() == {'error': 'login failed'}
+
+
+def test_api_listings():
+    register('api owner', 'owner@api.com', 'abC12!')
+    client = api_client('owner@api.com', 'abC12!')
+
+    response = client.post('/api/v1/listings', json=listing('Api Flat 0'))
+    assert response.status_code == 201
+    created = response.get_json()
+    assert created['owner_email'] == 'owner@api.com'
+    response = client.post('/api/v1/listings', json=listing('Api Flat 0'))
+    assert response.get_json() == {'error': 'title already used'}
+    response = client.post('/api/v1/listings', json=listing('Api Flat 1', 3))
+    assert response.status_code == 400
+
+    response = client.patch('/api/v1/listings/{}'.format(created['id']),
+                            json={'price': 60})
+    assert response.get_json()['price'] == 60
+    response = client.patch('/api/v1/listings/{}'.format(created['id']),
+                            json={'price': 55})
+    assert response.status_code == 400
+    assert client.patch('/api/v1/listings/0', json={}).status_code == 404
+
+    page = '/api/v1/listings?after=Api Fla&page_size=1'
+    response = client.get(page)
+    assert response.get_json()['listings'][0]['title'] == 'Api Flat 0'
+    assert response.get_json()['listings'][0]['price'] == 60
+    response = client.get(page, headers={
+        'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+
+def test_api_listings_batch():
+    register('api batcher', 'batcher@api.com', 'abC12!')
+    client = api_client('batcher@api.com', 'abC12!')
+    first = client.post('/api/v1/listings',
+                        json=listing('Api Batch 0')).get_json()
+
+    response = client.post('/api/v1/listings/batch', json=[
+        dict(listing('Api Batch 1'), op='create'),
+        {'op': 'update', 'id': first['id'], 'price': 70},
+        dict(listing('Api Batch 0'), op='create'),
+        {'op': 'update', 'id': first['id'], 'price': 20},
+        {'op': 'delete'},
+        dict(listing('Api Batch 2'), op='create', title=2),
+        {'op': 'update', 'id': first['id'], 'title': 3},
+    ])
+    results = response.get_json()['results']
+    assert results[0]['title'] == 'Api Batch 1'
+    assert results[1]['price'] == 70
+    assert results[2] == {'error': 'title already used'}
+    assert results[3] == {'error': 'update rejected'}
+    assert results[4] == {'error': 'unknown op'}
+    assert results[5] == results[6] == {'error': 'invalid field'}
+    response = client.post('/api/v1/listings', json=dict(
+        listing('Api Batch 3'), description=['not', 'text']))
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'invalid field'
+    assert client.post('/api/v1/listings/batch', json=[]).status_code == 400
+
+
+def test_api_bookings_and_profile():
+    register('api host', 'host@api.com', 'abC12!')
+    register('api guest', 'guest@api.com', 'abC12!')
+    host = api_client('host@api.com', 'abC12!')
+    host.post('/api/v1/listings', json=listing('Api Stay 0', 20))
+    host.post('/api/v1/listings', json=listing('Api Stay 1', 20))
+    client = api_client('guest@api.com', 'abC12!')
+
+    response = client.post('/api/v1/bookings', json={
+        'listing_title': 'Api Stay 0', 'start_date': '2022-06-01',
+        'end_date': '2022-06-03'})
+    assert response.status_code == 201
+    batch = [{'listing_title': 'Api Stay 1', 'start_date': '2022-06-01',
+              'end_date': '2022-06-03'},
+             {'listing_title': 'Api Stay 0', 'start_date': '2022-06-02',
+              'end_date': '2022-06-04'}]
+    # all or nothing by default
+    results = client.post('/api/v1/bookings/batch',
+                          json=batch).get_json()['results']
+    assert results == [{'error': 'another booking of the batch failed'},
+                       {'error': 'dates taken'}]
+    results = client.post('/api/v1/bookings/batch?atomic=0',
+                          json=batch).get_json()['results']
+    assert results[0]['listing_title'] == 'Api Stay 1'
+    assert results[1] == {'error': 'dates taken'}
+    bookings = client.get('/api/v1/bookings').get_json()['bookings']
+    assert [b['listing_title'] for b in bookings] == ['Api Stay 0',
+                                                      'Api Stay 1']
+
+    assert client.get('/api/v1/users/me').get_json()['balance'] == 60
+    response = client.patch('/api/v1/users/me', json={
+        'email': 'moved@api.com', 'postal_code': 'A1A1A1'})
+    assert response.get_json()['email'] == 'moved@api.com'
+    # the session follows the new email
+    assert client.get('/api/v1/users/me').get_json()['email'] == \
+        'moved@api.com'
+    response = client.patch('/api/v1/users/me', json={'postal_code': '!'})
+    assert response.get_json() == {'error': 'invalid postal code'}
+    assert db.session.query(User).filter_by(
+        email='moved@api.com').one().postal_code == 'A1A1A1'
+
+
+def test_api_listings_batch_order():
+    register('api orderer', 'orderer@api.com', '123aB!')
+    client = api_client('orderer@api.com', '123aB!')
+    first = client.post('/api/v1/listings',
+                        json=listing('Api Order 0')).get_json()
+
+    # each operation sees the ones before it
+    results = client.post('/api/v1/listings/batch', json=[
+        dict(listing('Api Order 1'), op='create'),
+        {'op': 'update', 'id': first['id'], 'title': 'Api Order 1'},
+        {'op': 'update', 'id': first['id'], 'title': 'Api Order 2'},
+        dict(listing('Api Order 2'), op='create'),
+        dict(listing('Api Order 0'), op='create'),
+        dict(listing('Api Order 3'), op='create'),
+    ]).get_json()['results']
+    assert results[0]['title'] == 'Api Order 1'
+    assert results[1] == {'error': 'update rejected'}
+    assert results[2]['title'] == 'Api Order 2'
+    assert results[3] == {'error': 'title already used'}
+    # the renamed listing freed its old title
+    assert results[4]['title'] == 'Api Order 0'
+    assert results[5]['title'] == 'Api Order 3'
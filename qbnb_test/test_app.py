@@ -0,0 +1,29 @@
+import os
+import tempfile
+import sqlalchemy as sa
+from qbnb import create_app
+from qbnb.models import db, init_db
+
+'''
+This file tests the application factory.
+'''
+
+
+def test_create_app_is_lazy():
+    '''
+    Building an app neither connects to nor creates the database,
+    init_db() does.
+    '''
+    db_file = os.path.join(tempfile.mkdtemp(), 'lazy.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                      'USER_CACHE_SIZE': 5})
+    assert not os.path.exists(db_file)
+    assert app.config['USER_CACHE_SIZE'] == 5
+    assert '/login' in {rule.rule for rule in app.url_map.iter_rules()}
+    assert app.test_client().get('/login').status_code == 200
+    assert not os.path.exists(db_file)
+
+    with app.app_context():
+        init_db()
+        tables = set(sa.inspect(db.engine).get_table_names())
+    assert {'user', 'listing', 'booking'} <= tables
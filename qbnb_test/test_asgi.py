@@ -0,0 +1,139 @@
+import asyncio
+import urllib.parse
+import pytest
+from qbnb import app
+from qbnb.models import register, create_listing, create_booking
+from qbnb.models import get_balance, User
+
+pytest.importorskip('aiosqlite')
+pytest.importorskip('asgiref')
+from qbnb.async_views import AsyncApp, create_booking_async  # noqa: E402
+
+'''
+This file tests the async views of the ASGI mode, called the way an
+ASGI server would call them.
+'''
+
+
+def call(asgi, method, path, form=None, headers=()):
+    '''
+    Run one request through the ASGI app
+      Returns:
+        The status, the headers as a dict and the body
+    '''
+    path, _, query = path.partition('?')
+    body = urllib.parse.urlencode(form or {}).encode()
+    headers = [(name.lower().encode(), value.encode())
+               for name, value in headers]
+    if form is not None:
+        headers.append((b'content-type',
+                        b'application/x-www-form-urlencoded'))
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query.encode(), 'headers': headers,
+             'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+             'server': ('localhost', 80), 'client': ('127.0.0.1', 1234)}
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi(scope, receive, send))
+    start = sent[0]
+    return (start['status'],
+            {name.decode(): value.decode()
+             for name, value in start['headers']},
+            b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+def session_cookie(headers):
+    return headers['set-cookie'].split(';')[0]
+
+
+def test_async_login_home_and_booking():
+    asgi = AsyncApp(app)
+    register('asgi host', 'host@asgi.com', '123aB!')
+    register('asgi guest', 'guest@asgi.com', '123aB!')
+    create_listing('Asgi Loft', 'A loft booked through the ASGI app', 40,
+                   '2022-03-04', 'host@asgi.com')
+
+    status, _, body = call(asgi, 'POST', '/login', {
+        'email': 'guest@asgi.com', 'password': 'wrong1A!'})
+    assert status == 200 and b'login failed' in body
+    status, headers, _ = call(asgi, 'POST', '/login', {
+        'email': 'guest@asgi.com', 'password': '123aB!'})
+    assert status == 303 and headers['location'] == '/'
+    cookie = ('Cookie', session_cookie(headers))
+
+    status, headers, body = call(asgi, 'GET', '/?after=Asgi&page_size=1',
+                                 headers=[cookie])
+    assert status == 200
+    assert b'asgi guest' in body and b'Asgi Loft' in body
+    # the ETag matches the one of the WSGI view
+    client = app.test_client()
+    client.post('/login', data={'email': 'guest@asgi.com',
+                                'password': '123aB!'})
+    assert client.get('/?after=Asgi&page_size=1').headers['ETag'] == \
+        headers['etag']
+    status, _, _ = call(asgi, 'GET', '/?after=Asgi&page_size=1',
+                        headers=[cookie, ('If-None-Match',
+                                          headers['etag'])])
+    assert status == 304
+
+    booking = {'user_email': 'guest@asgi.com', 'listing_title': 'Asgi Loft',
+               'start_date': '2023-09-01', 'end_date': '2023-09-03'}
+    _, _, body = call(asgi, 'POST', '/create_booking', booking,
+                      headers=[cookie])
+    assert b'Booking Created.' in body
+    _, _, body = call(asgi, 'POST', '/create_booking', booking,
+                      headers=[cookie])
+    assert b'Booking Creation Failed.' in body
+    guest = User.query.filter_by(email='guest@asgi.com').one()
+    assert get_balance(guest.id) == 60
+
+    # the new booking changes the page
+    status, _, body = call(asgi, 'GET', '/?after=Asgi&page_size=1',
+                           headers=[cookie, ('If-None-Match',
+                                             headers['etag'])])
+    assert status == 200 and b'2023-09-01' in body
+    # other routes are served by the WSGI app
+    status, _, body = call(asgi, 'GET', '/login')
+    assert status == 200 and b'login' in body
+
+
+def test_async_booking_rules_match_create_booking():
+    AsyncApp(app)
+    register('rules host', 'host@rules.com', '123aB!')
+    register('rules guest', 'guest@rules.com', '123aB!')
+    create_listing('Rules Flat', 'A flat both booking paths refuse', 20,
+                   '2022-03-04', 'host@rules.com')
+    create_listing('Rules Castle', 'A castle above the guest balance',
+                   500, '2022-03-04', 'host@rules.com')
+    assert create_booking('guest@rules.com', 'Rules Flat', '2023-05-10',
+                          '2023-05-15') is not None
+
+    rejected = [
+        # the owner's own listing
+        ('host@rules.com', 'Rules Flat', '2023-06-01', '2023-06-02'),
+        # more than the balance
+        ('guest@rules.com', 'Rules Castle', '2023-06-01', '2023-06-02'),
+        # overlapping dates, on either side and inside
+        ('guest@rules.com', 'Rules Flat', '2023-05-08', '2023-05-11'),
+        ('guest@rules.com', 'Rules Flat', '2023-05-14', '2023-05-20'),
+        ('guest@rules.com', 'Rules Flat', '2023-05-11', '2023-05-12'),
+        # invalid dates, no such listing or user
+        ('guest@rules.com', 'Rules Flat', '2023-05-20', '2023-05-20'),
+        ('guest@rules.com', 'Rules Nowhere', '2023-06-01', '2023-06-02'),
+        ('nobody@rules.com', 'Rules Flat', '2023-06-01', '2023-06-02'),
+    ]
+    for booking in rejected:
+        assert create_booking(*booking) is None, booking
+        assert asyncio.run(create_booking_async(*booking)) is False, booking
+    # the ranges next to the booking are free in both
+    assert create_booking('guest@rules.com', 'Rules Flat', '2023-05-15',
+                          '2023-05-16') is not None
+    assert asyncio.run(create_booking_async(
+        'guest@rules.com', 'Rules Flat', '2023-05-09', '2023-05-10'))
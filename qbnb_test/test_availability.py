@@ -0,0 +1,71 @@
+from qbnb import app
+from qbnb.models import db, register, create_listing, create_booking
+from qbnb.models import find_available_listings, User
+
+'''
+This file tests the availability search. The listings use prices no
+other test does, so the price range isolates them from the rest of the
+shared test database.
+'''
+
+DESCRIPTION = 'A bright room with a view over the river'
+
+
+def setup_listings():
+    register('free owner', 'freeowner@test.com', '123aB!')
+    register('free guest', 'freeguest@test.com', '123aB!')
+    # enough for one stay
+    User.query.filter_by(email='freeguest@test.com').one().balance = 8000
+    db.session.commit()
+    for title, price in (('Free Attic', 7771), ('Free Barn', 7772),
+                         ('Free Cellar', 7773), ('Free Dome', 7773)):
+        create_listing(title, DESCRIPTION, price, '2022-03-04',
+                       'freeowner@test.com')
+
+
+def titles(*args, **kwargs):
+    listings, cursor = find_available_listings(*args, **kwargs)
+    return [listing.title for listing in listings], cursor
+
+
+def test_available_listings():
+    setup_listings()
+    assert create_booking('freeguest@test.com', 'Free Barn',
+                          '2023-05-10', '2023-05-15')
+
+    # the booking overlaps, cheapest listing first
+    assert titles('2023-05-12', '2023-05-20', 7771, 7779) == (
+        ['Free Attic', 'Free Cellar', 'Free Dome'], None)
+    # check-out and check-in on the same day do not overlap
+    assert titles('2023-05-15', '2023-05-20', 7771, 7779)[0] == [
+        'Free Attic', 'Free Barn', 'Free Cellar', 'Free Dome']
+    assert titles('2023-05-01', '2023-05-10', 7772, 7772)[0] == [
+        'Free Barn']
+    assert titles('2023-05-01', '2023-05-11', 7772, 7772)[0] == []
+    # invalid dates
+    assert titles('2023-05-20', '2023-05-12', 7771, 7779) == ([], None)
+    assert titles('2023-02-30', '2023-03-02', 7771, 7779) == ([], None)
+
+    # pages follow the (price, id) cursor, equal prices included
+    page, cursor = titles('2023-05-15', '2023-05-20', 7771, 7779,
+                          page_size=3)
+    assert page == ['Free Attic', 'Free Barn', 'Free Cellar']
+    assert titles('2023-05-15', '2023-05-20', 7771, 7779, after=cursor,
+                  page_size=3) == (['Free Dome'], None)
+
+
+def test_availability_page():
+    client = app.test_client()
+    assert client.get('/availability').status_code == 302
+    client.post('/login', data={'email': 'freeguest@test.com',
+                                'password': '123aB!'})
+    response = client.get('/availability?start_date=2023-05-12&'
+                          'end_date=2023-05-20&min_price=7771&'
+                          'max_price=7779&page_size=2')
+    assert b'Free Attic' in response.data
+    assert b'Free Barn' not in response.data
+    next_url = response.headers['Link'].split('>')[0][1:]
+    response = client.get(next_url)
+    assert b'Free Dome' in response.data
+    assert b'Free Attic' not in response.data
+    assert 'Link' not in response.headers
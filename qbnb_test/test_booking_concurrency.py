@@ -0,0 +1,86 @@
+import threading
+from qbnb import app
+from qbnb.models import register, create_listing, create_booking
+from qbnb.models import db, Booking, Listing, User, get_balance
+
+'''
+Stress tests for create_booking: many threads booking at once must
+never produce overlapping bookings or a negative balance.
+'''
+
+THREADS = 16
+
+
+def run_concurrently(jobs):
+    '''
+    Run every job in its own thread (each with its own app context,
+    hence its own database session), all released at the same time.
+    Returns the jobs' results in order.
+    '''
+    results = [None] * len(jobs)
+    barrier = threading.Barrier(len(jobs))
+
+    def worker(index, job):
+        with app.app_context():
+            barrier.wait()
+            results[index] = job()
+
+    threads = [threading.Thread(target=worker, args=(i, job))
+               for i, job in enumerate(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_no_double_booking_under_contention():
+    '''
+    Many guests racing for the same dates: exactly one wins.
+    '''
+    owner = register("racer", "racer@email.com", "abC12!")
+    assert create_listing("Race House", "This is a very contested house",
+                          10, "2022-01-01", owner.email) is not None
+    emails = []
+    for i in range(THREADS):
+        email = "racer" + str(i) + "@email.com"
+        assert register("racer" + str(i), email, "abC12!") is not None
+        emails.append(email)
+
+    results = run_concurrently([
+        lambda email=email: create_booking(email, "Race House",
+                                           "2022-05-01", "2022-05-04")
+        for email in emails])
+
+    assert sum(result is not None for result in results) == 1
+    assert Booking.query.join(Booking.listing).filter(
+        Listing.title == "Race House").count() == 1
+
+
+def test_no_negative_balance_under_contention():
+    '''
+    One guest racing to book more nights than they can pay for:
+    only as many bookings as the balance covers go through.
+    '''
+    owner = register("spender", "spender@email.com", "abC12!")
+    guest = register("spendthrift", "spendthrift@email.com", "abC12!")
+    titles = []
+    for i in range(THREADS):
+        title = "Spend House " + str(i)
+        assert create_listing(title, "This is one of many spend houses",
+                              30, "2022-01-01", owner.email) is not None
+        titles.append(title)
+
+    results = run_concurrently([
+        lambda title=title: create_booking(guest.email, title,
+                                           "2022-06-01", "2022-06-02")
+        for title in titles])
+
+    # balance starts at 100 and every night costs 30
+    assert sum(result is not None for result in results) == 3
+    # the threads wrote through their own sessions
+    db.session.expire_all()
+    guest = User.query.filter_by(email="spendthrift@email.com").one()
+    owner = User.query.filter_by(email="spender@email.com").one()
+    assert get_balance(guest.id) == 10
+    assert get_balance(owner.id) == 190
@@ -0,0 +1,112 @@
+from qbnb import app
+from qbnb.models import db, register, create_listing, Booking, User
+from qbnb.models import get_balance
+from qbnb.booking_queue import enqueue_booking, get_booking_request
+from qbnb.booking_queue import process_booking_requests
+from qbnb.booking_queue import start_booking_writer
+import qbnb.booking_queue
+
+'''
+This file tests queued bookings: the queue order decides who gets
+contested dates, and the controller hands out tokens to poll.
+'''
+
+DESCRIPTION = 'A listing booked through the queue'
+
+
+def test_queue_order_decides():
+    register('queue owner', 'queueowner@test.com', '123aB!')
+    create_listing('Queue Cabin', DESCRIPTION, 30, '2022-03-04',
+                   'queueowner@test.com')
+    guests = []
+    for i in range(3):
+        email = 'queueguest{}@test.com'.format(i)
+        register('queue guest', email, '123aB!')
+        guests.append(email)
+
+    tokens = [enqueue_booking(email, 'Queue Cabin', '2023-07-01',
+                              '2023-07-04') for email in guests]
+    # the first guest books a second stay, the balance covers it
+    tokens.append(enqueue_booking(guests[0], 'Queue Cabin', '2023-08-01',
+                                  '2023-08-02'))
+    tokens.append(enqueue_booking(guests[0], 'No Such Listing',
+                                  '2023-08-01', '2023-08-02'))
+    assert enqueue_booking(guests[0], 'Queue Cabin', '2023-08-02',
+                           '2023-08-01') is None
+    assert get_booking_request(tokens[0]).status == 'pending'
+
+    assert process_booking_requests(batch_size=2) == 2
+    assert process_booking_requests(batch_size=100) >= 3
+    assert process_booking_requests() == 0
+    statuses = [get_booking_request(token).status for token in tokens]
+    assert statuses == ['booked', 'rejected', 'rejected', 'booked',
+                        'rejected']
+    first = get_booking_request(tokens[0])
+    booking = db.session.get(Booking, first.booking_id)
+    assert booking.start_date == '2023-07-01'
+    guest = User.query.filter_by(email=guests[0]).one()
+    assert get_balance(guest.id) == 40
+    assert get_booking_request('unknown') is None
+
+
+def test_queued_booking_route():
+    register('route owner', 'queueroute@test.com', '123aB!')
+    register('route guest', 'queueguestroute@test.com', '123aB!')
+    create_listing('Queue Loft', DESCRIPTION, 30, '2022-03-04',
+                   'queueroute@test.com')
+    client = app.test_client()
+    app.config['BOOKING_QUEUE'] = True
+    try:
+        response = client.post('/create_booking', data={
+            'user_email': 'queueguestroute@test.com',
+            'listing_title': 'Queue Loft',
+            'start_date': '2023-07-01', 'end_date': '2023-07-04'})
+        assert response.status_code == 202
+        link = response.data.split(b'id="booking-status"')[0]
+        status_url = link.rsplit(b"href='", 1)[1].split(b"'")[0].decode()
+        assert status_url.startswith('/booking_status/')
+        assert client.get(status_url).json['status'] == 'pending'
+    finally:
+        app.config['BOOKING_QUEUE'] = False
+
+    thread, stop = start_booking_writer(app)
+    try:
+        result = client.get(status_url + '?wait=5').json
+    finally:
+        stop.set()
+        thread.join()
+    assert result['status'] == 'booked'
+    assert result['booking_id'] is not None
+    assert client.get('/booking_status/unknown').status_code == 404
+
+
+def test_writer_survives_a_failing_request(monkeypatch):
+    register('poison owner', 'poisonowner@test.com', '123aB!')
+    register('poison guest', 'poisonguest@test.com', '123aB!')
+    for title in ('Calm Flat', 'Poison Flat'):
+        create_listing(title, DESCRIPTION, 10, '2022-03-04',
+                       'poisonowner@test.com')
+    stage_booking = qbnb.booking_queue.stage_booking
+
+    def failing(listing, *args):
+        if listing.title == 'Poison Flat':
+            raise RuntimeError('cannot decide')
+        return stage_booking(listing, *args)
+
+    monkeypatch.setattr(qbnb.booking_queue, 'stage_booking', failing)
+    tokens = [enqueue_booking('poisonguest@test.com', title, '2023-09-01',
+                              '2023-09-02')
+              for title in ('Calm Flat', 'Poison Flat', 'Calm Flat',
+                            'Calm Flat')]
+    thread, stop = start_booking_writer(app)
+    try:
+        statuses = [get_booking_request(token, wait=5).status
+                    for token in tokens]
+        # the writer is still running
+        later = enqueue_booking('poisonguest@test.com', 'Calm Flat',
+                                '2023-09-05', '2023-09-06')
+        assert get_booking_request(later, wait=5).status == 'booked'
+    finally:
+        stop.set()
+        thread.join()
+    assert statuses == ['booked', 'failed', 'rejected', 'rejected']
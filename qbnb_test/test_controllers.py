@@ -0,0 +1,189 @@
+import gzip
+import os
+import tempfile
+from qbnb import app, create_app
+from qbnb.models import init_db, register, create_listing, update_user
+from qbnb.models import user_cache_stats, create_booking
+from qbnb.fragments import fragment_cache_stats
+
+'''
+This file tests the flask routes directly through the test client,
+without starting a browser.
+'''
+
+
+def logged_in_client(email, password):
+    client = app.test_client()
+    client.post('/login', data={'email': email, 'password': password})
+    return client
+
+
+def test_home_feed_pagination():
+    '''
+    The home page shows real listings a page at a time and links
+    to the next page both in the body and in the Link header.
+    '''
+    owner = register("feedowner", "feedowner@email.com", "abC12!")
+    for i in range(3):
+        create_listing("Feed House " + str(i), "This is a nice feed house",
+                       100, "2022-01-01", owner.email)
+    client = logged_in_client("feedowner@email.com", "abC12!")
+
+    # other tests add listings too, so start the feed just before ours
+    response = client.get('/?page_size=2&after=Feed Hous')
+    assert response.status_code == 200
+    assert b'Feed House 0' in response.data
+    assert b'Feed House 1' in response.data
+    assert b'Feed House 2' not in response.data
+    assert 'rel="next"' in response.headers['Link']
+
+    next_url = response.headers['Link'].split(';')[0].strip('<>')
+    response = client.get(next_url)
+    assert b'Feed House 1' not in response.data
+    assert b'Feed House 2' in response.data
+
+
+def test_authenticated_user_cache():
+    '''
+    Repeat page views reuse the cached user instead of querying it,
+    and profile updates and logout drop the cached copy.
+    '''
+    register("cacheduser", "cacheduser@email.com", "abC12!")
+    client = logged_in_client("cacheduser@email.com", "abC12!")
+
+    client.get('/')
+    before = user_cache_stats()
+    response = client.get('/')
+    after = user_cache_stats()
+    assert b'Welcome cacheduser' in response.data
+    assert after['hits'] == before['hits'] + 1
+    assert after['misses'] == before['misses']
+
+    # the profile update is visible on the very next page view
+    update_user("cacheduser@email.com", "renamed user", "", "", "A1A1A1")
+    response = client.get('/')
+    assert b'Welcome renamed user' in response.data
+    assert user_cache_stats()['misses'] == after['misses'] + 1
+
+    client.get('/logout')
+    assert client.get('/').status_code == 302
+
+
+def test_home_page_etag():
+    '''
+    Repeat views of an unchanged home page are answered with 304 or
+    from the fragment cache, and new listings and bookings show at once.
+    '''
+    owner = register("etagowner", "etagowner@email.com", "abC12!")
+    register("etagguest", "etagguest@email.com", "abC12!")
+    create_listing("Etag House 0", "This is a nice etag house",
+                   10, "2022-01-01", owner.email)
+    client = logged_in_client("etagguest@email.com", "abC12!")
+    page = '/?page_size=2&after=Etag Hous'
+
+    response = client.get(page)
+    etag = response.headers['ETag']
+    assert 'no-cache' in response.headers['Cache-Control']
+    response = client.get(page, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+    # without the tag, both fragments come from the cache
+    hits = fragment_cache_stats()['hits']
+    response = client.get(page)
+    assert b'Etag House 0' in response.data
+    assert fragment_cache_stats()['hits'] == hits + 2
+
+    create_listing("Etag House 1", "This is a nice etag house",
+                   10, "2022-01-01", owner.email)
+    response = client.get(page, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Etag House 1' in response.data
+    etag = response.headers['ETag']
+
+    assert create_booking("etagguest@email.com", "Etag House 1",
+                          "2022-05-01", "2022-05-02")
+    response = client.get(page, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert b'Start Date: 2022-05-01' in response.data
+
+
+def test_update_listing_page():
+    '''
+    A listing updated through the form is saved, and the home page
+    shows it at once, under a new ETag.
+    '''
+    # an app of its own, so each request's session ends with it
+    db_file = os.path.join(tempfile.mkdtemp(), 'edit.sqlite')
+    edit_app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                           'PASSWORD_HASH_ITERATIONS': 1000})
+    with edit_app.app_context():
+        init_db()
+        owner = register("editowner", "editowner@email.com", "abC12!")
+        create_listing("Edit House 0", "This is a nice edit house",
+                       10, "2022-01-01", owner.email)
+    client = edit_app.test_client()
+    client.post('/login', data={'email': 'editowner@email.com',
+                                'password': 'abC12!'})
+    etag = client.get('/').headers['ETag']
+
+    response = client.post('/update_listing', data={
+        'email': 'editowner@email.com', 'title': 'Edit House 1',
+        'description': 'N/A', 'price': '20'})
+    assert b'Listing Updated.' in response.data
+    response = client.get('/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert b'Edit House 1' in response.data
+    assert b'Edit House 0' not in response.data
+
+
+def test_form_page_etag():
+    '''
+    The forms only change with the templates, a repeat view is a 304.
+    '''
+    client = app.test_client()
+    for page in ('/login', '/register', '/create_listing',
+                 '/update_listing', '/create_booking', '/update_profile'):
+        response = client.get(page)
+        assert response.status_code == 200
+        response = client.get(page, headers={
+            'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+
+def test_compressed_pages():
+    '''
+    Pages are gzipped for clients accepting it, under an ETag of their
+    own that revalidates like the plain one.
+    '''
+    owner = register("gzipowner", "gzipowner@email.com", "abC12!")
+    create_listing("Gzip House", "This is a nice gzip house",
+                   100, "2022-02-03", owner.email)
+    client = logged_in_client("gzipowner@email.com", "abC12!")
+    page = '/?page_size=1&after=Gzip Hous'
+
+    plain = client.get(page)
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.headers['Last-Modified'] == \
+        'Thu, 03 Feb 2022 00:00:00 GMT'
+    response = client.get(page, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data) == plain.data
+    assert len(response.data) < len(plain.data)
+    etag = response.headers['ETag']
+    assert etag == plain.headers['ETag'][:-1] + '-gzip"'
+
+    response = client.get(page, headers={'Accept-Encoding': 'gzip',
+                                         'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    # too small to be worth it
+    app.config['COMPRESS_MIN_SIZE'] = len(plain.data) + 1
+    try:
+        response = client.get(page, headers={'Accept-Encoding': 'gzip'})
+    finally:
+        app.config['COMPRESS_MIN_SIZE'] = 500
+    assert 'Content-Encoding' not in response.headers
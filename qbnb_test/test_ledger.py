@@ -0,0 +1,68 @@
+from qbnb.models import db, register, create_listing, create_booking
+from qbnb.models import get_balance, get_balances, LedgerEntry
+from qbnb.models import BalanceSnapshot
+from qbnb.ledger import take_snapshots, reconcile_ledger
+
+'''
+This file tests the balance ledger: bookings append entries instead of
+updating users, and snapshots and reconciliation keep balances right.
+'''
+
+DESCRIPTION = 'A listing paid for through the ledger'
+
+
+def test_bookings_append_to_the_ledger():
+    owner = register('ledger owner', 'ledgerowner@test.com', '123aB!')
+    guest = register('ledger guest', 'ledgerguest@test.com', '123aB!')
+    create_listing('Ledger Hut', DESCRIPTION, 30, '2022-03-04',
+                   'ledgerowner@test.com')
+    booking = create_booking('ledgerguest@test.com', 'Ledger Hut',
+                             '2023-03-01', '2023-03-02')
+    assert booking is not None
+
+    # the user rows keep the opening balance
+    db.session.expire_all()
+    assert (owner.balance, guest.balance) == (100, 100)
+    entries = LedgerEntry.query.filter_by(booking_id=booking.id).all()
+    assert sorted((e.user_id, e.amount) for e in entries) == [
+        (owner.id, 30), (guest.id, -30)]
+    assert get_balances([owner.id, guest.id]) == {owner.id: 130,
+                                                  guest.id: 70}
+    assert get_balance(-1) is None
+
+
+def test_snapshots_and_reconciliation():
+    owner = register('snap owner', 'snapowner@test.com', '123aB!')
+    guest = register('snap guest', 'snapguest@test.com', '123aB!')
+    create_listing('Snapshot Hut', DESCRIPTION, 20, '2022-03-04',
+                   'snapowner@test.com')
+    assert create_booking('snapguest@test.com', 'Snapshot Hut',
+                          '2023-03-01', '2023-03-02')
+
+    # too recent for a snapshot
+    take_snapshots()
+    assert db.session.get(BalanceSnapshot, guest.id) is None
+    assert take_snapshots(settle=0) > 0
+    assert db.session.get(BalanceSnapshot, guest.id).balance == 80
+    assert take_snapshots(settle=0) == 0
+
+    # entries after the snapshot count on top of it
+    assert create_booking('snapguest@test.com', 'Snapshot Hut',
+                          '2023-03-02', '2023-03-03')
+    assert get_balance(guest.id) == 60
+    assert get_balance(owner.id) == 140
+    # a guest cannot spend more than snapshot plus later entries
+    for day in range(3, 6):
+        create_booking('snapguest@test.com', 'Snapshot Hut',
+                       '2023-03-0{}'.format(day),
+                       '2023-03-0{}'.format(day + 1))
+    assert get_balance(guest.id) == 0
+
+    assert reconcile_ledger() == {'unbalanced bookings': 0,
+                                  'snapshots rewritten': 0,
+                                  'negative balances': 0}
+    db.session.get(BalanceSnapshot, guest.id).balance = 1000
+    db.session.commit()
+    assert reconcile_ledger()['snapshots rewritten'] == 1
+    assert db.session.get(BalanceSnapshot, guest.id).balance == 80
+    assert get_balance(guest.id) == 0
@@ -0,0 +1,93 @@
+import os
+import tempfile
+from qbnb.models import register, create_listing, Listing
+from qbnb.models import search_listings
+from qbnb.listing_import import read_listings, import_listings
+from qbnb.__main__ import main
+
+'''
+Tests for the bulk listing import pipeline.
+'''
+
+DESCRIPTION = 'An imported listing with a description'
+
+
+def write_file(name, text):
+    path = os.path.join(tempfile.mkdtemp(), name)
+    with open(path, 'w') as target:
+        target.write(text)
+    return path
+
+
+def test_import_listings_applies_create_listing_rules():
+    owner = register('importer', 'importer@test.com', '123aB!')
+    create_listing('Import Taken', DESCRIPTION, 100, '2022-01-01',
+                   owner.email)
+    rows = [
+        {'title': 'Import One', 'price': '100'},
+        {'title': 'Import Two', 'price': 'cheap'},
+        {'title': ' Import Three', 'price': '100'},
+        {'title': 'Import Four', 'price': '5'},
+        {'title': 'Import Taken', 'price': '100'},
+        {'title': 'Import Five', 'price': '100', 'owner_email': 'x@x.com'},
+        {'title': 'Import One', 'price': '200'},
+        {'title': 'Import Six', 'price': '300'},
+    ]
+    for row in rows:
+        row.setdefault('description', DESCRIPTION)
+        row.setdefault('last_modified_date', '2022-01-01')
+        row.setdefault('owner_email', owner.email)
+
+    # chunks of 3 put the duplicate title in a later chunk
+    rejected = import_listings(rows, chunk_size=3)
+    assert rejected == [(1, 'invalid price'), (2, 'invalid title'),
+                        (3, 'invalid price'), (4, 'title already used'),
+                        (5, 'owner does not exist'),
+                        (6, 'title already used')]
+    one = Listing.query.filter_by(title='Import One').one()
+    assert one.price == 100
+    assert one.owner.email == owner.email
+    assert Listing.query.filter_by(title='Import Six').one().price == 300
+    # imported listings are searchable
+    assert [listing.title for listing in search_listings('import six')] \
+        == ['Import Six']
+
+
+def test_read_listings_formats():
+    csv_path = write_file('listings.csv', (
+        'title,description,price,last_modified_date,owner_email\n'
+        'Csv House,{},150,2022-01-01,importer@test.com\n').format(
+            DESCRIPTION))
+    jsonl_path = write_file('listings.jsonl', (
+        '{{"title": "Jsonl House", "description": "{}", "price": 150,'
+        ' "last_modified_date": "2022-01-01",'
+        ' "owner_email": "importer@test.com"}}\n\n').format(DESCRIPTION))
+    assert [row['title'] for row in read_listings(csv_path)] == \
+        ['Csv House']
+    assert [row['title'] for row in read_listings(jsonl_path)] == \
+        ['Jsonl House']
+
+    main(['import-listings', csv_path])
+    main(['import-listings', jsonl_path, '--chunk-size', '1'])
+    assert Listing.query.filter(Listing.title.in_(
+        ['Csv House', 'Jsonl House'])).count() == 2
+
+
+def test_import_listings_rejects_bad_rows():
+    register('bad importer', 'badimporter@test.com', '123aB!')
+    good = ('{{"title": "Bad Rows House", "description": "{}", '
+            '"price": 150, "last_modified_date": "2022-01-01", '
+            '"owner_email": "badimporter@test.com"}}').format(DESCRIPTION)
+    path = write_file('bad.jsonl', '\n'.join([
+        '{"title": "Bad Rows Cut',
+        '',
+        good.replace('"Bad Rows House"', '42'),
+        good.replace('"2022-01-01"', '["2022-01-01"]'),
+        good.replace('"badimporter@test.com"', '{"id": 1}'),
+        '[1, 2]',
+        good]) + '\n')
+    rejected = import_listings(read_listings(path))
+    assert rejected == [(0, 'invalid JSON on line 1'),
+                        (1, 'invalid field'), (2, 'invalid field'),
+                        (3, 'invalid field'), (4, 'missing field')]
+    assert Listing.query.filter_by(title='Bad Rows House').count() == 1
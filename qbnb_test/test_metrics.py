@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+import pytest
+from qbnb import create_app
+from qbnb.models import init_db, register, create_listing
+from qbnb.metrics import set_worker_slot
+
+'''
+This file tests the request instrumentation and the /metrics export,
+on an app of its own so the counts start from zero.
+'''
+
+
+def make_app(**config):
+    db_file = os.path.join(tempfile.mkdtemp(), 'metrics.sqlite')
+    app = create_app(dict({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                           'PASSWORD_HASH_ITERATIONS': 1000}, **config))
+    with app.app_context():
+        init_db()
+        register('metric owner', 'metricowner@test.com', '123aB!')
+        register('metric guest', 'metricguest@test.com', '123aB!')
+        create_listing('Metric Flat', 'A flat that is being measured', 10,
+                       '2022-03-04', 'metricowner@test.com')
+    return app
+
+
+def sample(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+def book(client, day):
+    return client.post('/create_booking', data={
+        'user_email': 'metricguest@test.com', 'listing_title': 'Metric Flat',
+        'start_date': '2023-01-0{}'.format(day),
+        'end_date': '2023-01-0{}'.format(day + 1)})
+
+
+def test_requests_are_measured():
+    client = make_app().test_client()
+    client.post('/login', data={'email': 'metricguest@test.com',
+                                'password': '123aB!'})
+    client.get('/')
+    client.get('/no/such/page')
+    book(client, 1)
+    text = client.get('/metrics').data.decode()
+
+    assert sample(text, 'qbnb_requests_total{route="/",method="GET",'
+                        'status="200"}') == 1
+    assert sample(text, 'qbnb_requests_total{route="unmatched",'
+                        'method="GET",status="404"}') == 1
+    assert sample(text, 'qbnb_request_duration_seconds_count{'
+                        'route="/login"}') == 1
+    assert sample(text, 'qbnb_template_render_duration_seconds_count{'
+                        'template="index.html"}') == 1
+    assert sample(text, 'qbnb_request_db_duration_seconds_sum{'
+                        'route="/"}') > 0
+    # the home page reads the user, the listings and the bookings
+    assert 0 < sample(text, 'qbnb_request_queries_sum{route="/"}') <= 5
+
+
+def test_booking_query_count_does_not_grow():
+    client = make_app().test_client()
+    counts = []
+    for day in range(1, 6, 2):
+        book(client, day)
+        text = client.get('/metrics').data.decode()
+        counts.append(sample(text, 'qbnb_request_queries_sum{'
+                                   'route="/create_booking"}'))
+    # every booking costs the same few statements, however many the
+    # guest already has
+    per_booking = [counts[0]] + [b - a for a, b in zip(counts, counts[1:])]
+    assert len(set(per_booking)) == 1
+    assert per_booking[0] <= 8
+
+
+def test_workers_are_added_up():
+    directory = tempfile.mkdtemp()
+    app = make_app(METRICS_DIR=directory)
+    client = app.test_client()
+    client.get('/login')
+    # another worker's numbers
+    with open(os.path.join(directory, '1.json'), 'w') as file:
+        json.dump({'counters': [['qbnb_requests_total',
+                                 [['route', '/login'], ['method', 'GET'],
+                                  ['status', 200]], 4]],
+                   'histograms': []}, file)
+    text = client.get('/metrics').data.decode()
+    assert sample(text, 'qbnb_requests_total{route="/login",method="GET",'
+                        'status="200"}') == 5
+    assert '{}.json'.format(os.getpid()) in os.listdir(directory)
+
+
+def test_replaced_worker_counts_on():
+    directory = tempfile.mkdtemp()
+    app = make_app(METRICS_DIR=directory)
+    set_worker_slot(app, 0)
+    app.test_client().get('/login')
+    app.test_client().get('/metrics')
+    # the worker that takes over the slot, in a process of its own
+    successor = make_app(METRICS_DIR=directory)
+    set_worker_slot(successor, 0)
+    client = successor.test_client()
+    client.get('/login')
+    text = client.get('/metrics').data.decode()
+    assert sample(text, 'qbnb_requests_total{route="/login",method="GET",'
+                        'status="200"}') == 2
+    assert sorted(os.listdir(directory)) == ['worker-0.json']
+
+
+def test_failed_requests_are_counted():
+    app = make_app()
+
+    def broken():
+        raise RuntimeError('broken view')
+
+    app.add_url_rule('/broken', 'broken', broken)
+    client = app.test_client()
+    assert client.get('/broken').status_code == 500
+    # raised out of the request, as under a debugger
+    app.config['PROPAGATE_EXCEPTIONS'] = True
+    with pytest.raises(RuntimeError):
+        client.get('/broken')
+    text = client.get('/metrics').data.decode()
+    assert sample(text, 'qbnb_requests_total{route="/broken",method="GET",'
+                        'status="500"}') == 2
+
+
+def test_cache_and_pool_stats_are_exported():
+    client = make_app().test_client()
+    client.post('/login', data={'email': 'metricguest@test.com',
+                                'password': '123aB!'})
+    client.get('/')
+    client.get('/')
+    text = client.get('/metrics').data.decode()
+    assert sample(text, 'qbnb_cache_hits_total{cache="user"}') >= 1
+    assert sample(text, 'qbnb_cache_hits_total{cache="fragment"}') == 2
+    assert sample(text, 'qbnb_cache_entries{cache="fragment"}') == 2
+    assert sample(text, 'qbnb_db_pool_size{engine="default"}') >= 1
+    assert '# TYPE qbnb_db_pool_checked_out gauge' in text
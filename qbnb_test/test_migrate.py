@@ -0,0 +1,113 @@
+import os
+import tempfile
+import pytest
+import sqlalchemy as sa
+from qbnb import create_app
+from qbnb.models import db, init_db, User
+from qbnb.migrate import migrate_schema, OldSchemaError
+
+'''
+Tests converting a database with the original composite-key listing
+and booking tables, on a separate throw-away sqlite file.
+'''
+
+OLD_SCHEMA = [
+    '''CREATE TABLE listing (
+        title VARCHAR NOT NULL,
+        description VARCHAR NOT NULL,
+        price INTEGER NOT NULL,
+        last_modified_date VARCHAR NOT NULL,
+        owner_id VARCHAR NOT NULL,
+        PRIMARY KEY (title, description, owner_id))''',
+    '''CREATE TABLE booking (
+        user_id VARCHAR NOT NULL,
+        listing_id VARCHAR NOT NULL,
+        start_date VARCHAR NOT NULL,
+        end_date VARCHAR NOT NULL,
+        PRIMARY KEY (user_id, listing_id))''',
+    '''CREATE INDEX ix_booking_listing_start
+        ON booking (listing_id, start_date)''',
+]
+
+
+def old_database():
+    engine = sa.create_engine('sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'old.sqlite'))
+    with engine.begin() as connection:
+        User.__table__.create(connection)
+        for statement in OLD_SCHEMA:
+            connection.exec_driver_sql(statement)
+        connection.execute(User.__table__.insert(), [
+            {'id': i, 'email': 'old{}@test.com'.format(i), 'password': 'x',
+             'username': 'old' + str(i), 'billing_address': '',
+             'postal_code': '', 'balance': 100} for i in range(1, 4)])
+        connection.exec_driver_sql(
+            "INSERT INTO listing VALUES "
+            "('House A', 'A house with a long description', 100,"
+            " '2022-01-01', 'old1@test.com'),"
+            "('House B', 'A house with a long description', 200,"
+            " '2022-01-01', 'old2@test.com'),"
+            "('House B', 'Same title, other description', 300,"
+            " '2022-01-01', 'old2@test.com'),"
+            "('House C', 'A house whose owner is gone', 100,"
+            " '2022-01-01', 'gone@test.com'),"
+            "('House D', 'A house with a long description', 100,"
+            " '2022-01-01', 'old1@test.com')")
+        connection.exec_driver_sql(
+            "INSERT INTO booking VALUES "
+            "('old2@test.com', 'House A', '2022-02-01', '2022-02-03'),"
+            "('old3@test.com', 'House A', '2022-02-03', '2022-02-05'),"
+            "('old3@test.com', 'House B', '2022-02-03', '2022-02-05'),"
+            "('old3@test.com', 'House C', '2022-02-03', '2022-02-05'),"
+            # accepted by the old code: unpadded, overlapping, invalid
+            "('old1@test.com', 'House B', '2022-3-1', '2022-3-10'),"
+            "('old2@test.com', 'House D', '2022-02-01', '2022-02-05'),"
+            "('old3@test.com', 'House D', '2022-02-04', '2022-02-06'),"
+            "('old1@test.com', 'House A', '2022-02-05', '2022-02-05')")
+    return engine
+
+
+def test_migrate_schema():
+    engine = old_database()
+    report = migrate_schema(engine, batch_size=2)
+    assert report == {'listings': 3, 'duplicate listings': 1,
+                      'listings without owner': 1,
+                      'bookings': 5, 'orphaned bookings': 1,
+                      'bookings with invalid dates': 1,
+                      'overlapping bookings': 1}
+
+    with engine.connect() as connection:
+        listings = connection.exec_driver_sql(
+            'SELECT id, title, owner_id FROM listing ORDER BY title').all()
+        assert [(title, owner) for _, title, owner in listings] == [
+            ('House A', 1), ('House B', 2), ('House D', 1)]
+        ids = {title: listing_id for listing_id, title, _ in listings}
+        bookings = connection.exec_driver_sql(
+            'SELECT user_id, listing_id, start_date FROM booking '
+            'ORDER BY user_id, listing_id').all()
+        assert bookings == [(1, ids['House B'], '2022-03-01'),
+                            (2, ids['House A'], '2022-02-01'),
+                            (2, ids['House D'], '2022-02-01'),
+                            (3, ids['House A'], '2022-02-03'),
+                            (3, ids['House B'], '2022-02-03')]
+        tables = set(sa.inspect(connection).get_table_names())
+        assert 'listing_old' not in tables and 'booking_old' not in tables
+
+    # a converted database is left alone
+    assert migrate_schema(engine) == {}
+
+
+def test_init_db_needs_migrate_first():
+    engine = old_database()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': str(engine.url)})
+    with app.app_context():
+        with pytest.raises(OldSchemaError, match='qbnb migrate'):
+            init_db()
+        migrate_schema(db.engine)
+        init_db()
+        assert 'ix_listing_price' in {index['name'] for index in sa.inspect(
+            db.engine).get_indexes('listing')}
+        # running both steps again changes nothing
+        assert migrate_schema(db.engine) == {}
+        init_db()
+        db.engine.dispose()
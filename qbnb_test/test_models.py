@@ -1,5 +1,11 @@
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.exc import IntegrityError
+import qbnb.models
 from qbnb.models import create_listing, login, update_user, db, User
 from qbnb.models import register, update_listing, datetime, create_booking
+from qbnb.models import Listing, get_listings_page, update_users
+from qbnb.models import register_many, get_balance, create_bookings
 
 
 def test_r0_user_register():
@@ -119,6 +125,58 @@ def test_r1_10_user_register():
     assert (user.balance == 100) is not None
 
 
+def test_r1_11_register_many():
+    '''
+    Testing bulk registration: valid records are created with the same
+    defaults as register, and every rejected record gets its reason.
+    '''
+    rejected = register_many([
+        ('bulk0', 'bulkr111a@test.com', '123aB!'),
+        ('bulk1', 'bulkr111b@test.com', 'hello123'),
+        ('bulk2', 'test0@test.com', '123aB!'),
+        ('bulk3', 'bulkr111c@test.com', '123aB!'),
+        ('bulk4', 'bulkr111a@test.com', '123aB!'),
+        (' bulk5', 'bulkr111d@test.com', '123aB!'),
+    ], chunk_size=4)
+    assert rejected == [(1, 'invalid password'), (2, 'email already used'),
+                        (4, 'email already used'), (5, 'invalid username')]
+    user = User.query.filter_by(email='bulkr111c@test.com').first()
+    assert user.username == 'bulk3'
+    assert user.balance == 100
+    assert user.billing_address == '' and user.postal_code == ''
+    assert login('bulkr111a@test.com', '123aB!') is not None
+
+
+def test_r1_11_register_many_race(monkeypatch):
+    '''
+    Testing bulk registration when another registration takes one of
+    the emails between the check and the insert
+    '''
+    engine = db.engine
+    hash_password = qbnb.models.hash_password
+
+    def racing_hash(password, iterations=None):
+        if password == 'race1A!':
+            with engine.begin() as connection:
+                connection.execute(User.__table__.insert(), {
+                    'username': 'racer', 'email': 'bulkrace@test.com',
+                    'password': 'x', 'billing_address': '',
+                    'postal_code': '', 'balance': 100})
+        return hash_password(password, iterations)
+
+    monkeypatch.setattr(qbnb.models, 'hash_password', racing_hash)
+    rejected = register_many([
+        ('bulk6', 'bulkrace@test.com', 'race1A!'),
+        ('bulk7', 'bulkracea@test.com', '123aB!'),
+        ('bulk8', 'bulkrace@test.com', '123aB!'),
+    ], workers=1)
+    assert rejected == [(0, 'email already used'),
+                        (2, 'email already used')]
+    assert User.query.filter_by(email='bulkrace@test.com').one().username \
+        == 'racer'
+    assert User.query.filter_by(email='bulkracea@test.com').one()
+
+
 def test_r2_1_login():
     '''
     Testing R2-1: A user can log in using her/his email address 
@@ -280,6 +338,97 @@ def test_r3_4_update():
     # user = update_user('test0@test.com', "user0", "", "", "A1A1A1")
 
 
+def test_r3_5_update():
+    '''
+    An update with any invalid field changes nothing, not even
+    the fields that were valid.
+    '''
+    register('userr35', 'testr35@test.com', '123aB!')
+    user = update_user('testr35@test.com', "", "", "1 First Road", "A1A1A1")
+    assert user is not None
+
+    # valid postal code and address, invalid username
+    user = update_user('testr35@test.com', " bad name", "",
+                       "2 Second Road", "B2B2B2")
+    assert user is None
+    user = User.query.filter_by(email='testr35@test.com').first()
+    assert user.postal_code == "A1A1A1"
+    assert user.billing_address == "1 First Road"
+
+    # email already used by another user
+    user = update_user('testr35@test.com', "", "test1@test.com", "",
+                       "B2B2B2")
+    assert user is None
+    assert User.query.filter_by(email='testr35@test.com').first() is not None
+
+
+def test_r3_6_update_users():
+    '''
+    Bulk profile updates apply the valid rows, batch by batch, and
+    report why the others were rejected.
+    '''
+    for i in range(5):
+        register('bulkr36', 'bulkr36{}@test.com'.format(i), '123aB!')
+    rejected = update_users([
+        ('bulkr360@test.com', "bulk zero", "", "", "A1A1A1"),
+        ('bulkr361@test.com', "", "", "", "A!A1A1"),
+        ('nobodyr36@test.com', "", "", "", "A1A1A1"),
+        ('bulkr362@test.com', "", "bulkr363@test.com", "", "A1A1A1"),
+        ('bulkr364@test.com', "", "bulkr36x@test.com", "4 Road", "C3C3C3"),
+    ], batch_size=2)
+    assert rejected == [(1, 'invalid postal code'), (2, 'no such user'),
+                        (3, 'email already used')]
+    user = User.query.filter_by(email='bulkr360@test.com').first()
+    assert user.username == 'bulk zero'
+    user = User.query.filter_by(email='bulkr36x@test.com').first()
+    assert user.billing_address == '4 Road'
+    assert user.postal_code == 'C3C3C3'
+
+
+def test_r3_6_update_users_commit(monkeypatch):
+    '''
+    Bulk profile updates drop the cached users only once the batch is
+    committed, and roll the batch back when the commit fails.
+    '''
+    engine = db.engine
+    register('bulkr36c', 'bulkr36c@test.com', '123aB!')
+    register('bulkr36d', 'bulkr36d@test.com', '123aB!')
+
+    def committed_username(email):
+        with engine.connect() as connection:
+            return connection.execute(sa.select(User.username).where(
+                User.email == email)).scalar()
+
+    seen = []
+    invalidate = qbnb.models.invalidate_cached_user
+    monkeypatch.setattr(qbnb.models, 'invalidate_cached_user', lambda *e: (
+        seen.append(committed_username(e[-1])), invalidate(*e)))
+    assert update_users([
+        ('bulkr36c@test.com', 'bulk c', '', '', 'A1A1A1')]) == []
+    assert seen == ['bulk c']
+
+    bump = qbnb.models.bump_data_version
+
+    def racing_bump(name):
+        # someone else registers the new email before the commit
+        with engine.begin() as connection:
+            connection.execute(User.__table__.insert(), {
+                'username': 'racer', 'email': 'bulkr36race@test.com',
+                'password': 'x', 'billing_address': '', 'postal_code': '',
+                'balance': 100})
+        bump(name)
+
+    monkeypatch.setattr(qbnb.models, 'bump_data_version', racing_bump)
+    with pytest.raises(IntegrityError):
+        update_users([
+            ('bulkr36d@test.com', 'bulk d', 'bulkr36race@test.com', '',
+             'A1A1A1')])
+    assert seen == ['bulk c']
+    # the session was rolled back and can be used again
+    user = User.query.filter_by(email='bulkr36d@test.com').one()
+    assert user.username == 'bulkr36d'
+
+
 def test_r4_1_create_list():
     '''
     Testing R4-1: Title of the product has to be alphanumeric-only,
@@ -424,7 +573,7 @@ def test_r5_1_update_listing():
     # Shows that the listing is created
     assert listing is not None
     # Shows that the owner id is not changed
-    assert listing.owner_id == "test0@test.com"
+    assert listing.owner.email == "test0@test.com"
     # Shows that the title is updated
     assert listing.title == "New1 3Home"
     # Shows that the description is updated
@@ -456,7 +605,7 @@ def test_r5_3_update_listing():
                    "2021-01-06", "test0@test.com")
     listing = update_listing("test0@test.com", "N/A", "N/A", 2000)
     # Shows that the listing is None if it is a lower value
-    assert listing.last_modified_date == datetime.date.today()
+    assert listing.last_modified_date == datetime.date.today().isoformat()
 
 
 def test_r5_4_update_listing():
@@ -576,5 +725,112 @@ def test_5_create_booking():
     booking = (create_booking(user.email, listing_title, 
                               "2022-01-06", "2022-01-09"))
     assert booking is not None
-    assert user.balance == 0
-    assert owner.balance == 200
\ No newline at end of file
+    assert get_balance(user.id) == 0
+    assert get_balance(owner.id) == 200
+
+
+def test_6_create_booking():
+    '''
+    Overlap detection covers every way two date ranges can collide,
+    while back-to-back bookings sharing a check-out/check-in day pass.
+    '''
+    listing_title = "Overlap House"
+    owner = register("frank60", "frank60@email.com", "abC12!")
+    listing = (create_listing(listing_title, "This is a new nice big house",
+                              10, "2022-01-01", owner.email))
+    assert listing is not None
+    guests = [register("tommy6" + str(i), "tommy6" + str(i) + "@email.com",
+                       "abC12!") for i in range(7)]
+
+    assert create_booking(guests[0].email, listing_title,
+                          "2022-03-10", "2022-03-20") is not None
+    # identical range
+    assert create_booking(guests[1].email, listing_title,
+                          "2022-03-10", "2022-03-20") is None
+    # contained in the existing booking
+    assert create_booking(guests[1].email, listing_title,
+                          "2022-03-12", "2022-03-15") is None
+    # containing the existing booking
+    assert create_booking(guests[1].email, listing_title,
+                          "2022-03-01", "2022-03-25") is None
+    # end date before start date
+    assert create_booking(guests[1].email, listing_title,
+                          "2022-04-10", "2022-04-01") is None
+    # back to back on either side
+    assert create_booking(guests[2].email, listing_title,
+                          "2022-03-20", "2022-03-22") is not None
+    assert create_booking(guests[3].email, listing_title,
+                          "2022-03-05", "2022-03-10") is not None
+    # squeezed between two bookings
+    assert create_booking(guests[4].email, listing_title,
+                          "2022-03-21", "2022-03-23") is None
+    # dates without zero padding are normalised before comparing
+    assert create_booking(guests[5].email, listing_title,
+                          "2022-3-6", "2022-3-8") is None
+    assert create_booking(guests[6].email, listing_title,
+                          "2022-4-1", "2022-4-3") is not None
+
+
+def test_create_bookings():
+    '''
+    A batch of bookings follows the rules of create_booking, the
+    requests seeing each other's dates and payments, and is booked
+    all or nothing unless atomic is off.
+    '''
+    owner = register("batchhost", "batchhost@email.com", "abC12!")
+    guest = register("batchguest", "batchguest@email.com", "abC12!")
+    for title in ("Batch House 0", "Batch House 1"):
+        create_listing(title, "This is a batch nice big house", 40,
+                       "2022-01-01", owner.email)
+    requests = [
+        (guest.email, "Batch House 0", "2022-07-01", "2022-07-03"),
+        # overlaps the request above
+        (guest.email, "Batch House 0", "2022-07-02", "2022-07-04"),
+        (guest.email, "Batch House 1", "2022-07-01", "2022-07-03"),
+        # the first two bookings leave 20 of the 100
+        (guest.email, "Batch House 1", "2022-08-01", "2022-08-03"),
+        (owner.email, "Batch House 1", "2022-09-01", "2022-09-03"),
+        (guest.email, "No Such House", "2022-07-01", "2022-07-03"),
+        (guest.email, "Batch House 1", "2022-07-03", "2022-07-01"),
+    ]
+    reasons = [reason for _, reason in create_bookings(requests)]
+    assert reasons == ["another booking of the batch failed",
+                       "dates taken",
+                       "another booking of the batch failed",
+                       "insufficient balance", "own listing",
+                       "no such listing", "invalid dates"]
+    assert get_balance(guest.id) == 100
+
+    results = create_bookings(requests, atomic=False)
+    assert [booking is not None for booking, _ in results] == \
+        [True, False, True, False, False, False, False]
+    assert results[2][0].listing.title == "Batch House 1"
+    assert get_balance(guest.id) == 20
+    assert get_balance(owner.id) == 180
+    # now taken by the batch's bookings
+    assert create_booking(guest.email, "Batch House 0",
+                          "2022-07-02", "2022-07-03") is None
+
+
+def test_listings_page():
+    '''
+    The home page feed walks every listing exactly once, in title
+    order, following the next-page cursor.
+    '''
+    owner = register("pager0", "pager0@email.com", "abC12!")
+    for i in range(5):
+        assert create_listing("Paged House " + str(i),
+                              "This is a paged nice big house", 100,
+                              "2022-01-01", owner.email) is not None
+
+    seen = []
+    cursor = None
+    while True:
+        listings, cursor = get_listings_page(cursor, 2)
+        assert len(listings) <= 2
+        seen.extend(listing.title for listing in listings)
+        if cursor is None:
+            break
+    assert seen == sorted(seen)
+    assert len(seen) == len(set(seen)) == Listing.query.count()
+    assert "Paged House 4" in seen
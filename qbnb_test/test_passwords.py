@@ -0,0 +1,71 @@
+from qbnb import app
+from qbnb.models import db, register, login
+from qbnb.passwords import hash_password, verify_password, needs_rehash
+
+
+def test_password_is_stored_hashed():
+    '''
+    Registration never stores the plain text password,
+    and the same password hashes differently every time.
+    '''
+    user = register('hashed0', 'hashed0@test.com', '123aB!')
+    assert user.password != '123aB!'
+    assert user.password.startswith('pbkdf2_sha256$')
+    assert hash_password('123aB!') != hash_password('123aB!')
+    assert verify_password('123aB!', user.password)
+    assert not verify_password('123aB?', user.password)
+
+
+def test_login_rehashes_on_cost_change():
+    '''
+    Changing the work factor upgrades the stored hash
+    the next time the user logs in.
+    '''
+    user = register('hashed1', 'hashed1@test.com', '123aB!')
+    old_hash = user.password
+    cost = app.config['PASSWORD_HASH_ITERATIONS']
+    app.config['PASSWORD_HASH_ITERATIONS'] = cost + 1
+    try:
+        assert needs_rehash(old_hash)
+        user = login('hashed1@test.com', '123aB!')
+        assert user is not None
+        assert user.password != old_hash
+        assert '${}$'.format(cost + 1) in user.password
+        assert login('hashed1@test.com', '123aB!') is not None
+    finally:
+        app.config['PASSWORD_HASH_ITERATIONS'] = cost
+
+
+def test_login_upgrades_plain_text_password():
+    '''
+    Rows saved before hashing was introduced still log in,
+    and get hashed on the way.
+    '''
+    user = register('hashed2', 'hashed2@test.com', '123aB!')
+    user.password = '123aB!'
+    db.session.commit()
+    user = login('hashed2@test.com', '123aB!')
+    assert user is not None
+    assert user.password.startswith('pbkdf2_sha256$')
+    assert login('hashed2@test.com', '123aB?') is None
+
+
+def test_verification_cache():
+    '''
+    With the cache enabled, a repeated successful verification
+    is served from the cache, and a wrong password never is.
+    '''
+    encoded = hash_password('123aB!')
+    app.config['PASSWORD_VERIFY_CACHE_SIZE'] = 8
+    app.extensions.pop('qbnb_password_cache', None)
+    try:
+        assert verify_password('123aB!', encoded)
+        cache = app.extensions['qbnb_password_cache']
+        assert cache.hits == 0
+        assert verify_password('123aB!', encoded)
+        assert cache.hits == 1
+        assert not verify_password('123aB?', encoded)
+        assert cache.hits == 1
+    finally:
+        app.config['PASSWORD_VERIFY_CACHE_SIZE'] = 0
+        app.extensions.pop('qbnb_password_cache', None)
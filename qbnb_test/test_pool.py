@@ -0,0 +1,117 @@
+import os
+import tempfile
+import threading
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import event
+from qbnb import create_app, default_config
+from qbnb.models import db
+from qbnb.pool import MeteredQueuePool, pool_options, pool_stats
+from qbnb.pool import watch_pool
+
+'''
+This file tests the connection pool settings and metrics. The pool
+runs on a SQLite file here, and a connection MySQL dropped after its
+idle timeout is simulated by closing the DBAPI connection underneath
+the pool.
+'''
+
+POOL_SIZE = 4
+
+
+def make_engine(**settings):
+    config = dict(default_config(), DB_POOL_SIZE=POOL_SIZE,
+                  DB_MAX_OVERFLOW=0, DB_POOL_TIMEOUT=5)
+    config.update(settings)
+    db_file = os.path.join(tempfile.mkdtemp(), 'pool.sqlite')
+    engine = sa.create_engine('sqlite:///' + db_file,
+                              **pool_options(config))
+    watch_pool(engine)
+    opened = []
+    event.listen(engine, 'connect', lambda conn, record: opened.append(conn))
+    return engine, opened
+
+
+def fill_pool(engine):
+    connections = [engine.connect() for _ in range(POOL_SIZE)]
+    for connection in connections:
+        connection.execute(sa.text('SELECT 1'))
+        connection.close()
+
+
+def burst(engine, count=2 * POOL_SIZE):
+    '''
+    Run count concurrent queries, returns how many failed
+    '''
+    failures = []
+    barrier = threading.Barrier(count)
+
+    def query():
+        barrier.wait()
+        try:
+            with engine.connect() as connection:
+                connection.execute(sa.text('SELECT 1'))
+        except sa.exc.DBAPIError:
+            failures.append(1)
+
+    threads = [threading.Thread(target=query) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(failures)
+
+
+def test_pool_settings_from_config():
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'mysql+pymysql://x@h/db',
+                      'DB_POOL_SIZE': 3, 'DB_POOL_RECYCLE': 60})
+    with app.app_context():
+        pool = db.engine.pool
+        assert isinstance(pool, MeteredQueuePool)
+        assert pool.size() == 3
+        assert pool._recycle == 60
+        assert pool._pre_ping
+    # SQLite keeps Flask-SQLAlchemy's own pool setup
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with app.app_context():
+        assert not isinstance(db.engine.pool, MeteredQueuePool)
+
+
+def test_pre_ping_recovers_stale_connections():
+    '''
+    After every pooled connection died, a burst of queries still all
+    succeed: the pings find the dead connections and replace them.
+    '''
+    engine, opened = make_engine()
+    fill_pool(engine)
+    for connection in opened:
+        connection.close()
+
+    assert burst(engine) == 0
+    stats = pool_stats(engine)
+    assert stats['invalidations'] >= 1
+    assert stats['connects'] > POOL_SIZE
+    assert stats['checkouts'] >= 3 * POOL_SIZE
+    assert stats['timeouts'] == 0
+
+
+def test_without_pre_ping_stale_connections_fail():
+    engine, opened = make_engine(DB_POOL_PRE_PING=False)
+    fill_pool(engine)
+    for connection in opened:
+        connection.close()
+
+    assert burst(engine) > 0
+
+
+def test_checkout_timeout_is_counted():
+    engine, _ = make_engine(DB_POOL_SIZE=1, DB_POOL_TIMEOUT=0.05)
+    with engine.connect():
+        with pytest.raises(sa.exc.TimeoutError):
+            engine.connect()
+    stats = pool_stats(engine)
+    assert stats['timeouts'] == 1
+    assert stats['wait_max'] >= 0.05
+    # the counters survive engine.dispose()
+    engine.dispose()
+    assert pool_stats(engine)['timeouts'] == 1
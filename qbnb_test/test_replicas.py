@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import tempfile
+import time
+from flask import session
+from qbnb import create_app
+from qbnb.models import db, init_db, register, login, create_listing
+from qbnb.models import get_listings_page, update_users
+from qbnb.replicas import replica_key, PIN_KEY
+
+'''
+This file tests read replica routing with two SQLite files standing in
+for the primary and a replica. Replication is simulated by copying the
+primary into the replica with replicate(), so until it is called the
+replica lags behind.
+'''
+
+
+def make_app(window=5):
+    folder = tempfile.mkdtemp()
+    primary = os.path.join(folder, 'primary.sqlite')
+    replica = os.path.join(folder, 'replica.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + primary,
+                      'SQLALCHEMY_REPLICA_URIS': ['sqlite:///' + replica],
+                      'REPLICA_READ_YOUR_WRITES': window,
+                      'PASSWORD_HASH_ITERATIONS': 1000,
+                      'USER_CACHE_SIZE': 0})
+    with app.app_context():
+        init_db()
+        db.metadata.create_all(db.engines[replica_key(0)])
+
+    def replicate():
+        with app.app_context():
+            db.session.remove()
+            source = sqlite3.connect(primary)
+            target = sqlite3.connect(replica)
+            source.backup(target)
+            source.close()
+            target.close()
+    return app, replicate
+
+
+def titles():
+    listings, _ = get_listings_page(page_size=100)
+    return {listing.title for listing in listings}
+
+
+def test_reads_go_to_the_replica():
+    app, replicate = make_app()
+    with app.app_context():
+        register('owner one', 'owner@replica.com', '123aB!')
+        # the replica has not seen the user yet
+        assert login('owner@replica.com', '123aB!') is None
+        replicate()
+        assert login('owner@replica.com', '123aB!') is not None
+
+        assert create_listing('Replica Lag Flat', 'x' * 30, 100,
+                              '2022-03-04', 'owner@replica.com')
+        db.session.remove()
+        assert 'Replica Lag Flat' not in titles()
+        replicate()
+        assert 'Replica Lag Flat' in titles()
+
+
+def test_unflushed_writes_keep_reads_on_the_primary():
+    app, replicate = make_app()
+    with app.app_context():
+        register('owner one', 'owner@replica.com', '123aB!')
+        replicate()
+        user = login('owner@replica.com', '123aB!')
+        user.username = 'renamed'
+        # the pending change would be invisible on the replica
+        assert login('owner@replica.com', '123aB!').username == 'renamed'
+        db.session.rollback()
+
+
+def test_read_your_writes_window():
+    app, replicate = make_app(window=0.5)
+    with app.app_context():
+        register('owner one', 'owner@replica.com', '123aB!')
+        replicate()
+
+    with app.test_request_context():
+        assert create_listing('Own Write Flat', 'x' * 30, 100,
+                              '2022-03-04', 'owner@replica.com')
+        db.session.remove()
+        # the writer reads from the primary during the window
+        assert 'Own Write Flat' in titles()
+        time.sleep(0.6)
+        db.session.remove()
+        assert 'Own Write Flat' not in titles()
+
+
+def test_window_follows_the_user_between_requests():
+    app, replicate = make_app()
+    with app.app_context():
+        register('owner one', 'owner@replica.com', '123aB!')
+        register('guest one', 'guest@replica.com', '123aB!')
+        replicate()
+
+    owner = app.test_client()
+    guest = app.test_client()
+    for client, email in ((owner, 'owner@replica.com'),
+                          (guest, 'guest@replica.com')):
+        client.post('/login', data={'email': email, 'password': '123aB!'})
+    owner.post('/create_listing', data={
+        'title': 'Fresh Cookie Flat', 'description': 'x' * 30,
+        'price': 100, 'last_modified_date': '2022-03-04',
+        'email': 'owner@replica.com'})
+
+    assert b'Fresh Cookie Flat' in owner.get('/').data
+    assert b'Fresh Cookie Flat' not in guest.get('/').data
+    replicate()
+    assert b'Fresh Cookie Flat' in guest.get('/').data
+
+
+def test_every_write_opens_the_window():
+    app, replicate = make_app()
+    with app.app_context():
+        register('owner one', 'owner@replica.com', '123aB!')
+        replicate()
+    # a stronger work factor makes the next login rehash the password
+    app.config['PASSWORD_HASH_ITERATIONS'] = 2000
+    with app.test_request_context():
+        assert login('owner@replica.com', '123aB!') is not None
+        assert PIN_KEY in session
+    with app.test_request_context():
+        assert update_users([('owner@replica.com', 'owner two',
+                              'owner@replica.com', '', 'A1A1A1')]) == []
+        assert PIN_KEY in session
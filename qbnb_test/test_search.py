@@ -0,0 +1,163 @@
+import os
+import tempfile
+from qbnb import app, create_app
+from qbnb.models import db, init_db, register, create_listing
+from qbnb.models import update_listing, search_listings, Listing
+from qbnb.search import search_backend, index_listing, InvertedIndex
+
+'''
+This file tests listing search, on the FTS5 backend used by the test
+database and on the in-process fallback index.
+'''
+
+DESCRIPTION = 'A quiet place close to everything in town'
+
+
+def titles(query, limit=20):
+    return [listing.title for listing in search_listings(query, limit)]
+
+
+def test_search_fts5():
+    assert search_backend(db.session) == 'fts5'
+    register('search owner', 'search@test.com', '123aB!')
+    create_listing('Lakeside Cabin', DESCRIPTION + ' by the lake',
+                   100, '2022-03-04', 'search@test.com')
+    create_listing('City Loft', DESCRIPTION + ', with a lakeside view',
+                   100, '2022-03-04', 'search@test.com')
+    create_listing('Mountain Chalet', DESCRIPTION + ' near the slopes',
+                   100, '2022-03-04', 'search@test.com')
+
+    # a title match ranks above a description match
+    assert titles('lakeside') == ['Lakeside Cabin', 'City Loft']
+    # every word has to match, in any case
+    assert titles('LAKESIDE view') == ['City Loft']
+    assert titles('lakeside slopes') == []
+    assert titles('') == []
+    assert titles('quiet', limit=2) and len(titles('quiet', limit=2)) == 2
+
+
+def test_search_follows_updates():
+    register('update owner', 'searchupdate@test.com', '123aB!')
+    create_listing('Harbour Studio', DESCRIPTION, 100, '2022-03-04',
+                   'searchupdate@test.com')
+    assert titles('harbour') == ['Harbour Studio']
+    update_listing('searchupdate@test.com', 'Seaside Studio', 'N/A', -1)
+    assert titles('harbour') == []
+    assert titles('seaside') == ['Seaside Studio']
+
+
+def test_search_memory_index():
+    db_file = os.path.join(tempfile.mkdtemp(), 'search.sqlite')
+    memory_app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+        'PASSWORD_HASH_ITERATIONS': 1000})
+    with memory_app.app_context():
+        memory_app.extensions['qbnb_search_backend'] = 'memory'
+        init_db()
+        register('memory owner', 'memory@test.com', '123aB!')
+        create_listing('Garden Cottage', DESCRIPTION + ' in a garden',
+                       100, '2022-03-04', 'memory@test.com')
+        create_listing('Rooftop Flat', DESCRIPTION + ' above a garden',
+                       100, '2022-03-04', 'memory@test.com')
+        assert titles('garden') == ['Garden Cottage', 'Rooftop Flat']
+
+        update_listing('memory@test.com', 'Orchard Cottage', 'N/A', -1)
+        assert titles('orchard') == ['Orchard Cottage']
+        # equal scores keep the older listing first
+        assert titles('garden') == ['Orchard Cottage', 'Rooftop Flat']
+        # changes of this process are applied on commit only
+        listing = search_listings('orchard')[0]
+        index_listing(db.session, listing.id, 'Vineyard Cottage',
+                      listing.description)
+        assert titles('vineyard') == []
+        db.session.rollback()
+        assert titles('vineyard') == []
+
+        # a listing written by another process is picked up by id
+        owner_id = search_listings('rooftop')[0].owner_id
+        db.session.execute(Listing.__table__.insert(), [{
+            'title': 'Garden Shed', 'description': DESCRIPTION,
+            'price': 10, 'last_modified_date': '2022-03-04',
+            'owner_id': owner_id}])
+        db.session.commit()
+        assert titles('garden') == ['Garden Shed', 'Orchard Cottage',
+                                    'Rooftop Flat']
+
+
+def test_memory_index_keeps_id_order():
+    index = InvertedIndex()
+    for listing_id in (1, 2, 3):
+        index.add(listing_id, 'Dune House', DESCRIPTION)
+    # an update re-adds the oldest listing
+    index.add(1, 'Dune House', DESCRIPTION + ' by the sea')
+    # with room for two candidates, the two newest are ranked
+    assert sorted(index.search(['dune'], 3, 3, 2)) == [2, 3]
+    assert list(index.postings['dune']) == [1, 2, 3]
+
+
+def test_search_page():
+    register('page owner', 'searchpage@test.com', '123aB!')
+    create_listing('Treehouse Retreat', DESCRIPTION, 100, '2022-03-04',
+                   'searchpage@test.com')
+    client = app.test_client()
+    assert client.get('/search?q=treehouse').status_code == 302
+    client.post('/login', data={'email': 'searchpage@test.com',
+                                'password': '123aB!'})
+    page = client.get('/search?q=treehouse').data
+    assert b'1 listings for' in page
+    assert b'Treehouse Retreat' in page
+
+
+def test_search_over_candidate_cap():
+    register('cap owner', 'searchcap@test.com', '123aB!')
+    for title in ('Canal Boat', 'Old Canal House', 'Canal Side Flat',
+                  'Bridge Room'):
+        create_listing(title, DESCRIPTION + ' on the canal', 100,
+                       '2022-03-04', 'searchcap@test.com')
+    app.config['SEARCH_RANK_CANDIDATES'] = 2
+    try:
+        # too many matches to rank: newest title matches, then the rest
+        assert titles('canal', limit=4) == ['Canal Side Flat',
+                                            'Old Canal House', 'Canal Boat',
+                                            'Bridge Room']
+        assert titles('canal', limit=2) == ['Canal Side Flat',
+                                            'Old Canal House']
+    finally:
+        app.config['SEARCH_RANK_CANDIDATES'] = 2000
+
+
+def edit_through_form(backend, title):
+    '''
+    Edit a listing through /update_listing of an app of its own, so
+    the request ends as it would in production
+      Returns:
+        The app and a logged in client
+    '''
+    db_file = os.path.join(tempfile.mkdtemp(), 'search.sqlite')
+    form_app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+        'PASSWORD_HASH_ITERATIONS': 1000})
+    with form_app.app_context():
+        form_app.extensions['qbnb_search_backend'] = backend
+        init_db()
+        register('form owner', 'searchform@test.com', '123aB!')
+        create_listing('Prairie Barn', DESCRIPTION, 100, '2022-03-04',
+                       'searchform@test.com')
+        assert titles('prairie') == ['Prairie Barn']
+    client = form_app.test_client()
+    client.post('/login', data={'email': 'searchform@test.com',
+                                'password': '123aB!'})
+    response = client.post('/update_listing', data={
+        'email': 'searchform@test.com', 'title': title,
+        'description': 'N/A', 'price': '-1'})
+    assert b'Listing Updated.' in response.data
+    return form_app, client
+
+
+def test_search_follows_form_updates():
+    for backend in ('fts5', 'memory'):
+        form_app, client = edit_through_form(backend, 'Meadow Barn')
+        assert b'Meadow Barn' in client.get('/search?q=meadow').data
+        assert b'0 listings for' in client.get('/search?q=prairie').data
+        with form_app.app_context():
+            assert titles('meadow') == ['Meadow Barn']
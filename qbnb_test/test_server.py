@@ -0,0 +1,106 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import pytest
+
+'''
+This file tests the pre-forking server of qbnb/server.py, run with
+python -m qbnb serve in a process of its own: requests keep being
+served while workers are recycled and restarted.
+'''
+
+pytestmark = pytest.mark.skipif(
+    not os.path.exists('/proc/self/task'),
+    reason='finds the workers through /proc')
+
+# seconds the server gets to stop, its workers are idle
+GRACE = 10
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def children(pid):
+    with open('/proc/{0}/task/{0}/children'.format(pid)) as listing:
+        return set(listing.read().split())
+
+
+def wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.1)
+
+
+def get(port):
+    with urllib.request.urlopen(
+            'http://127.0.0.1:{}/login'.format(port), timeout=10) as response:
+        return response.status
+
+
+def start_server(max_requests):
+    # no services, so that the children are the workers
+    environment = dict(os.environ, password_hash_iterations='1000',
+                       booking_queue='0', balance_snapshot_interval='0',
+                       db_string='sqlite:///' + os.path.join(
+                           tempfile.mkdtemp(), 'server.sqlite'))
+    subprocess.run([sys.executable, '-m', 'qbnb', 'init-db'],
+                   env=environment, check=True, stdout=subprocess.DEVNULL)
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'qbnb', 'serve', '--host', '127.0.0.1',
+         '--port', str(port), '--workers', '2',
+         '--max-requests', str(max_requests)],
+        env=environment, stdout=subprocess.DEVNULL)
+    wait_for(lambda: len(children(server.pid)) == 2)
+    return server, port
+
+
+def stop_server(server):
+    if server.poll() is None:
+        server.kill()
+        server.wait()
+
+
+def test_serve_recycles_workers():
+    server, port = start_server(max_requests=3)
+    try:
+        first = children(server.pid)
+        # each worker is replaced after 3 requests
+        assert [get(port) for _ in range(12)] == [200] * 12
+        wait_for(lambda: len(children(server.pid)) == 2)
+        assert children(server.pid) != first
+
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=GRACE) == 0
+    finally:
+        stop_server(server)
+
+
+def test_serve_restarts_workers_on_sighup():
+    server, port = start_server(max_requests=0)
+    try:
+        before = children(server.pid)
+        assert get(port) == 200
+        server.send_signal(signal.SIGHUP)
+        statuses = []
+        # every worker is replaced, one at a time, while requests
+        # are served
+        wait_for(lambda: statuses.append(get(port)) or (
+            len(children(server.pid)) == 2 and
+            not children(server.pid) & before))
+        assert statuses and set(statuses) == {200}
+        assert get(port) == 200
+
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=GRACE) == 0
+    finally:
+        stop_server(server)
@@ -0,0 +1,41 @@
+import os
+import tempfile
+import pytest
+from qbnb import create_app
+from qbnb.models import db, init_db
+from qbnb.sqlite_profile import sqlite_pragmas
+
+'''
+This file tests that the SQLite profiles are applied on connect.
+'''
+
+
+def pragmas_of(profile):
+    db_file = os.path.join(tempfile.mkdtemp(), 'profile.sqlite')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_file,
+                      'SQLITE_PROFILE': profile})
+    with app.app_context():
+        init_db()
+        with db.engine.connect() as connection:
+            pragma = connection.exec_driver_sql
+            return {name: pragma('PRAGMA ' + name).scalar()
+                    for name in ('journal_mode', 'synchronous',
+                                 'busy_timeout')}
+
+
+def test_wal_profile():
+    assert pragmas_of('wal') == {'journal_mode': 'wal', 'synchronous': 1,
+                                 'busy_timeout': 5000}
+
+
+def test_default_profile():
+    assert pragmas_of('default')['journal_mode'] == 'delete'
+
+
+def test_pragma_overrides_and_unknown_profile():
+    pragmas = sqlite_pragmas({'SQLITE_PROFILE': 'wal',
+                              'SQLITE_PRAGMAS': {'synchronous': 'FULL'}})
+    assert pragmas['synchronous'] == 'FULL'
+    assert pragmas['journal_mode'] == 'WAL'
+    with pytest.raises(ValueError):
+        sqlite_pragmas({'SQLITE_PROFILE': 'fast'})
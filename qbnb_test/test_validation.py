@@ -0,0 +1,53 @@
+from qbnb.validation import valid_username, valid_email, valid_title
+from qbnb.validation import validate_registrations
+
+
+def old_username_check(name):
+    # the per-character loop register used before the validation engine
+    if (len(name) <= 2) or (len(name) >= 20):
+        return False
+    for i in range(len(name)):
+        if (i == 0) or (i == len(name) - 1):
+            if not name[i].isalnum():
+                return False
+        elif not name[i].isalnum() and name[i] != ' ':
+            return False
+    return True
+
+
+def test_username_fast_path_matches_loop():
+    '''
+    The character-class fast path accepts exactly the names
+    the old per-character loop accepted.
+    '''
+    names = ['', 'ab', 'abc', ' abc', 'abc ', 'a c', 'a  c', 'a_c',
+             'a!c', 'x' * 19, 'x' * 20, 'user 1 2', 'éclair', '1 2 3']
+    for name in names:
+        assert valid_username(name) == old_username_check(name), name
+
+
+def test_email_and_title_rules():
+    assert valid_email('test0@test.com')
+    assert valid_email('first.last@test.com')
+    assert not valid_email('test0test.com')
+    assert not valid_email(None)
+    assert valid_title('New1 2Home')
+    assert not valid_title(' New Home')
+    assert not valid_title('New  Home')
+    assert not valid_title('X' * 81)
+    assert not valid_title('')
+
+
+def test_validate_registrations_batch():
+    '''
+    The batch API reports a reason for every rejected record
+    and None for every valid one, in input order.
+    '''
+    records = [('user0', 'batch0@test.com', '123aB!'),
+               ('user1', '', '123aB!'),
+               ('user2', 'batch2test.com', '123aB!'),
+               ('user3', 'batch3@test.com', 'hello123'),
+               (' user4', 'batch4@test.com', '123aB!')]
+    assert validate_registrations(records) == [
+        None, 'email and password are required', 'invalid email',
+        'invalid password', 'invalid username']
@@ -5,6 +5,7 @@ import tempfile
 import threading
 from werkzeug.serving import make_server
 from qbnb import app
+from qbnb.models import init_db
 
 '''
 This file defines what to do BEFORE running any test cases:
@@ -17,9 +18,14 @@ def pytest_sessionstart():
     '''
     print('Setting up environment..')
     db_file = 'db.sqlite'
-    if os.path.exists(db_file):
-        os.remove(db_file)
+    # with the WAL profile the log and its index sit next to the file
+    for path in (db_file, db_file + '-wal', db_file + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+    # keep password hashing cheap, the suites register many users
+    app.config['PASSWORD_HASH_ITERATIONS'] = 1000
     app.app_context().push()
+    init_db()
 
 
 def pytest_sessionfinish():
@@ -37,8 +43,6 @@ class ServerThread(threading.Thread):
 
     def __init__(self):
         threading.Thread.__init__(self)
-        # import necessary routes
-        from qbnb import controllers
         self.srv = make_server('127.0.0.1', 8081, app)
         self.ctx = app.app_context()
         self.ctx.push()